@@ -1,7 +1,6 @@
 # (C) Datadog, Inc. 2018-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
-import copy
 import functools
 import importlib
 import inspect
@@ -28,11 +27,15 @@ from ..types import (
     ProxySettings,
     ServiceCheckStatus,
 )
-from ..utils.agent.utils import should_profile_memory
+from ..utils.agent.common import METRIC_PROFILE_NAMESPACE
+from ..utils.agent.utils import should_profile_cpu, should_profile_memory
 from ..utils.common import ensure_bytes, to_native_string
+from ..utils.containers import mutable_copy, read_only
+from ..utils.executor import DEFAULT_MAX_CONCURRENCY, CheckExecutor, get_shared_executor
 from ..utils.http import RequestsWrapper
-from ..utils.limiter import Limiter
+from ..utils.limiter import DEFAULT_PRECISION, HyperLogLog, Limiter
 from ..utils.metadata import MetadataManager
+from ..utils.normalization import NormalizationCache
 from ..utils.proxy import config_proxy_skip
 from ..utils.secrets import SecretsSanitizer
 
@@ -115,6 +118,10 @@ class AgentCheck(object):
     DOT_UNDERSCORE_CLEANUP = re.compile(br'_*\._*')
     DEFAULT_METRIC_LIMIT = 0
 
+    # Set to True when `check` never modifies its `instance` argument, so that the same read-only
+    # view of the instance is passed every run instead of a new copy
+    FROZEN_INSTANCE = False
+
     def __init__(self, *args, **kwargs):
         # type: (*Any, **Any) -> None
         """In general, you don't need to and you should not override anything from the base
@@ -235,6 +242,16 @@ class AgentCheck(object):
         # Setup metric limits
         self.metric_limiter = self._get_metric_limiter(self.name, instance=self.instance)
 
+        # Opt-in estimation of the number of distinct contexts submitted, reset after each run
+        self._context_cardinality = self._get_context_cardinality(instance=self.instance)
+
+        # Opt-in cache of normalized tags and formatted metric names, cleared after each run
+        self._normalization_cache = self._get_normalization_cache(instance=self.instance)
+
+        # Read-only view of the instance passed to `check` when `FROZEN_INSTANCE` is set,
+        # built once all initializations have been done
+        self._frozen_instance = None  # type: Optional[InstanceType]
+
         # Functions that will be called exactly once (if successful) before the first check run
         self.check_initializations = deque([self.send_config_metadata])  # type: Deque[Callable[[], None]]
 
@@ -243,7 +260,11 @@ class AgentCheck(object):
         limit = self._get_metric_limit(instance=instance)
 
         if limit > 0:
-            return Limiter(name, 'metrics', limit, self.warning)
+            compact = (self.init_config or {}).get('compact_metric_limiter', False)
+            if instance is not None:
+                compact = instance.get('compact_metric_limiter', compact)
+
+            return Limiter(name, 'metrics', limit, self.warning, compact=is_affirmative(compact))
 
         return None
 
@@ -281,6 +302,38 @@ class AgentCheck(object):
 
         return limit
 
+    def _get_context_cardinality(self, instance=None):
+        # type: (InstanceType) -> Optional[HyperLogLog]
+        config = {}
+        config.update(self.init_config or {})
+        config.update(instance or {})
+
+        if not is_affirmative(config.get('context_cardinality', False)):
+            return None
+
+        precision = config.get('context_cardinality_precision', DEFAULT_PRECISION)
+        try:
+            return HyperLogLog(int(precision))
+        except (ValueError, TypeError):
+            self.warning(
+                "Configured 'context_cardinality_precision' must be an integer between 4 and 16: %s. "
+                "Reverting to the default precision: %s",
+                precision,
+                DEFAULT_PRECISION,
+            )
+            return HyperLogLog()
+
+    def _get_normalization_cache(self, instance=None):
+        # type: (InstanceType) -> Optional[NormalizationCache]
+        enabled = (self.init_config or {}).get('normalization_cache', False)
+        if instance is not None:
+            enabled = instance.get('normalization_cache', enabled)
+
+        if is_affirmative(enabled):
+            return NormalizationCache()
+
+        return None
+
     @staticmethod
     def load_config(yaml_str):
         # type: (str) -> Any
@@ -299,9 +352,25 @@ class AgentCheck(object):
         """
         if not hasattr(self, '_http'):
             self._http = RequestsWrapper(self.instance or {}, self.init_config, self.HTTP_CONFIG_REMAPPER, self.log)
+            self._http.task_executor = self.task_executor
 
         return self._http
 
+    @property
+    def task_executor(self):
+        # type: () -> CheckExecutor
+        """
+        Runs tasks on the thread pool shared by all checks, at most `max_concurrent_tasks` at a time for
+        this instance. Tasks that have not started yet are cancelled when the check is unscheduled.
+        """
+        if not hasattr(self, '_task_executor'):
+            max_concurrency = (self.instance or {}).get(
+                'max_concurrent_tasks', (self.init_config or {}).get('max_concurrent_tasks', DEFAULT_MAX_CONCURRENCY)
+            )
+            self._task_executor = CheckExecutor(get_shared_executor(), int(max_concurrency))
+
+        return self._task_executor
+
     @property
     def metadata_manager(self):
         # type: () -> MetadataManager
@@ -380,6 +449,24 @@ class AgentCheck(object):
         # type: (int, str, Sequence[str], str) -> str
         return '{}-{}-{}-{}'.format(mtype, name, tags if tags is None else hash(frozenset(tags)), hostname)
 
+    def _context_hash(self, mtype, name, tags=None, hostname=None):
+        # type: (int, str, Sequence[str], str) -> int
+        return hash((mtype, name, tags if tags is None else frozenset(tags), hostname))
+
+    def _limit_context(self, mtype, name, tags, hostname, context_hash=None):
+        # type: (int, str, Sequence[str], str, Optional[int]) -> bool
+        """
+        Returns whether the metric limit was reached, for metric types that are expected to be
+        submitted several times per context
+        """
+        if self.metric_limiter.compact:
+            if context_hash is None:
+                context_hash = self._context_hash(mtype, name, tags, hostname)
+
+            return self.metric_limiter.is_reached(context_hash)
+
+        return self.metric_limiter.is_reached(self._context_uid(mtype, name, tags, hostname))
+
     def submit_histogram_bucket(self, name, value, lower_bound, upper_bound, monotonic, hostname, tags):
         # type: (str, float, int, int, bool, str, Sequence[str]) -> None
         if value is None:
@@ -416,6 +503,11 @@ class AgentCheck(object):
         if hostname is None:
             hostname = ''
 
+        context_hash = None
+        if self._context_cardinality is not None:
+            context_hash = self._context_hash(mtype, name, tags, hostname)
+            self._context_cardinality.add(context_hash)
+
         if self.metric_limiter:
             if mtype in ONE_PER_CONTEXT_METRIC_TYPES:
                 # Fast path for gauges, rates, monotonic counters, assume one set of tags per call
@@ -423,8 +515,7 @@ class AgentCheck(object):
                     return
             else:
                 # Other metric types have a legit use case for several calls per set of tags, track unique sets of tags
-                context = self._context_uid(mtype, name, tags, hostname)
-                if self.metric_limiter.is_reached(context):
+                if self._limit_context(mtype, name, tags, hostname, context_hash):
                     return
 
         try:
@@ -570,6 +661,88 @@ class AgentCheck(object):
             aggregator.COUNTER, name, value, tags=tags, hostname=hostname, device_name=device_name, raw=raw
         )
 
+    def submit_batch(self, mtype, name, values, tags_list=None, hostnames=None, raw=False):
+        # type: (int, str, Sequence[float], Sequence[Sequence[str]], Sequence[str], bool) -> None
+        """Submit several samples of the same metric at once.
+
+        This is equivalent to calling the method matching `mtype` for every sample, but the metric name is
+        formatted only once, consecutive samples sharing the same tag list are normalized only once and the
+        samples are handed to the Agent in a single call when it supports it.
+
+        :param int mtype: the metric type, e.g. :code:`aggregator.GAUGE`.
+        :param str name: the name of the metric.
+        :param list values: the values of the samples.
+        :param list tags_list: (optional) the list of tags of each sample.
+        :param list hostnames: (optional) the hostname of each sample. Defaults to the current host.
+        :param bool raw: (optional) whether to ignore any defined namespace prefix
+        """
+        if tags_list is None:
+            tags_list = [None] * len(values)
+        if hostnames is None:
+            hostnames = [None] * len(values)
+
+        if not len(values) == len(tags_list) == len(hostnames):
+            raise ValueError(
+                'Batch for metric {} has {} values, {} tag lists and {} hostnames.'.format(
+                    repr(name), len(values), len(tags_list), len(hostnames)
+                )
+            )
+
+        batch_values = []
+        batch_tags = []
+        batch_hostnames = []
+        one_per_context = mtype in ONE_PER_CONTEXT_METRIC_TYPES
+
+        last_tags = normalized_tags = None
+        for value, tags, hostname in zip(values, tags_list, hostnames):
+            if value is None:
+                # ignore metric sample
+                continue
+
+            if tags is not last_tags or normalized_tags is None:
+                last_tags = tags
+                normalized_tags = self._normalize_tags_type(tags or [], metric_name=name)
+            if hostname is None:
+                hostname = ''
+
+            context_hash = None
+            if self._context_cardinality is not None:
+                context_hash = self._context_hash(mtype, name, normalized_tags, hostname)
+                self._context_cardinality.add(context_hash)
+
+            if self.metric_limiter:
+                if one_per_context:
+                    if self.metric_limiter.is_reached():
+                        break
+                elif self._limit_context(mtype, name, normalized_tags, hostname, context_hash):
+                    continue
+
+            try:
+                value = float(value)
+            except ValueError:
+                err_msg = 'Metric: {} has non float value: {}. Only float values can be submitted as metrics.'.format(
+                    repr(name), repr(value)
+                )
+                if using_stub_aggregator:
+                    raise ValueError(err_msg)
+                self.warning(err_msg)
+                continue
+
+            batch_values.append(value)
+            batch_tags.append(normalized_tags)
+            batch_hostnames.append(hostname)
+
+        if not batch_values:
+            return
+
+        name = self._format_namespace(name, raw)
+        submit_metrics = getattr(aggregator, 'submit_metrics', None)
+        if submit_metrics is not None:
+            submit_metrics(self, self.check_id, mtype, name, batch_values, batch_tags, batch_hostnames)
+        else:
+            for value, tags, hostname in zip(batch_values, batch_tags, batch_hostnames):
+                aggregator.submit_metric(self, self.check_id, mtype, name, value, tags, hostname)
+
     def service_check(self, name, status, tags=None, hostname=None, message=None, raw=False):
         # type: (str, ServiceCheckStatus, Sequence[str], str, str, bool) -> None
         """Send the status of a service.
@@ -655,6 +828,27 @@ class AgentCheck(object):
 
         return entrypoint
 
+    def read_persistent_cache(self, key):
+        # type: (str) -> str
+        """Returns the value previously stored with `write_persistent_cache` for the same `key`.
+
+        :param str key: the key to retrieve
+        """
+        return datadog_agent.read_persistent_cache(self._persistent_cache_id(key))
+
+    def write_persistent_cache(self, key, value):
+        # type: (str, str) -> None
+        """Stores `value` in a persistent cache for this check instance, which is kept across Agent restarts.
+
+        :param str key: the key to store the value under
+        :param str value: the value to store
+        """
+        datadog_agent.write_persistent_cache(self._persistent_cache_id(key), value)
+
+    def _persistent_cache_id(self, key):
+        # type: (str) -> str
+        return '{}_{}'.format(self.check_id, key)
+
     def set_external_tags(self, external_tags):
         # type: (Sequence[ExternalTagType]) -> None
         # Example of external_tags format
@@ -736,10 +930,21 @@ class AgentCheck(object):
 
     def _format_namespace(self, s, raw=False):
         # type: (str, bool) -> str
+        cache = self._normalization_cache
+        if cache is not None:
+            name = cache.get_name(s, raw)
+            if name is not None:
+                return name
+
         if not raw and self.__NAMESPACE__:
-            return '{}.{}'.format(self.__NAMESPACE__, to_native_string(s))
+            name = '{}.{}'.format(self.__NAMESPACE__, to_native_string(s))
+        else:
+            name = to_native_string(s)
+
+        if cache is not None:
+            cache.set_name(s, raw, name)
 
-        return to_native_string(s)
+        return name
 
     def normalize(self, metric, prefix=None, fix_case=False):
         # type: (Union[str, bytes], Union[str, bytes], bool) -> str
@@ -786,6 +991,16 @@ class AgentCheck(object):
         # type: (InstanceType) -> None
         raise NotImplementedError
 
+    def cancel(self):
+        # type: () -> None
+        """
+        This method is called when the check is unscheduled by the Agent, possibly while it is running,
+        so it must be thread safe and must not block.
+        """
+        task_executor = getattr(self, '_task_executor', None)
+        if task_executor is not None:
+            task_executor.cancel()
+
     def run(self):
         # type: () -> str
         try:
@@ -797,7 +1012,13 @@ class AgentCheck(object):
                     self.check_initializations.appendleft(initialization)
                     raise
 
-            instance = copy.deepcopy(self.instances[0])
+            if self.FROZEN_INSTANCE:
+                if self._frozen_instance is None:
+                    self._frozen_instance = read_only(self.instances[0])
+
+                instance = self._frozen_instance
+            else:
+                instance = mutable_copy(self.instances[0])
 
             if 'set_breakpoint' in self.init_config:
                 from ..utils.agent.debug import enter_pdb
@@ -812,10 +1033,23 @@ class AgentCheck(object):
                     self.check, self.init_config, namespaces=self.check_id.split(':', 1), args=(instance,)
                 )
 
-                tags = ['check_name:{}'.format(self.name), 'check_version:{}'.format(self.check_version)]
+                tags = self._get_profile_tags()
                 tags.extend(instance.get('__memory_profiling_tags', []))
                 for m in metrics:
                     self.gauge(m.name, m.value, tags=tags, raw=True)
+            elif 'profile_cpu' in self.init_config or (
+                is_affirmative(datadog_agent.get_config('cpu_profiling_enabled'))
+                and should_profile_cpu(datadog_agent, self.name)
+            ):
+                from ..utils.agent.cpu import profile_cpu
+
+                metrics = profile_cpu(
+                    self.check, self.init_config, namespaces=self.check_id.split(':', 1), args=(instance,)
+                )
+
+                tags = self._get_profile_tags()
+                for m in metrics:
+                    self.gauge(m.name, m.value, tags=tags + m.tags, raw=True)
             else:
                 self.check(instance)
 
@@ -825,11 +1059,83 @@ class AgentCheck(object):
             tb = self.sanitize(traceback.format_exc())
             result = json.dumps([{'message': message, 'traceback': tb}])
         finally:
+            if self._normalization_cache is not None:
+                self._send_normalization_cache_stats()
+
+            http = getattr(self, '_http', None)
+            if http is not None and http.connection_stats is not None:
+                self._send_http_connection_stats(http.connection_stats)
+
+            task_executor = getattr(self, '_task_executor', None)
+            if task_executor is not None and task_executor.submitted:
+                self._send_task_executor_stats(task_executor)
+
+            if self._context_cardinality is not None:
+                self._send_context_cardinality()
+
             if self.metric_limiter:
                 self.metric_limiter.reset()
 
         return result
 
+    def _get_profile_tags(self):
+        # type: () -> List[str]
+        """
+        Tags of the metrics sent under the `datadog.agent.profile` namespace
+        """
+        return ['check_name:{}'.format(self.name), 'check_version:{}'.format(self.check_version)]
+
+    def _send_task_executor_stats(self, task_executor):
+        # type: (CheckExecutor) -> None
+        tags = self._get_profile_tags()
+        for name, value in task_executor.get_stats():
+            self.gauge('{}.executor.{}'.format(METRIC_PROFILE_NAMESPACE, name), value, tags=tags, raw=True)
+
+        task_executor.reset()
+
+    def _send_context_cardinality(self):
+        # type: () -> None
+        # Submitted straight to the aggregator: these metrics neither count against
+        # the metric limit nor are part of the next estimate
+        tags = self._get_profile_tags()
+        aggregator.submit_metric(
+            self,
+            self.check_id,
+            aggregator.GAUGE,
+            '{}.contexts.estimated'.format(METRIC_PROFILE_NAMESPACE),
+            float(self._context_cardinality.estimate()),
+            tags,
+            '',
+        )
+        if self.metric_limiter:
+            aggregator.submit_metric(
+                self,
+                self.check_id,
+                aggregator.GAUGE,
+                '{}.contexts.limit'.format(METRIC_PROFILE_NAMESPACE),
+                float(self.metric_limiter.limit),
+                tags,
+                '',
+            )
+
+        self._context_cardinality.reset()
+
+    def _send_normalization_cache_stats(self):
+        # type: () -> None
+        tags = self._get_profile_tags()
+        for name, value in self._normalization_cache.get_stats():
+            self.gauge('{}.normalization_cache.{}'.format(METRIC_PROFILE_NAMESPACE, name), value, tags=tags, raw=True)
+
+        self._normalization_cache.reset()
+
+    def _send_http_connection_stats(self, connection_stats):
+        # type: (Any) -> None
+        tags = self._get_profile_tags()
+        for name, value in connection_stats.get_stats():
+            self.gauge('{}.http.{}'.format(METRIC_PROFILE_NAMESPACE, name), value, tags=tags, raw=True)
+
+        connection_stats.reset()
+
     def event(self, event):
         # type: (Event) -> None
         """Send an event.
@@ -887,6 +1193,13 @@ class AgentCheck(object):
         - normalize tags type
         - doesn't mutate the passed list, returns a new list
         """
+        cache = self._normalization_cache
+        if cache is not None:
+            tags, key = cache.tags_key(tags, device_name)
+            normalized_tags = cache.get_tags(key)
+            if normalized_tags is not None:
+                return normalized_tags
+
         normalized_tags = []
 
         if device_name:
@@ -910,4 +1223,7 @@ class AgentCheck(object):
 
             normalized_tags.append(tag)
 
+        if cache is not None:
+            cache.set_tags(key, normalized_tags)
+
         return normalized_tags
@@ -1,21 +1,35 @@
 # (C) Datadog, Inc. 2020-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
+import re
+from math import isinf
 
+from google.protobuf.internal.decoder import _DecodeVarint32  # pylint: disable=E0611,E0401
 from prometheus_client.metrics_core import Metric
-from prometheus_client.parser import _parse_sample, _replace_help_escaping
+from prometheus_client.parser import _parse_sample, _replace_escaping, _replace_help_escaping
+from prometheus_client.samples import Sample
+
+from ...utils.prometheus import metrics_pb2
+
+# The sample name is everything up to the label set or the first whitespace
+SAMPLE_NAME_PATTERN = re.compile(r'[^{\s]*')
 
 
 # This copies most of the code from upstream at that version:
 # https://github.com/prometheus/client_python/blob/049744296d216e6be65dc8f3d44650310f39c384/prometheus_client/parser.py#L144
 # but reverting the behavior to a compatible version, which doesn't change counters to have a total suffix. See
 # https://github.com/prometheus/client_python/commit/a4dd93bcc6a0422e10cfa585048d1813909c6786#diff-0adf47ea7f99c66d4866ccb4e557a865L158
-def text_fd_to_metric_families(fd):
+def text_fd_to_metric_families(fd, family_filter=None):
     """Parse Prometheus text format from a file descriptor.
 
     This is a laxer parser than the main Go parser, so successful parsing does
     not imply that the parsed text meets the specification.
 
+    If `family_filter` is provided, it is called with the name and the type of every
+    family at its `# HELP`/`# TYPE` boundary (and with the sample name and `untyped`
+    for families without metadata). Families for which it returns a falsy value are
+    skipped entirely: their sample lines are never tokenized and no label dict is built.
+
     Yields Metric's.
     """
     name = ''
@@ -23,6 +37,7 @@ def text_fd_to_metric_families(fd):
     typ = 'untyped'
     samples = []
     allowed_names = []
+    skip = False
 
     def build_metric(name, documentation, typ, samples):
         # This is where the change is happening: we don't munge counters as upstream does.
@@ -39,20 +54,22 @@ def text_fd_to_metric_families(fd):
                 continue
             if parts[1] == 'HELP':
                 if parts[2] != name:
-                    if name != '':
+                    if name != '' and not skip:
                         yield build_metric(name, documentation, typ, samples)
                     # New metric
                     name = parts[2]
                     typ = 'untyped'
                     samples = []
                     allowed_names = [parts[2]]
+                    if family_filter is not None:
+                        skip = not family_filter(name, typ)
                 if len(parts) == 4:
                     documentation = _replace_help_escaping(parts[3])
                 else:
                     documentation = ''
             elif parts[1] == 'TYPE':
                 if parts[2] != name:
-                    if name != '':
+                    if name != '' and not skip:
                         yield build_metric(name, documentation, typ, samples)
                     # New metric
                     name = parts[2]
@@ -66,12 +83,32 @@ def text_fd_to_metric_families(fd):
                     'histogram': ['_count', '_sum', '_bucket'],
                 }.get(typ, [''])
                 allowed_names = [name + n for n in allowed_names]
+                if family_filter is not None:
+                    skip = not family_filter(name, typ)
             else:
                 # Ignore other comment tokens
                 pass
         elif line == '':
             # Ignore blank lines
             pass
+        elif family_filter is not None:
+            sample_name = SAMPLE_NAME_PATTERN.match(line).group(0)
+            if sample_name in allowed_names:
+                if not skip:
+                    samples.append(_parse_sample(line))
+                continue
+
+            if name != '' and not skip:
+                yield build_metric(name, documentation, typ, samples)
+            name = ''
+            documentation = ''
+            typ = 'untyped'
+            samples = []
+            allowed_names = []
+            skip = False
+            if family_filter(sample_name, typ):
+                # New metric, yield immediately as untyped singleton
+                yield build_metric(sample_name, documentation, typ, [_parse_sample(line)])
         else:
             sample = _parse_sample(line)
             if sample.name not in allowed_names:
@@ -87,5 +124,300 @@ def text_fd_to_metric_families(fd):
             else:
                 samples.append(sample)
 
-    if name != '':
+    if name != '' and not skip:
+        yield build_metric(name, documentation, typ, samples)
+
+
+# A sample line is made of a name, an optional label set and a value (optionally followed by a timestamp)
+BYTES_SAMPLE_PATTERN = re.compile(br'[ \t]*([^#{\s][^{\s]*)(?:[ \t]*\{(.*)\}[ \t]*|[ \t]+)(\S+)')
+BYTES_SAMPLE_NAME_PATTERN = re.compile(br'[ \t]*([^#{\s][^{\s]*)?')
+BYTES_LABEL_PATTERN = re.compile(br'([^=,\s]+)\s*=\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+
+def bytes_to_metric_families(buf, family_filter=None):
+    """Parse Prometheus text format from a bytes-like object, e.g. a `bytearray` holding the whole payload.
+
+    Lines, names and label sets are located with offsets into `buf` so that the payload is
+    never decoded nor split into intermediate line strings: only metadata lines, metric and
+    label names (which are cached) and label values are decoded.
+
+    Accepts the same `family_filter` as `text_fd_to_metric_families`.
+
+    Yields Metric's.
+    """
+    name = ''
+    documentation = ''
+    typ = 'untyped'
+    samples = []
+    allowed_names = []
+    skip = False
+    names = {}
+    find_labels = BYTES_LABEL_PATTERN.findall
+
+    def build_metric(name, documentation, typ, samples):
+        metric = Metric(name, documentation, typ)
+        metric.samples = samples
+        return metric
+
+    def decode_name(raw_name):
+        decoded = names.get(raw_name)
+        if decoded is None:
+            decoded = names[raw_name] = raw_name.decode('utf-8')
+        return decoded
+
+    def parse_sample(match):
+        labels = {}
+        labels_start, labels_end = match.span(2)
+        if labels_start != -1:
+            for label_name, label_value in find_labels(buf, labels_start, labels_end):
+                label_value = label_value.decode('utf-8')
+                if '\\' in label_value:
+                    label_value = _replace_escaping(label_value)
+                labels[names.get(label_name) or decode_name(label_name)] = label_value
+
+        return Sample(names.get(match.group(1)) or decode_name(match.group(1)), labels, float(match.group(3)))
+
+    position = 0
+    size = len(buf)
+    while position < size:
+        line_start = position
+        line_end = buf.find(b'\n', line_start)
+        if line_end == -1:
+            line_end = size
+        position = line_end + 1
+
+        if family_filter is not None:
+            match = BYTES_SAMPLE_NAME_PATTERN.match(buf, line_start, line_end)
+            raw_name = match.group(1)
+            if raw_name:
+                sample_name = decode_name(raw_name)
+                if sample_name in allowed_names:
+                    if not skip:
+                        samples.append(parse_sample(_match_sample(buf, line_start, line_end)))
+                    continue
+
+                if name != '' and not skip:
+                    yield build_metric(name, documentation, typ, samples)
+                name = ''
+                documentation = ''
+                typ = 'untyped'
+                samples = []
+                allowed_names = []
+                skip = False
+                if family_filter(sample_name, typ):
+                    # New metric, yield immediately as untyped singleton
+                    yield build_metric(
+                        sample_name, documentation, typ, [parse_sample(_match_sample(buf, line_start, line_end))]
+                    )
+                continue
+        else:
+            match = BYTES_SAMPLE_PATTERN.match(buf, line_start, line_end)
+            if match is not None:
+                sample = parse_sample(match)
+                if sample.name not in allowed_names:
+                    if name != '':
+                        yield build_metric(name, documentation, typ, samples)
+                    # New metric, yield immediately as untyped singleton
+                    name = ''
+                    documentation = ''
+                    typ = 'untyped'
+                    samples = []
+                    allowed_names = []
+                    yield build_metric(sample.name, documentation, typ, [sample])
+                else:
+                    samples.append(sample)
+                continue
+
+        line = buf[line_start:line_end].strip()
+        if not line:
+            # Ignore blank lines
+            continue
+        elif not line.startswith(b'#'):
+            raise ValueError('Invalid sample line: {!r}'.format(bytes(line)))
+
+        parts = line.decode('utf-8').split(None, 3)
+        if len(parts) < 2:
+            continue
+        if parts[1] == 'HELP':
+            if parts[2] != name:
+                if name != '' and not skip:
+                    yield build_metric(name, documentation, typ, samples)
+                # New metric
+                name = parts[2]
+                typ = 'untyped'
+                samples = []
+                allowed_names = [parts[2]]
+                if family_filter is not None:
+                    skip = not family_filter(name, typ)
+            if len(parts) == 4:
+                documentation = _replace_help_escaping(parts[3])
+            else:
+                documentation = ''
+        elif parts[1] == 'TYPE':
+            if parts[2] != name:
+                if name != '' and not skip:
+                    yield build_metric(name, documentation, typ, samples)
+                # New metric
+                name = parts[2]
+                documentation = ''
+                samples = []
+            typ = parts[3]
+            allowed_names = {
+                'counter': [''],
+                'gauge': [''],
+                'summary': ['_count', '_sum', ''],
+                'histogram': ['_count', '_sum', '_bucket'],
+            }.get(typ, [''])
+            allowed_names = [name + n for n in allowed_names]
+            if family_filter is not None:
+                skip = not family_filter(name, typ)
+
+    if name != '' and not skip:
         yield build_metric(name, documentation, typ, samples)
+
+
+def _match_sample(buf, line_start, line_end):
+    match = BYTES_SAMPLE_PATTERN.match(buf, line_start, line_end)
+    if match is None:
+        raise ValueError('Invalid sample line: {!r}'.format(bytes(buf[line_start:line_end])))
+    return match
+
+
+PROTOBUF_METRIC_TYPES = {
+    metrics_pb2.COUNTER: 'counter',
+    metrics_pb2.GAUGE: 'gauge',
+    metrics_pb2.SUMMARY: 'summary',
+    metrics_pb2.UNTYPED: 'untyped',
+    metrics_pb2.HISTOGRAM: 'histogram',
+}
+
+
+def protobuf_to_metric_families(chunks, family_filter=None):
+    """Parse the Prometheus protobuf format from an iterable of bytes, e.g. `response.iter_content()`.
+
+    The payload is a stream of MetricFamily messages [0], each one prefixed with its length as a varint32 [1].
+    Messages are decoded as soon as they are fully received and converted to the same Metric's, with the
+    same samples, as the ones built from the text format.
+
+    Accepts the same `family_filter` as `text_fd_to_metric_families`: the name and type of each
+    family are read from the message header so that rejected families are never decoded.
+
+    [0] https://github.com/prometheus/client_model/blob/086fe7ca28bde6cec2acd5223423c1475a362858/metrics.proto#L76-%20%20L81  # noqa: E501
+    [1] https://developers.google.com/protocol-buffers/docs/reference/java/com/google/protobuf/AbstractMessageLite#writeDelimitedTo(java.io.OutputStream)  # noqa: E501
+
+    Yields Metric's.
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+
+        position = 0
+        size = len(buf)
+        while position < size:
+            try:
+                message_length, message_start = _DecodeVarint32(buf, position)
+            except IndexError:
+                # The length itself has not been fully received yet
+                break
+
+            message_end = message_start + message_length
+            if message_end > size:
+                break
+            position = message_end
+
+            header = None
+            if family_filter is not None:
+                header = _read_family_header(buf, message_start, message_end)
+                if header is not None and not family_filter(*header):
+                    continue
+
+            family = metrics_pb2.MetricFamily()
+            family.ParseFromString(bytes(buf[message_start:message_end]))
+            if header is None and family_filter is not None:
+                if not family_filter(family.name, PROTOBUF_METRIC_TYPES.get(family.type, 'untyped')):
+                    continue
+
+            yield _build_metric_from_protobuf(family)
+
+        del buf[:position]
+
+    if buf:
+        raise ValueError('Truncated protobuf payload, {} trailing bytes'.format(len(buf)))
+
+
+def _read_family_header(buf, start, end):
+    """
+    Read the name and type of a serialized MetricFamily, which precede its metrics. Returns
+    None if the header cannot be read without decoding the whole message.
+    """
+    name = ''
+    typ = metrics_pb2.COUNTER
+    position = start
+    while position < end:
+        tag, position = _DecodeVarint32(buf, position)
+        field_number, wire_type = tag >> 3, tag & 0x7
+        if field_number == 4:
+            break
+        elif wire_type == 0:
+            value, position = _DecodeVarint32(buf, position)
+            if field_number == 3:
+                typ = value
+        elif wire_type == 2:
+            length, position = _DecodeVarint32(buf, position)
+            if field_number == 1:
+                name = bytes(buf[position : position + length]).decode('utf-8')
+            position += length
+        else:
+            return None
+
+    if typ not in PROTOBUF_METRIC_TYPES:
+        return None
+
+    return name, PROTOBUF_METRIC_TYPES[typ]
+
+
+def _format_bound(value):
+    # Same representation of infinite values as in the text format
+    if isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def _build_metric_from_protobuf(family):
+    name = family.name
+    typ = PROTOBUF_METRIC_TYPES.get(family.type, 'untyped')
+    metric = Metric(name, family.help, typ)
+
+    samples = []
+    for message in family.metric:
+        labels = {pair.name: pair.value for pair in message.label}
+        if typ == 'counter':
+            samples.append(Sample(name, labels, message.counter.value))
+        elif typ == 'gauge':
+            samples.append(Sample(name, labels, message.gauge.value))
+        elif typ == 'untyped':
+            samples.append(Sample(name, labels, message.untyped.value))
+        elif typ == 'summary':
+            for quantile in message.summary.quantile:
+                quantile_labels = dict(labels)
+                quantile_labels['quantile'] = _format_bound(quantile.quantile)
+                samples.append(Sample(name, quantile_labels, quantile.value))
+            samples.append(Sample(name + '_sum', labels, message.summary.sample_sum))
+            samples.append(Sample(name + '_count', labels, float(message.summary.sample_count)))
+        else:
+            infinite_bucket = False
+            for bucket in message.histogram.bucket:
+                bucket_labels = dict(labels)
+                bucket_labels['le'] = _format_bound(bucket.upper_bound)
+                infinite_bucket = isinf(bucket.upper_bound)
+                samples.append(Sample(name + '_bucket', bucket_labels, float(bucket.cumulative_count)))
+            if not infinite_bucket:
+                # The +Inf bucket is implicit in the protobuf format
+                bucket_labels = dict(labels)
+                bucket_labels['le'] = '+Inf'
+                samples.append(Sample(name + '_bucket', bucket_labels, float(message.histogram.sample_count)))
+            samples.append(Sample(name + '_sum', labels, message.histogram.sample_sum))
+            samples.append(Sample(name + '_count', labels, float(message.histogram.sample_count)))
+
+    metric.samples = samples
+    return metric
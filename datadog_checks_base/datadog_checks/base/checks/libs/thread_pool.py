@@ -25,9 +25,12 @@
 import sys
 import threading
 import traceback
+from concurrent import futures
 
 from six.moves import queue, range
 
+from ...utils.executor import CheckExecutor, get_shared_executor
+
 # Item pushed on the work queue to tell the worker threads to terminate
 SENTINEL = "QUIT"
 
@@ -640,3 +643,139 @@ class OrderedResultCollector(AbstractResultCollector):
 
 
 ## end of http://code.activestate.com/recipes/576519/ }}}
+
+
+class FutureResult(object):
+    """Result of the `SharedPool::*_async()` methods, with the same
+    interface as ApplyResult, backed by the futures of the tasks"""
+
+    def __init__(self, fs, single=True, as_iterator=False, ordered=True, callback=None):
+        self._futures = fs
+        self._single = single
+        self._as_iterator = as_iterator
+        self._ordered = ordered
+
+        # Futures in the order they completed
+        self._completed = []
+        for future in fs:
+            future.add_done_callback(self._completed.append)
+
+        if callback is not None:
+            remaining = [len(fs)]
+            lock = threading.Lock()
+
+            def notify(_):
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]:
+                        return
+
+                if self.successful():
+                    try:
+                        callback(self._value())
+                    except:
+                        traceback.print_exc()
+
+            for future in fs:
+                future.add_done_callback(notify)
+
+    def _value(self):
+        values = [future.result() for future in (self._futures if self._ordered else self._completed)]
+        if self._single:
+            return values[0]
+        elif self._as_iterator:
+            return iter(values)
+        return values
+
+    def get(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError("Result not available within %fs" % timeout)
+        return self._value()
+
+    def wait(self, timeout=None):
+        _, not_done = futures.wait(self._futures, timeout)
+        return not not_done
+
+    def ready(self):
+        return all(future.done() for future in self._futures)
+
+    def successful(self):
+        assert self.ready()
+        return all(not future.cancelled() and future.exception() is None for future in self._futures)
+
+
+class SharedPool(object):
+    """
+    Drop-in replacement for Pool that runs the jobs on the thread pool
+    shared by all checks instead of starting its own threads, with at
+    most `nworkers` jobs running at once
+    """
+
+    def __init__(self, nworkers, name="Pool", executor=None):
+        """
+        :param nworkers: number of jobs to run at once
+        :param name: unused, kept for compatibility with Pool
+        :param executor: CheckExecutor to use, e.g. the `task_executor`
+        of a check, a new one is created by default
+        """
+        if executor is None:
+            executor = CheckExecutor(get_shared_executor(), nworkers)
+        self._executor = executor
+        self._closed = False
+        self._futures = set()
+
+    def get_nworkers(self):
+        """Returns the number of jobs that can run at once"""
+        return self._executor.max_concurrency
+
+    def _submit(self, func, args=(), kwds=None):
+        assert not self._closed
+        future = self._executor.submit(func, *args, **(kwds or {}))
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def apply(self, func, args=(), kwds=dict()):
+        return self.apply_async(func, args, kwds).get()
+
+    def map(self, func, iterable, chunksize=None):
+        return self.map_async(func, iterable, chunksize).get()
+
+    def imap(self, func, iterable, chunksize=1):
+        fs = [self._submit(func, (item,)) for item in iterable]
+        return (future.result() for future in fs)
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        fs = [self._submit(func, (item,)) for item in iterable]
+        return (future.result() for future in futures.as_completed(fs))
+
+    def apply_async(self, func, args=(), kwds=dict(), callback=None):
+        return FutureResult([self._submit(func, args, kwds)], callback=callback)
+
+    def map_async(self, func, iterable, chunksize=None, callback=None):
+        fs = [self._submit(func, (item,)) for item in iterable]
+        return FutureResult(fs, single=False, callback=callback)
+
+    def imap_async(self, func, iterable, chunksize=None, callback=None):
+        fs = [self._submit(func, (item,)) for item in iterable]
+        return FutureResult(fs, single=False, as_iterator=True, callback=callback)
+
+    def imap_unordered_async(self, func, iterable, chunksize=None, callback=None):
+        fs = [self._submit(func, (item,)) for item in iterable]
+        return FutureResult(fs, single=False, as_iterator=True, ordered=False, callback=callback)
+
+    def close(self):
+        """Prevents any more tasks from being submitted to the pool"""
+        self._closed = True
+
+    def terminate(self):
+        """Stops accepting tasks and cancels the ones that have not
+        started yet"""
+        self.close()
+        for future in list(self._futures):
+            future.cancel()
+
+    def join(self):
+        """Waits for the tasks of the pool to complete"""
+        assert self._closed
+        futures.wait(list(self._futures))
@@ -0,0 +1,198 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+from operator import itemgetter
+
+from six import iteritems
+
+# indexes in the sample tuple of core.Metric
+SAMPLE_LABELS = 1
+SAMPLE_VALUE = 2
+
+
+class LabelJoinIndex(object):
+    """
+    LabelJoinIndex stores the labels collected from the metrics listed in `label_joins`
+    and adds them to the samples of the other metrics sharing the labels to match.
+
+    Tables are keyed by the sorted tuple of the labels to match, and then by the value of
+    these labels (the value itself when matching a single label, a tuple otherwise).
+    Entries are kept in two generations: the ones stored or used during the current run,
+    and the ones from the previous run which are moved to the current generation when
+    used again. Calling `expire` at the end of a run drops the entries that were not
+    used for a whole run, without going through all of them.
+    """
+
+    def __init__(self, label_joins, log=None):
+        """
+        :param label_joins: the `label_joins` option of the scraper configuration
+        :param log: logger used to warn about deprecated options
+        """
+        # join metric name -> (key, getter, labels to match, labels to get or None for all of them)
+        self.sources = {}
+        # key -> getter
+        self.keys = {}
+        # metric name -> (label names of the keys not found in its samples yet, tuple of (key, getter) that may apply)
+        self.families = {}
+
+        for metric_name, join in iteritems(label_joins):
+            if 'labels_to_match' in join:
+                labels = join['labels_to_match']
+            elif 'label_to_match' in join:
+                if log is not None:
+                    log.warning("`label_to_match` is being deprecated, please use `labels_to_match`")
+                labels = join['label_to_match']
+                if not isinstance(labels, list):
+                    labels = [labels]
+            else:
+                continue
+
+            if not labels:
+                continue
+
+            key = tuple(sorted(set(labels)))
+            getter = itemgetter(*key)
+            labels_to_get = join['labels_to_get']
+            labels_to_get = None if '*' in labels_to_get else tuple(labels_to_get)
+
+            self.sources[metric_name] = (key, getter, frozenset(key), labels_to_get)
+            self.keys[key] = getter
+
+        # Match single labels first, then tuples of labels
+        self.ordered_keys = sorted(self.keys, key=len)
+        self.key_labels = frozenset(label for key in self.keys for label in key)
+
+        self.current = {key: {} for key in self.keys}
+        self.previous = {key: {} for key in self.keys}
+
+    def mapping(self, key):
+        """
+        Returns all the labels stored for `key`, by label value
+        """
+        mapping = dict(self.previous.get(key, {}))
+        mapping.update(self.current.get(key, {}))
+        return mapping
+
+    def applicable_keys(self, metric):
+        """
+        Returns the keys whose labels are all present in the samples of the metric.
+
+        Results are cached by metric name, and only computed again when a label of the
+        keys that was never seen in the samples of the metric shows up.
+        """
+        cached = self.families.get(metric.name)
+        if cached is not None:
+            missing, applicable = cached
+            if not missing:
+                return applicable
+
+            for sample in metric.samples:
+                if not missing.isdisjoint(sample[SAMPLE_LABELS]):
+                    break
+            else:
+                return applicable
+
+        if not metric.samples:
+            return ()
+
+        label_names = set()
+        for sample in metric.samples:
+            label_names.update(sample[SAMPLE_LABELS])
+        if cached is not None:
+            label_names.update(self.key_labels - cached[0])
+
+        applicable = tuple((key, self.keys[key]) for key in self.ordered_keys if label_names.issuperset(key))
+        self.families[metric.name] = (self.key_labels - label_names, applicable)
+        return applicable
+
+    def needs_join(self, metric):
+        """
+        Whether the metric may be enriched with the labels collected from other metrics
+        """
+        return metric.name not in self.sources and bool(self.applicable_keys(metric))
+
+    def _entry(self, key, value):
+        current = self.current[key]
+        try:
+            return current[value]
+        except KeyError:
+            entry = self.previous[key].pop(value, None)
+            if entry is not None:
+                current[value] = entry
+            return entry
+
+    def store(self, metric):
+        """
+        Collects the labels of the metric if it is listed in `label_joins`
+        """
+        try:
+            key, getter, labels_to_match, labels_to_get = self.sources[metric.name]
+        except KeyError:
+            return
+
+        for sample in metric.samples:
+            # metadata-only metrics that are used for label joins are always equal to 1
+            # this is required for metrics where all combinations of a state are sent
+            # but only the active one is set to 1 (others are set to 0)
+            # example: kube_pod_status_phase in kube-state-metrics
+            if sample[SAMPLE_VALUE] != 1:
+                continue
+
+            sample_labels = sample[SAMPLE_LABELS]
+            try:
+                value = getter(sample_labels)
+            except KeyError:
+                continue
+
+            if labels_to_get is None:
+                labels = {
+                    label_name: label_value
+                    for label_name, label_value in iteritems(sample_labels)
+                    if label_name not in labels_to_match
+                }
+            else:
+                labels = {
+                    label_name: sample_labels[label_name] for label_name in labels_to_get if label_name in sample_labels
+                }
+
+            entry = self._entry(key, value)
+            if entry is None:
+                self.current[key][value] = labels
+            else:
+                entry.update(labels)
+
+    def join(self, metric):
+        """
+        Adds the collected labels to the samples of the metric
+        """
+        applicable = self.applicable_keys(metric)
+        if not applicable:
+            return
+
+        samples = metric.samples
+        for key, getter in applicable:
+            current = self.current[key]
+            previous = self.previous[key]
+            for sample in samples:
+                sample_labels = sample[SAMPLE_LABELS]
+                try:
+                    value = getter(sample_labels)
+                except KeyError:
+                    continue
+
+                try:
+                    entry = current[value]
+                except KeyError:
+                    entry = previous.pop(value, None)
+                    if entry is None:
+                        continue
+                    current[value] = entry
+
+                sample_labels.update(entry)
+
+    def expire(self):
+        """
+        Starts a new generation, dropping the entries that were not used since the previous call
+        """
+        self.previous = self.current
+        self.current = {key: {} for key in self.keys}
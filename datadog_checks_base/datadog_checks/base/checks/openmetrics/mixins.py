@@ -3,26 +3,64 @@
 # Licensed under a 3-clause BSD style license (see LICENSE)
 from __future__ import division
 
+import sys
+from concurrent import futures
 from fnmatch import translate
+from functools import partial
 from math import isinf, isnan
 from os.path import isfile
 from re import compile
+from timeit import default_timer
 
 import requests
 from prometheus_client.samples import Sample
-from six import PY3, iteritems, string_types
+from six import PY3, iteritems, itervalues, reraise, string_types
 
 from ...config import is_affirmative
 from ...errors import CheckException
 from ...utils.common import to_native_string
 from ...utils.http import RequestsWrapper
+from ...utils.lru import LRUCache
 from .. import AgentCheck
-from ..libs.prometheus import text_fd_to_metric_families
+from ..libs.prometheus import bytes_to_metric_families, protobuf_to_metric_families, text_fd_to_metric_families
+from .label_joins import LabelJoinIndex
 
 if PY3:
     long = int
 
 
+class _PhaseTimer(object):
+    """
+    Adds the time spent in the `with` block to the telemetry timings of a scrape
+    """
+
+    __slots__ = ('timings', 'phase', 'start')
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+
+    def __exit__(self, *exc_info):
+        self.timings[self.phase] += default_timer() - self.start
+
+
+class _NoTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_TIMER = _NoTimer()
+
+
 class OpenMetricsScraperMixin(object):
     # pylint: disable=E1101
     # This class is not supposed to be used by itself, it provides scraping behavior but
@@ -43,15 +81,37 @@ class OpenMetricsScraperMixin(object):
     TELEMETRY_COUNTER_METRICS_INPUT_COUNT = "metrics.input.count"
     TELEMETRY_COUNTER_METRICS_IGNORE_COUNT = "metrics.ignored.count"
     TELEMETRY_COUNTER_METRICS_PROCESS_COUNT = "metrics.processed.count"
+    TELEMETRY_GAUGE_TAGS_CACHE_SIZE = "tags_cache.size"
+    TELEMETRY_COUNTER_TAGS_CACHE_HIT_COUNT = "tags_cache.hit.count"
+    TELEMETRY_COUNTER_TAGS_CACHE_MISS_COUNT = "tags_cache.miss.count"
+    TELEMETRY_COUNTER_TAGS_CACHE_EVICTION_COUNT = "tags_cache.eviction.count"
+    TELEMETRY_HISTOGRAM_HTTP_WAIT_TIME = "scrape.http_wait.time"
+    TELEMETRY_HISTOGRAM_FIRST_BYTE_TIME = "scrape.first_byte.time"
+    TELEMETRY_HISTOGRAM_PARSE_TIME = "scrape.parse.time"
+    TELEMETRY_HISTOGRAM_LABEL_JOIN_TIME = "scrape.label_join.time"
+    TELEMETRY_HISTOGRAM_FILTER_TIME = "scrape.filter.time"
+    TELEMETRY_HISTOGRAM_SUBMIT_TIME = "scrape.submit.time"
+    TELEMETRY_GAUGE_FAMILY_SAMPLES = "metrics.family.samples"
+    TELEMETRY_GAUGE_FAMILY_TIME = "metrics.family.time"
 
     METRIC_TYPES = ['counter', 'gauge', 'summary', 'histogram']
 
+    PROTOBUF_CONTENT_TYPE = 'application/vnd.google.protobuf'
+    # Same preference as the Prometheus server, falling back to the text format
+    PROTOBUF_ACCEPT_HEADER = (
+        'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,'
+        'text/plain;version=0.0.4;q=0.3'
+    )
+
     KUBERNETES_TOKEN_PATH = '/var/run/secrets/kubernetes.io/serviceaccount/token'
 
     def __init__(self, *args, **kwargs):
         # Initialize AgentCheck's base class
         super(OpenMetricsScraperMixin, self).__init__(*args, **kwargs)
 
+        # Executor used by `process_all`, set up on first use
+        self._scrape_executor = None
+
     def create_scraper_configuration(self, instance=None):
 
         # We can choose to create a default mixin configuration for an empty instance
@@ -129,26 +189,16 @@ class OpenMetricsScraperMixin(object):
         config['label_joins'] = default_instance.get('label_joins', {})
         config['label_joins'].update(instance.get('label_joins', {}))
 
-        # `_label_mapping` holds the additionals label info to add for a specific
-        # label value, example:
-        # self._label_mapping = {
-        #     'pod': {
-        #         'dd-agent-9s1l1': [("node","yolo"),("host_ip","yey")]
-        #     }
-        # }
-        config['_label_mapping'] = {}
+        # `_label_join_index` holds the labels collected from the metrics of `label_joins`
+        # to add to the other metrics, see LabelJoinIndex. It is built on the first scrape.
+        config['_label_join_index'] = None
 
-        # `_active_label_mapping` holds a dictionary of label values found during the run
-        # to cleanup the label_mapping of unused values, example:
-        # self._active_label_mapping = {
-        #     'pod': {
-        #         'dd-agent-9s1l1': True
-        #     }
-        # }
-        config['_active_label_mapping'] = {}
-
-        # `_watched_labels` holds the sets of labels to watch for enrichment
-        config['_watched_labels'] = {}
+        # The first scrape only collects the labels to join, without submitting anything, so that
+        # metrics exposed before the ones of `label_joins` are not submitted without their labels.
+        # When disabled, these metrics are instead processed at the end of the first scrape.
+        config['label_joins_dry_run'] = is_affirmative(
+            instance.get('label_joins_dry_run', default_instance.get('label_joins_dry_run', True))
+        )
 
         config['_dry_run'] = True
 
@@ -172,6 +222,34 @@ class OpenMetricsScraperMixin(object):
         if ignored_patterns:
             config['_ignored_re'] = compile('|'.join(ignored_patterns))
 
+        # If you want families that will not be collected (not mapped, without a transformer, ignored or
+        # untyped) to be skipped while parsing the payload, set skip_unwanted_families to True. Their samples
+        # are then neither tokenized nor counted by the telemetry. Leave it disabled in checks overriding
+        # `process_metric` to handle families that are not in `metrics`.
+        config['skip_unwanted_families'] = is_affirmative(
+            instance.get('skip_unwanted_families', default_instance.get('skip_unwanted_families', False))
+        )
+
+        # `_wanted_families` caches, per (family name, family type), whether the family should be parsed
+        config['_wanted_families'] = {}
+
+        # If you want the payload to be read into a buffer and parsed directly as bytes instead of being decoded
+        # and split line by line, set parse_as_bytes to True. Only names, metadata and label values get decoded.
+        # It's not used when lines are filtered with `_text_filter_blacklist`.
+        config['parse_as_bytes'] = is_affirmative(
+            instance.get('parse_as_bytes', default_instance.get('parse_as_bytes', False))
+        )
+
+        # `_payload_buffer` holds the payload when parsing as bytes, it is reused from one scrape to the next
+        config['_payload_buffer'] = bytearray()
+
+        # If you want to request the protobuf exposition format, which is cheaper to parse than the text format,
+        # set prefer_protobuf to True. Endpoints that don't support it will keep sending the text format.
+        # The text format is always requested when `_text_filter_blacklist` is set.
+        config['prefer_protobuf'] = is_affirmative(
+            instance.get('prefer_protobuf', default_instance.get('prefer_protobuf', False))
+        )
+
         # If you want to send the buckets as tagged values when dealing with histograms,
         # set send_histograms_buckets to True, set to False otherwise.
         config['send_histograms_buckets'] = is_affirmative(
@@ -193,6 +271,9 @@ class OpenMetricsScraperMixin(object):
         if config['send_distribution_buckets'] is True:
             config['non_cumulative_buckets'] = True
 
+        # `_bucket_bounds` caches, per histogram family, the sorted bucket boundaries used to decumulate buckets
+        config['_bucket_bounds'] = {}
+
         # If you want to send `counter` metrics as monotonic counts, set this value to True.
         # Set to False if you want to instead send those metrics as `gauge`.
         config['send_monotonic_counter'] = is_affirmative(
@@ -225,6 +306,12 @@ class OpenMetricsScraperMixin(object):
         # will just not be added as tags when submitting the metric.
         config['exclude_labels'] = default_instance.get('exclude_labels', []) + instance.get('exclude_labels', [])
 
+        # If you want the tags built from each label set to be formatted once and reused across runs,
+        # set tags_cache_size to the maximum number of label sets to remember (least recently used ones
+        # are evicted first). Custom and dynamic tags are still added, and finalized, for every sample.
+        tags_cache_size = int(instance.get('tags_cache_size', default_instance.get('tags_cache_size', 0)))
+        config['_tags_cache'] = LRUCache(tags_cache_size) if tags_cache_size > 0 else None
+
         # `type_overrides` is a dictionary where the keys are prometheus metric names
         # and the values are a metric type (name as string) to use instead of the one
         # listed in the payload. It can be used to force a type on untyped metrics.
@@ -273,6 +360,16 @@ class OpenMetricsScraperMixin(object):
             'prometheus_timeout', default_instance.get('prometheus_timeout', 10)
         )
 
+        # Maximum time in seconds to wait for the payload to be fetched and parsed by a worker thread
+        # when several endpoints are processed concurrently, see `process_all`
+        config['scrape_timeout'] = instance.get('scrape_timeout', default_instance.get('scrape_timeout', None))
+
+        # Outcome of the request and of the parsing done by a worker thread, consumed by the next scrape
+        config['_prefetched_response'] = None
+        config['_prefetched_families'] = None
+        # Scrape submitted to a worker thread that timed out and may still be running
+        config['_prefetch_future'] = None
+
         # Authentication used when polling endpoint
         config['username'] = instance.get('username', default_instance.get('username', None))
         config['password'] = instance.get('password', default_instance.get('password', None))
@@ -287,6 +384,8 @@ class OpenMetricsScraperMixin(object):
         # one of these strings, it will be filtered out before being parsed.
         # INTERNAL FEATURE, might be removed in future versions
         config['_text_filter_blacklist'] = []
+        # Number of lines filtered out during the current scrape, submitted by `process`
+        config['_text_filter_blacklist_count'] = 0
 
         # Whether or not to use the service account bearer token for authentication
         # if 'bearer_token_path' is not set, we use /var/run/secrets/kubernetes.io/serviceaccount/token
@@ -305,6 +404,16 @@ class OpenMetricsScraperMixin(object):
 
         config['telemetry'] = is_affirmative(instance.get('telemetry', default_instance.get('telemetry', False)))
 
+        # Number of metric families reported by the telemetry as the most expensive to process
+        config['telemetry_top_families'] = int(
+            instance.get('telemetry_top_families', default_instance.get('telemetry_top_families', 10))
+        )
+
+        # Time spent in each phase of the current scrape, and the number of samples and time spent
+        # per metric family, only tracked when the telemetry is enabled
+        config['_telemetry_timings'] = None
+        config['_telemetry_families'] = None
+
         # The metric name services use to indicate build information
         config['metadata_metric_name'] = instance.get(
             'metadata_metric_name', default_instance.get('metadata_metric_name')
@@ -319,6 +428,9 @@ class OpenMetricsScraperMixin(object):
         if config['metadata_metric_name'] and config['metadata_label_map']:
             config['_default_metric_transformers'][config['metadata_metric_name']] = self.transform_metadata
 
+        # `_metric_transformers` holds the names of the families handled by a transformer
+        config['_metric_transformers'] = frozenset(config['_default_metric_transformers'])
+
         return config
 
     def get_http_handler(self, scraper_config):
@@ -352,7 +464,10 @@ class OpenMetricsScraperMixin(object):
         headers.setdefault('accept-encoding', 'gzip')
 
         # Explicitly set the content type we accept
-        headers.setdefault('accept', 'text/plain')
+        if scraper_config['prefer_protobuf']:
+            headers.setdefault('accept', self.PROTOBUF_ACCEPT_HEADER)
+        else:
+            headers.setdefault('accept', 'text/plain')
 
         return http_handler
 
@@ -366,17 +481,40 @@ class OpenMetricsScraperMixin(object):
     def parse_metric_family(self, response, scraper_config):
         """
         Parse the MetricFamily from a valid requests.Response object to provide a MetricFamily object (see [0])
-        The text format uses iter_lines() generator.
+        The text format uses iter_lines() generator, or iter_content() when parsing as bytes.
+        The protobuf format, when negotiated, decodes the messages streamed by iter_content().
         :param response: requests.Response
         :return: core.Metric
         """
-        if response.encoding is None:
-            response.encoding = 'utf-8'
-        input_gen = response.iter_lines(chunk_size=self.REQUESTS_CHUNK_SIZE, decode_unicode=True)
-        if scraper_config['_text_filter_blacklist']:
-            input_gen = self._text_filter_input(input_gen, scraper_config)
+        prefetched = scraper_config['_prefetched_families']
+        prefetch_timings = None
+        if prefetched is not None:
+            scraper_config['_prefetched_families'] = None
+            metric_families, exc_info, prefetch_timings = prefetched
+            if exc_info is not None:
+                reraise(*exc_info)
+        else:
+            metric_families = self._metric_families(response, scraper_config)
+
+        timings = scraper_config['_telemetry_timings']
+        parse_times = None
+        if timings is not None:
+            families = scraper_config['_telemetry_families']
+            if prefetch_timings is not None:
+                # The payload was downloaded and parsed by a worker thread, see `_prefetch`
+                phase_timings, parse_times = prefetch_timings
+                for phase, duration in iteritems(phase_timings):
+                    timings[phase] += duration
+                parse_times = iter(parse_times)
+            last = default_timer()
+
+        for metric in metric_families:
+            if timings is not None:
+                now = default_timer()
+                parse_time = now - last if parse_times is None else next(parse_times)
+                timings[self.TELEMETRY_HISTOGRAM_PARSE_TIME] += parse_time
+                last = now
 
-        for metric in text_fd_to_metric_families(input_gen):
             self._send_telemetry_counter(
                 self.TELEMETRY_COUNTER_METRICS_INPUT_COUNT, len(metric.samples), scraper_config
             )
@@ -384,7 +522,50 @@ class OpenMetricsScraperMixin(object):
             if metric.type not in self.METRIC_TYPES:
                 continue
             metric.name = self._remove_metric_prefix(metric.name, scraper_config)
-            yield metric
+
+            if timings is not None:
+                families[metric.name] = [len(metric.samples), parse_time]
+                yield metric
+                # Leave out the time spent by the consumer
+                last = default_timer()
+            else:
+                yield metric
+
+        if timings is not None and parse_times is None:
+            timings[self.TELEMETRY_HISTOGRAM_PARSE_TIME] += default_timer() - last
+
+    def _metric_families(self, response, scraper_config):
+        family_filter = None
+        if scraper_config['skip_unwanted_families']:
+            family_filter = partial(self._is_family_wanted, scraper_config=scraper_config)
+
+        if scraper_config['prefer_protobuf'] and self.PROTOBUF_CONTENT_TYPE in response.headers.get('Content-Type', ''):
+            return protobuf_to_metric_families(
+                response.iter_content(chunk_size=self.REQUESTS_CHUNK_SIZE), family_filter=family_filter
+            )
+        elif scraper_config['parse_as_bytes'] and not scraper_config['_text_filter_blacklist']:
+            return bytes_to_metric_families(self._read_payload(response, scraper_config), family_filter=family_filter)
+
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        input_gen = response.iter_lines(chunk_size=self.REQUESTS_CHUNK_SIZE, decode_unicode=True)
+        if scraper_config['_text_filter_blacklist']:
+            input_gen = self._text_filter_input(input_gen, scraper_config)
+
+        return text_fd_to_metric_families(input_gen, family_filter=family_filter)
+
+    def _read_payload(self, response, scraper_config):
+        """
+        Read the whole payload into the buffer of the scraper config, without decoding it
+        :param response: requests.Response
+        :return: bytearray
+        """
+        buf = scraper_config['_payload_buffer']
+        del buf[:]
+        for chunk in response.iter_content(chunk_size=self.REQUESTS_CHUNK_SIZE):
+            buf += chunk
+
+        return buf
 
     def _text_filter_input(self, input_gen, scraper_config):
         """
@@ -397,12 +578,45 @@ class OpenMetricsScraperMixin(object):
         for line in input_gen:
             for item in scraper_config['_text_filter_blacklist']:
                 if item in line:
-                    self._send_telemetry_counter(self.TELEMETRY_COUNTER_METRICS_BLACKLIST_COUNT, 1, scraper_config)
+                    scraper_config['_text_filter_blacklist_count'] += 1
                     break
             else:
                 # No blacklist matches, passing the line through
                 yield line
 
+    def _is_family_wanted(self, name, typ, scraper_config):
+        """
+        Decide, from the family name and type found in the payload, whether `process_metric`
+        would make any use of the family. Decisions are cached on the scraper config.
+        """
+        key = (name, typ)
+        wanted = scraper_config['_wanted_families'].get(key)
+        if wanted is None:
+            wanted = scraper_config['_wanted_families'][key] = self._compute_family_wanted(name, typ, scraper_config)
+
+        return wanted
+
+    def _compute_family_wanted(self, name, typ, scraper_config):
+        if scraper_config['type_overrides'].get(name, typ) not in self.METRIC_TYPES:
+            return False
+
+        name = self._remove_metric_prefix(name, scraper_config)
+
+        # Labels of targeted metrics are stored before the metric is ignored
+        if name in scraper_config['label_joins']:
+            return True
+
+        if name in scraper_config['_ignored_metrics']:
+            return False
+
+        if scraper_config['_ignored_re'] and scraper_config['_ignored_re'].search(name):
+            return False
+
+        if name in scraper_config['metrics_mapper'] or name in scraper_config['_metric_transformers']:
+            return True
+
+        return bool(scraper_config['_wildcards_re'] and scraper_config['_wildcards_re'].search(name))
+
     def _remove_metric_prefix(self, metric, scraper_config):
         prometheus_metrics_prefix = scraper_config['prometheus_metrics_prefix']
         return metric[len(prometheus_metrics_prefix) :] if metric.startswith(prometheus_metrics_prefix) else metric
@@ -411,7 +625,20 @@ class OpenMetricsScraperMixin(object):
         """
         Poll the data from prometheus and return the metrics as a generator.
         """
+        timings = scraper_config['_telemetry_timings']
+        if timings is not None:
+            start = default_timer()
+
         response = self.poll(scraper_config)
+        if timings is not None:
+            # Download the whole payload so that the parsing is timed separately
+            response.content
+            timings[self.TELEMETRY_HISTOGRAM_HTTP_WAIT_TIME] += default_timer() - start
+
+            elapsed = getattr(response, 'elapsed', None)
+            if elapsed is not None:
+                timings[self.TELEMETRY_HISTOGRAM_FIRST_BYTE_TIME] = elapsed.total_seconds()
+
         if scraper_config['telemetry']:
             if 'content-length' in response.headers:
                 content_len = int(response.headers['content-length'])
@@ -419,46 +646,48 @@ class OpenMetricsScraperMixin(object):
                 content_len = len(response.content)
             self._send_telemetry_gauge(self.TELEMETRY_GAUGE_MESSAGE_SIZE, content_len, scraper_config)
         try:
+            label_join_index = self._get_label_join_index(scraper_config)
+
             # no dry run if no label joins
-            if not scraper_config['label_joins']:
+            if label_join_index is None:
                 scraper_config['_dry_run'] = False
-            elif not scraper_config['_watched_labels']:
-                watched = scraper_config['_watched_labels']
-                watched['sets'] = {}
-                watched['keys'] = {}
-                watched['singles'] = set()
-                for key, val in iteritems(scraper_config['label_joins']):
-                    labels = []
-                    if 'labels_to_match' in val:
-                        labels = val['labels_to_match']
-                    elif 'label_to_match' in val:
-                        self.log.warning("`label_to_match` is being deprecated, please use `labels_to_match`")
-                        if isinstance(val['label_to_match'], list):
-                            labels = val['label_to_match']
-                        else:
-                            labels = [val['label_to_match']]
-
-                    if labels:
-                        s = frozenset(labels)
-                        watched['sets'][key] = s
-                        watched['keys'][key] = ','.join(s)
-                        if len(labels) == 1:
-                            watched['singles'].add(labels[0])
-
-            for metric in self.parse_metric_family(response, scraper_config):
-                yield metric
+
+            if scraper_config['_dry_run'] and not scraper_config['label_joins_dry_run']:
+                # Process the metrics that may need labels from the others once all of them were seen
+                scraper_config['_dry_run'] = False
+                deferred = []
+                for metric in self.parse_metric_family(response, scraper_config):
+                    if label_join_index.needs_join(metric):
+                        deferred.append(metric)
+                    else:
+                        yield metric
+
+                for metric in deferred:
+                    yield metric
+            else:
+                for metric in self.parse_metric_family(response, scraper_config):
+                    yield metric
 
             # Set dry run off
             scraper_config['_dry_run'] = False
-            # Garbage collect unused mapping and reset active labels
-            for metric, mapping in list(iteritems(scraper_config['_label_mapping'])):
-                for key in list(mapping):
-                    if key not in scraper_config['_active_label_mapping'][metric]:
-                        del scraper_config['_label_mapping'][metric][key]
-            scraper_config['_active_label_mapping'] = {}
+            # Drop the labels that were not used during the last two runs
+            if label_join_index is not None:
+                label_join_index.expire()
         finally:
             response.close()
 
+    def _get_label_join_index(self, scraper_config):
+        if not scraper_config['label_joins']:
+            return None
+
+        label_join_index = scraper_config['_label_join_index']
+        if label_join_index is None:
+            label_join_index = scraper_config['_label_join_index'] = LabelJoinIndex(
+                scraper_config['label_joins'], self.log
+            )
+
+        return label_join_index
+
     def process(self, scraper_config, metric_transformers=None):
         """
         Polls the data from prometheus and pushes them as gauges
@@ -467,12 +696,261 @@ class OpenMetricsScraperMixin(object):
         Note that if the instance has a 'tags' attribute, it will be pushed
         automatically as additional custom tags and added to the metrics
         """
+        transformers = self._update_metric_transformers(scraper_config, metric_transformers)
+
+        try:
+            if scraper_config['telemetry']:
+                self._process_with_telemetry(scraper_config, transformers)
+            else:
+                for metric in self.scrape_metrics(scraper_config):
+                    self.process_metric(metric, scraper_config, metric_transformers=transformers)
+        finally:
+            blacklist_count = scraper_config['_text_filter_blacklist_count']
+            if blacklist_count:
+                scraper_config['_text_filter_blacklist_count'] = 0
+                self._send_telemetry_counter(
+                    self.TELEMETRY_COUNTER_METRICS_BLACKLIST_COUNT, blacklist_count, scraper_config
+                )
+
+        if scraper_config['_tags_cache'] is not None:
+            self._send_tags_cache_telemetry(scraper_config)
+
+    def _process_with_telemetry(self, scraper_config, metric_transformers):
+        """
+        Same as `process`, timing each phase of the scrape and each metric family
+        """
+        timings = scraper_config['_telemetry_timings'] = {
+            self.TELEMETRY_HISTOGRAM_HTTP_WAIT_TIME: 0.0,
+            self.TELEMETRY_HISTOGRAM_FIRST_BYTE_TIME: None,
+            self.TELEMETRY_HISTOGRAM_PARSE_TIME: 0.0,
+            self.TELEMETRY_HISTOGRAM_LABEL_JOIN_TIME: 0.0,
+            self.TELEMETRY_HISTOGRAM_FILTER_TIME: 0.0,
+            self.TELEMETRY_HISTOGRAM_SUBMIT_TIME: 0.0,
+        }
+        families = scraper_config['_telemetry_families'] = {}
+
+        try:
+            for metric in self.scrape_metrics(scraper_config):
+                family = families.setdefault(metric.name, [len(metric.samples), 0.0])
+                start = default_timer()
+                self.process_metric(metric, scraper_config, metric_transformers=metric_transformers)
+                family[1] += default_timer() - start
+
+            for phase, duration in iteritems(timings):
+                if duration is not None:
+                    self._send_telemetry_histogram(phase, duration, scraper_config)
+
+            # Only the slowest families are reported to bound the number of contexts
+            top_families = sorted(iteritems(families), key=lambda family: family[1][1], reverse=True)
+            for name, (samples, duration) in top_families[: scraper_config['telemetry_top_families']]:
+                tags = ['metric_family:' + name]
+                self._send_telemetry_gauge(
+                    self.TELEMETRY_GAUGE_FAMILY_SAMPLES, samples, scraper_config, extra_tags=tags
+                )
+                self._send_telemetry_gauge(self.TELEMETRY_GAUGE_FAMILY_TIME, duration, scraper_config, extra_tags=tags)
+        finally:
+            scraper_config['_telemetry_timings'] = None
+            scraper_config['_telemetry_families'] = None
+
+    def _telemetry_timer(self, phase, scraper_config):
+        timings = scraper_config['_telemetry_timings']
+        if timings is None:
+            return NO_TIMER
+
+        return _PhaseTimer(timings, phase)
+
+    def process_all(self, scraper_configs, metric_transformers=None):
+        """
+        Process several scraper configurations, see `process`.
+
+        When the `concurrent_scrapes` option is greater than 1, that many payloads are fetched and parsed
+        at the same time by the `task_executor` of the check, so the run lasts as long as the slowest
+        endpoint rather than the sum of all of them. `concurrent_scrapes` sets the quota of the task
+        executor, unless `max_concurrent_tasks` is configured. Everything is still submitted from the
+        calling thread, one scraper configuration after the other, and the first error is raised once
+        all the scraper configurations have been processed.
+
+        Worker threads request the endpoints with `send_request`, so headers must be set on the
+        http handler rather than passed by an overridden `poll`. They work on a copy of the scraper
+        configuration, see `_worker_scraper_config`. An endpoint whose previous scrape timed out
+        and is still running is not scraped again until that scrape is over.
+        """
+        executor = self._get_scrape_executor() if len(scraper_configs) > 1 else None
+        if executor is None:
+            for scraper_config in scraper_configs:
+                self.process(scraper_config, metric_transformers=metric_transformers)
+            return
+
+        scrapes = []
+        for scraper_config in scraper_configs:
+            # The parsing done by the workers depends on the transformers and on the http handler,
+            # make sure they are set up from this thread beforehand
+            self._update_metric_transformers(scraper_config, metric_transformers)
+            self.get_http_handler(scraper_config)
+
+            previous = scraper_config['_prefetch_future']
+            if previous is not None and not previous.done():
+                scrapes.append((scraper_config, None, None, None))
+                continue
+
+            # The timeout of each endpoint runs from the submission of its scrape,
+            # not from the time the previous endpoints have been processed
+            deadline = None
+            if scraper_config['scrape_timeout'] is not None:
+                deadline = default_timer() + scraper_config['scrape_timeout']
+
+            worker_config = self._worker_scraper_config(scraper_config)
+            future = scraper_config['_prefetch_future'] = executor.submit(self._prefetch, worker_config)
+            scrapes.append((scraper_config, worker_config, future, deadline))
+
+        exc_info = None
+        for scraper_config, worker_config, future, deadline in scrapes:
+            if future is None:
+                scraper_config['_prefetched_response'] = self._timeout_exc_info(
+                    scraper_config, 'Previous scrape of endpoint {} is still running'
+                )
+            else:
+                try:
+                    timeout = None if deadline is None else max(0, deadline - default_timer())
+                    response, families = future.result(timeout=timeout)
+                except futures.TimeoutError:
+                    # Scrapes that did not start yet are dropped, the others release their response once done
+                    if not future.cancel():
+                        future.add_done_callback(self._close_prefetched_response)
+                    scraper_config['_prefetched_response'] = self._timeout_exc_info(scraper_config)
+                else:
+                    scraper_config['_prefetch_future'] = None
+                    scraper_config['_prefetched_response'] = response
+                    scraper_config['_prefetched_families'] = families
+                    scraper_config['_wanted_families'].update(worker_config['_wanted_families'])
+                    scraper_config['_text_filter_blacklist_count'] += worker_config['_text_filter_blacklist_count']
+
+            try:
+                self.process(scraper_config, metric_transformers=metric_transformers)
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+                self.log.debug('Error processing endpoint %s', scraper_config['prometheus_url'], exc_info=True)
+            finally:
+                response = scraper_config['_prefetched_response']
+                if isinstance(response, requests.Response):
+                    response.close()
+                scraper_config['_prefetched_response'] = None
+                scraper_config['_prefetched_families'] = None
+
+        if exc_info is not None:
+            reraise(*exc_info)
+
+    def _get_scrape_executor(self):
+        if self._scrape_executor is None:
+            concurrent_scrapes = (self.init_config or {}).get('concurrent_scrapes', 1)
+            if self.instance is not None:
+                concurrent_scrapes = self.instance.get('concurrent_scrapes', concurrent_scrapes)
+
+            try:
+                concurrent_scrapes = int(concurrent_scrapes)
+            except (ValueError, TypeError):
+                self.warning(
+                    "Configured 'concurrent_scrapes' cannot be interpreted as an integer: %s. Scraping serially.",
+                    concurrent_scrapes,
+                )
+                concurrent_scrapes = 1
+
+            if concurrent_scrapes > 1:
+                # Scrapes run on the thread pool shared by all checks rather than on threads of their own
+                task_executor = self._scrape_executor = self.task_executor
+                # The quota of the tasks of the check is the number of concurrent scrapes, unless it is configured
+                if not any(
+                    'max_concurrent_tasks' in config for config in (self.instance or {}, self.init_config or {})
+                ):
+                    task_executor.max_concurrency = concurrent_scrapes
+            else:
+                self._scrape_executor = False
+
+        return self._scrape_executor or None
+
+    @staticmethod
+    def _worker_scraper_config(scraper_config):
+        """
+        Shallow copy of a scraper configuration for a worker thread, with its own payload buffer, cache
+        of wanted families and counters: a scrape that outlives its run must not share them with the next one.
+        """
+        worker_config = scraper_config.copy()
+        worker_config['_payload_buffer'] = bytearray()
+        worker_config['_wanted_families'] = scraper_config['_wanted_families'].copy()
+        worker_config['_text_filter_blacklist_count'] = 0
+        return worker_config
+
+    def _prefetch(self, scraper_config):
+        """
+        Runs in a worker thread: request the endpoint, download and parse the payload without
+        submitting anything. Errors are returned to be raised again from the calling thread.
+
+        With telemetry, the time spent waiting for the payload and parsing it is measured here
+        and returned with the families, along with the parse time of each family.
+        """
+        telemetry = scraper_config['telemetry']
+        if telemetry:
+            start = default_timer()
+
+        try:
+            response = self.send_request(scraper_config['prometheus_url'], scraper_config)
+        except Exception:
+            return sys.exc_info(), None
+
+        if not response.ok:
+            return response, None
+
+        try:
+            # Download the whole payload here, the telemetry may need its size afterwards
+            response.content
+            if not telemetry:
+                return response, (list(self._metric_families(response, scraper_config)), None, None)
+
+            last = default_timer()
+            phase_timings = {self.TELEMETRY_HISTOGRAM_HTTP_WAIT_TIME: last - start}
+            families = []
+            parse_times = []
+            for metric in self._metric_families(response, scraper_config):
+                now = default_timer()
+                families.append(metric)
+                parse_times.append(now - last)
+                last = now
+            phase_timings[self.TELEMETRY_HISTOGRAM_PARSE_TIME] = default_timer() - last
+        except Exception:
+            return response, ([], sys.exc_info(), None)
+
+        return response, (families, None, (phase_timings, parse_times))
+
+    @staticmethod
+    def _close_prefetched_response(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        response = future.result()[0]
+        if isinstance(response, requests.Response):
+            response.close()
+
+    @staticmethod
+    def _timeout_exc_info(scraper_config, message='Endpoint {} was not scraped within {} seconds'):
+        try:
+            raise requests.exceptions.Timeout(
+                message.format(scraper_config['prometheus_url'], scraper_config['scrape_timeout'])
+            )
+        except requests.exceptions.Timeout:
+            return sys.exc_info()
+
+    def _update_metric_transformers(self, scraper_config, metric_transformers=None):
         transformers = scraper_config['_default_metric_transformers'].copy()
         if metric_transformers:
             transformers.update(metric_transformers)
 
-        for metric in self.scrape_metrics(scraper_config):
-            self.process_metric(metric, scraper_config, metric_transformers=transformers)
+        transformer_names = frozenset(transformers)
+        if transformer_names != scraper_config['_metric_transformers']:
+            scraper_config['_metric_transformers'] = transformer_names
+            scraper_config['_wanted_families'].clear()
+
+        return transformers
 
     def transform_metadata(self, metric, scraper_config):
         labels = metric.samples[0][self.SAMPLE_LABELS]
@@ -483,13 +961,15 @@ class OpenMetricsScraperMixin(object):
     def _telemetry_metric_name_with_namespace(self, metric_name, scraper_config):
         return '{}.{}.{}'.format(scraper_config['namespace'], 'telemetry', metric_name)
 
-    def _send_telemetry_gauge(self, metric_name, val, scraper_config):
+    def _send_telemetry_gauge(self, metric_name, val, scraper_config, extra_tags=None):
         if scraper_config['telemetry']:
             metric_name_with_namespace = self._telemetry_metric_name_with_namespace(metric_name, scraper_config)
             # Determine the tags to send
             custom_tags = scraper_config['custom_tags']
             tags = list(custom_tags)
             tags.extend(scraper_config['_metric_tags'])
+            if extra_tags:
+                tags.extend(extra_tags)
             self.gauge(metric_name_with_namespace, val, tags=tags)
 
     def _send_telemetry_counter(self, metric_name, val, scraper_config, extra_tags=None):
@@ -503,90 +983,26 @@ class OpenMetricsScraperMixin(object):
                 tags.extend(extra_tags)
             self.count(metric_name_with_namespace, val, tags=tags)
 
+    def _send_telemetry_histogram(self, metric_name, val, scraper_config):
+        if scraper_config['telemetry']:
+            metric_name_with_namespace = self._telemetry_metric_name_with_namespace(metric_name, scraper_config)
+            # Determine the tags to send
+            custom_tags = scraper_config['custom_tags']
+            tags = list(custom_tags)
+            tags.extend(scraper_config['_metric_tags'])
+            self.histogram(metric_name_with_namespace, val, tags=tags)
+
     def _store_labels(self, metric, scraper_config):
         # If targeted metric, store labels
-        if metric.name not in scraper_config['label_joins']:
-            return
-
-        watched = scraper_config['_watched_labels']
-        matching_labels = watched['sets'][metric.name]
-        mapping_key = watched['keys'][metric.name]
-
-        labels_to_get = scraper_config['label_joins'][metric.name]['labels_to_get']
-        get_all = '*' in labels_to_get
-        for sample in metric.samples:
-            # metadata-only metrics that are used for label joins are always equal to 1
-            # this is required for metrics where all combinations of a state are sent
-            # but only the active one is set to 1 (others are set to 0)
-            # example: kube_pod_status_phase in kube-state-metrics
-            if sample[self.SAMPLE_VALUE] != 1:
-                continue
-
-            sample_labels = sample[self.SAMPLE_LABELS]
-            sample_labels_keys = sample_labels.keys()
-
-            if matching_labels.issubset(sample_labels_keys):
-                label_dict = dict()
-
-                if get_all:
-                    for label_name, label_value in iteritems(sample_labels):
-                        if label_name in matching_labels:
-                            continue
-                        label_dict[label_name] = label_value
-                else:
-                    for label_name in labels_to_get:
-                        if label_name in sample_labels:
-                            label_dict[label_name] = sample_labels[label_name]
-
-                mapping_value = ','.join([sample_labels[l] for l in matching_labels])
-
-                scraper_config['_label_mapping'].setdefault(mapping_key, {}).setdefault(mapping_value, {}).update(
-                    label_dict
-                )
+        label_join_index = self._get_label_join_index(scraper_config)
+        if label_join_index is not None:
+            label_join_index.store(metric)
 
     def _join_labels(self, metric, scraper_config):
         # Filter metric to see if we can enrich with joined labels
-        if not scraper_config['label_joins']:
-            return
-
-        label_mapping = scraper_config['_label_mapping']
-        active_label_mapping = scraper_config['_active_label_mapping']
-
-        watched = scraper_config['_watched_labels']
-        sets = watched['sets']
-        keys = watched['keys']
-        singles = watched['singles']
-
-        for sample in metric.samples:
-            sample_labels = sample[self.SAMPLE_LABELS]
-            sample_labels_keys = sample_labels.keys()
-
-            # Match with single labels
-            matching_single_labels = singles.intersection(sample_labels_keys)
-            for label in matching_single_labels:
-                mapping_key = label
-                mapping_value = sample_labels[label]
-
-                active_label_mapping.setdefault(mapping_key, {})[mapping_value] = True
-
-                if mapping_key in label_mapping and mapping_value in label_mapping[mapping_key]:
-                    sample_labels.update(label_mapping[mapping_key][mapping_value])
-
-            # Match with tuples of labels
-            for key, mapping_key in iteritems(keys):
-                if mapping_key in matching_single_labels:
-                    continue
-
-                matching_labels = sets[key]
-
-                if matching_labels.issubset(sample_labels_keys):
-                    matching_values = [sample_labels[l] for l in matching_labels]
-                    mapping_value = ','.join(matching_values)
-
-                    active_label_mapping.setdefault(mapping_key, {})[mapping_value] = True
-
-                    if mapping_key in label_mapping and mapping_value in label_mapping[mapping_key]:
-                        sample_labels.update(label_mapping[mapping_key][mapping_value])
+        label_join_index = self._get_label_join_index(scraper_config)
+        if label_join_index is not None:
+            label_join_index.join(metric)
 
     def process_metric(self, metric, scraper_config, metric_transformers=None):
         """
@@ -598,57 +1014,63 @@ class OpenMetricsScraperMixin(object):
         `metric_transformers` is a dict of <metric name>:<function to run when the metric name is encountered>
         """
         # If targeted metric, store labels
-        self._store_labels(metric, scraper_config)
-
-        if scraper_config['ignore_metrics']:
-            if metric.name in scraper_config['_ignored_metrics']:
-                self._send_telemetry_counter(
-                    self.TELEMETRY_COUNTER_METRICS_IGNORE_COUNT, len(metric.samples), scraper_config
-                )
-                return  # Ignore the metric
+        with self._telemetry_timer(self.TELEMETRY_HISTOGRAM_LABEL_JOIN_TIME, scraper_config):
+            self._store_labels(metric, scraper_config)
+
+        with self._telemetry_timer(self.TELEMETRY_HISTOGRAM_FILTER_TIME, scraper_config):
+            if scraper_config['ignore_metrics']:
+                if metric.name in scraper_config['_ignored_metrics']:
+                    self._send_telemetry_counter(
+                        self.TELEMETRY_COUNTER_METRICS_IGNORE_COUNT, len(metric.samples), scraper_config
+                    )
+                    return  # Ignore the metric
 
-            if scraper_config['_ignored_re'] and scraper_config['_ignored_re'].search(metric.name):
-                # Metric must be ignored
-                scraper_config['_ignored_metrics'].add(metric.name)
-                self._send_telemetry_counter(
-                    self.TELEMETRY_COUNTER_METRICS_IGNORE_COUNT, len(metric.samples), scraper_config
-                )
-                return  # Ignore the metric
+                if scraper_config['_ignored_re'] and scraper_config['_ignored_re'].search(metric.name):
+                    # Metric must be ignored
+                    scraper_config['_ignored_metrics'].add(metric.name)
+                    self._send_telemetry_counter(
+                        self.TELEMETRY_COUNTER_METRICS_IGNORE_COUNT, len(metric.samples), scraper_config
+                    )
+                    return  # Ignore the metric
 
-        self._send_telemetry_counter(self.TELEMETRY_COUNTER_METRICS_PROCESS_COUNT, len(metric.samples), scraper_config)
+            self._send_telemetry_counter(
+                self.TELEMETRY_COUNTER_METRICS_PROCESS_COUNT, len(metric.samples), scraper_config
+            )
 
-        if self._filter_metric(metric, scraper_config):
-            return  # Ignore the metric
+            if self._filter_metric(metric, scraper_config):
+                return  # Ignore the metric
 
         # Filter metric to see if we can enrich with joined labels
-        self._join_labels(metric, scraper_config)
+        with self._telemetry_timer(self.TELEMETRY_HISTOGRAM_LABEL_JOIN_TIME, scraper_config):
+            self._join_labels(metric, scraper_config)
 
         if scraper_config['_dry_run']:
             return
 
-        try:
-            self.submit_openmetric(scraper_config['metrics_mapper'][metric.name], metric, scraper_config)
-        except KeyError:
-            if metric_transformers is not None and metric.name in metric_transformers:
-                try:
-                    # Get the transformer function for this specific metric
-                    transformer = metric_transformers[metric.name]
-                    transformer(metric, scraper_config)
-                except Exception as err:
-                    self.log.warning('Error handling metric: %s - error: %s', metric.name, err)
-
-                return
-
-            # try matching wildcards
-            if scraper_config['_wildcards_re'] and scraper_config['_wildcards_re'].search(metric.name):
-                self.submit_openmetric(metric.name, metric, scraper_config)
-                return
-
-            self.log.debug(
-                'Skipping metric `%s` as it is not defined in the metrics mapper, '
-                'has no transformer function, nor does it match any wildcards.',
-                metric.name,
-            )
+        with self._telemetry_timer(self.TELEMETRY_HISTOGRAM_SUBMIT_TIME, scraper_config):
+            try:
+                self.submit_openmetric(scraper_config['metrics_mapper'][metric.name], metric, scraper_config)
+            except KeyError:
+                if metric_transformers is not None and metric.name in metric_transformers:
+                    try:
+                        # Get the transformer function for this specific metric
+                        transformer = metric_transformers[metric.name]
+                        transformer(metric, scraper_config)
+                    except Exception as err:
+                        self.log.warning('Error handling metric: %s - error: %s', metric.name, err)
+
+                    return
+
+                # try matching wildcards
+                if scraper_config['_wildcards_re'] and scraper_config['_wildcards_re'].search(metric.name):
+                    self.submit_openmetric(metric.name, metric, scraper_config)
+                    return
+
+                self.log.debug(
+                    'Skipping metric `%s` as it is not defined in the metrics mapper, '
+                    'has no transformer function, nor does it match any wildcards.',
+                    metric.name,
+                )
 
     def poll(self, scraper_config, headers=None):
         """
@@ -692,10 +1114,21 @@ class OpenMetricsScraperMixin(object):
             raise
 
     def send_request(self, endpoint, scraper_config, headers=None):
+        prefetched = scraper_config['_prefetched_response']
+        if prefetched is not None:
+            scraper_config['_prefetched_response'] = None
+            if isinstance(prefetched, tuple):
+                reraise(*prefetched)
+            return prefetched
+
         kwargs = {}
         if headers:
             kwargs['headers'] = headers
 
+        # The text filter blacklist works on the lines of the text format, so there is no point asking for protobuf
+        if scraper_config['prefer_protobuf'] and scraper_config['_text_filter_blacklist']:
+            kwargs['extra_headers'] = {'accept': 'text/plain'}
+
         http_handler = self.get_http_handler(scraper_config)
 
         return http_handler.get(endpoint, stream=True, **kwargs)
@@ -801,7 +1234,7 @@ class OpenMetricsScraperMixin(object):
         Extracts metrics from a prometheus histogram and sends them as gauges
         """
         if scraper_config['non_cumulative_buckets']:
-            self._decumulate_histogram_buckets(metric)
+            self._decumulate_histogram_buckets(metric, scraper_config)
         for sample in metric.samples:
             val = sample[self.SAMPLE_VALUE]
             if not self._is_value_valid(val):
@@ -847,68 +1280,72 @@ class OpenMetricsScraperMixin(object):
         # hence we remove the "le" tag
         return hash(frozenset(sorted((k, v) for k, v in iteritems(tags) if k != 'le')))
 
-    def _decumulate_histogram_buckets(self, metric):
+    def _decumulate_histogram_buckets(self, metric, scraper_config=None):
         """
         Decumulate buckets in a given histogram metric and adds the lower_bound label (le being upper_bound)
-        """
-        bucket_values_by_context_upper_bound = {}
-        for sample in metric.samples:
-            if sample[self.SAMPLE_NAME].endswith("_bucket"):
-                context_key = self._compute_bucket_hash(sample[self.SAMPLE_LABELS])
-                if context_key not in bucket_values_by_context_upper_bound:
-                    bucket_values_by_context_upper_bound[context_key] = {}
-                bucket_values_by_context_upper_bound[context_key][float(sample[self.SAMPLE_LABELS]["le"])] = sample[
-                    self.SAMPLE_VALUE
-                ]
-
-        sorted_buckets_by_context = {}
-        for context in bucket_values_by_context_upper_bound:
-            sorted_buckets_by_context[context] = sorted(bucket_values_by_context_upper_bound[context])
-
-        # Tuples (lower_bound, upper_bound, value)
-        bucket_tuples_by_context_upper_bound = {}
-        for context in sorted_buckets_by_context:
-            for i, upper_b in enumerate(sorted_buckets_by_context[context]):
-                if i == 0:
-                    if context not in bucket_tuples_by_context_upper_bound:
-                        bucket_tuples_by_context_upper_bound[context] = {}
-                    if upper_b > 0:
-                        # positive buckets start at zero
-                        bucket_tuples_by_context_upper_bound[context][upper_b] = (
-                            0,
-                            upper_b,
-                            bucket_values_by_context_upper_bound[context][upper_b],
-                        )
-                    else:
-                        # negative buckets start at -inf
-                        bucket_tuples_by_context_upper_bound[context][upper_b] = (
-                            self.MINUS_INF,
-                            upper_b,
-                            bucket_values_by_context_upper_bound[context][upper_b],
-                        )
-                    continue
-                tmp = (
-                    bucket_values_by_context_upper_bound[context][upper_b]
-                    - bucket_values_by_context_upper_bound[context][sorted_buckets_by_context[context][i - 1]]
-                )
-                bucket_tuples_by_context_upper_bound[context][upper_b] = (
-                    sorted_buckets_by_context[context][i - 1],
-                    upper_b,
-                    tmp,
-                )
 
-        # modify original metric to inject lower_bound & modified value
+        Buckets are grouped by context in a single pass. As all the contexts of a histogram usually share
+        the same buckets, the parsed and sorted bucket boundaries are cached per histogram family on the
+        scraper config, keyed by the `le` values of the context.
+        """
+        # context -> ([sample indexes], [le values], [cumulative counts])
+        buckets_by_context = {}
         for i, sample in enumerate(metric.samples):
             if not sample[self.SAMPLE_NAME].endswith("_bucket"):
                 continue
 
-            context_key = self._compute_bucket_hash(sample[self.SAMPLE_LABELS])
-            matching_bucket_tuple = bucket_tuples_by_context_upper_bound[context_key][
-                float(sample[self.SAMPLE_LABELS]["le"])
-            ]
-            # Replacing the sample tuple
-            sample[self.SAMPLE_LABELS]["lower_bound"] = str(matching_bucket_tuple[0])
-            metric.samples[i] = Sample(sample[self.SAMPLE_NAME], sample[self.SAMPLE_LABELS], matching_bucket_tuple[2])
+            labels = sample[self.SAMPLE_LABELS]
+            context = frozenset(item for item in iteritems(labels) if item[0] != 'le')
+            buckets = buckets_by_context.get(context)
+            if buckets is None:
+                buckets = buckets_by_context[context] = ([], [], [])
+            buckets[0].append(i)
+            buckets[1].append(labels["le"])
+            buckets[2].append(sample[self.SAMPLE_VALUE])
+
+        if not buckets_by_context:
+            return
+
+        if scraper_config is None:
+            bucket_bounds = {}
+        else:
+            bucket_bounds = scraper_config['_bucket_bounds'].setdefault(metric.name, {})
+
+        samples = metric.samples
+        for indexes, upper_bounds, values in itervalues(buckets_by_context):
+            upper_bounds = tuple(upper_bounds)
+            bounds = bucket_bounds.get(upper_bounds)
+            if bounds is None:
+                bounds = bucket_bounds[upper_bounds] = self._compute_bucket_bounds(upper_bounds)
+
+            # Tuples (position, lower_bound) sorted by upper bound
+            previous_value = None
+            for position, lower_bound in bounds:
+                value = values[position]
+                sample = samples[indexes[position]]
+                sample[self.SAMPLE_LABELS]["lower_bound"] = lower_bound
+                # Replacing the sample tuple
+                samples[indexes[position]] = Sample(
+                    sample[self.SAMPLE_NAME],
+                    sample[self.SAMPLE_LABELS],
+                    value if previous_value is None else value - previous_value,
+                )
+                previous_value = value
+
+    def _compute_bucket_bounds(self, upper_bounds):
+        """
+        Sort the buckets of a context by upper bound, returns their positions with their lower bound
+        """
+        parsed_upper_bounds = [float(upper_bound) for upper_bound in upper_bounds]
+        positions = sorted(range(len(parsed_upper_bounds)), key=parsed_upper_bounds.__getitem__)
+
+        first_upper_bound = parsed_upper_bounds[positions[0]]
+        # positive buckets start at zero, negative buckets start at -inf
+        bounds = [(positions[0], str(0 if first_upper_bound > 0 else self.MINUS_INF))]
+        for previous_position, position in zip(positions, positions[1:]):
+            bounds.append((position, str(parsed_upper_bounds[previous_position])))
+
+        return tuple(bounds)
 
     def _submit_sample_histogram_buckets(self, metric_name, sample, scraper_config, hostname=None):
         if "lower_bound" not in sample[self.SAMPLE_LABELS] or "le" not in sample[self.SAMPLE_LABELS]:
@@ -947,14 +1384,40 @@ class OpenMetricsScraperMixin(object):
         custom_tags = scraper_config['custom_tags']
         _tags = list(custom_tags)
         _tags.extend(scraper_config['_metric_tags'])
-        for label_name, label_value in iteritems(sample[self.SAMPLE_LABELS]):
-            if label_name not in scraper_config['exclude_labels']:
-                tag_name = scraper_config['labels_mapper'].get(label_name, label_name)
-                _tags.append('{}:{}'.format(to_native_string(tag_name), to_native_string(label_value)))
+
+        tags_cache = scraper_config['_tags_cache']
+        if tags_cache is None:
+            _tags.extend(self._label_tags(sample[self.SAMPLE_LABELS], scraper_config))
+        else:
+            cache_key = frozenset(iteritems(sample[self.SAMPLE_LABELS]))
+            label_tags = tags_cache.get(cache_key)
+            if label_tags is None:
+                label_tags = tuple(self._label_tags(sample[self.SAMPLE_LABELS], scraper_config))
+                tags_cache.set(cache_key, label_tags)
+            _tags.extend(label_tags)
+
         return self._finalize_tags_to_submit(
             _tags, metric_name, val, sample, custom_tags=custom_tags, hostname=hostname
         )
 
+    def _label_tags(self, labels, scraper_config):
+        tags = []
+        for label_name, label_value in iteritems(labels):
+            if label_name not in scraper_config['exclude_labels']:
+                tag_name = scraper_config['labels_mapper'].get(label_name, label_name)
+                tags.append('{}:{}'.format(to_native_string(tag_name), to_native_string(label_value)))
+        return tags
+
+    def _send_tags_cache_telemetry(self, scraper_config):
+        tags_cache = scraper_config['_tags_cache']
+        self._send_telemetry_counter(self.TELEMETRY_COUNTER_TAGS_CACHE_HIT_COUNT, tags_cache.hits, scraper_config)
+        self._send_telemetry_counter(self.TELEMETRY_COUNTER_TAGS_CACHE_MISS_COUNT, tags_cache.misses, scraper_config)
+        self._send_telemetry_counter(
+            self.TELEMETRY_COUNTER_TAGS_CACHE_EVICTION_COUNT, tags_cache.evictions, scraper_config
+        )
+        self._send_telemetry_gauge(self.TELEMETRY_GAUGE_TAGS_CACHE_SIZE, len(tags_cache), scraper_config)
+        tags_cache.reset_stats()
+
     def _is_value_valid(self, val):
         return not (isnan(val) or isinf(val))
 
@@ -28,6 +28,13 @@ class AggregatorStub(object):
     """
     Mainly used for unit testing checks, this stub makes possible to execute
     a check without a running Agent.
+
+    Metrics are indexed by name, by name and sorted tags, and by name and hostname as they
+    are submitted so that assertions only go through the submissions that can match.
+
+    In compact mode, which is meant for checks submitting a lot of metrics, the stored
+    submissions hold their normalized tags as tuples shared by all submissions with the
+    same tags, instead of the lists passed by the check.
     """
 
     # Replicate the Enum we have on the Agent
@@ -46,12 +53,10 @@ class AggregatorStub(object):
     AGGREGATE_TYPES = {COUNT, COUNTER}
     IGNORED_METRICS = {'datadog.agent.profile.memory.check_run_alloc'}
 
-    def __init__(self):
-        self._metrics = defaultdict(list)
-        self._asserted = set()
-        self._service_checks = defaultdict(list)
-        self._events = []
+    def __init__(self, compact=False):
+        self._default_compact = compact
         self._histogram_buckets = defaultdict(list)
+        self.reset()
 
     @classmethod
     def is_aggregate(cls, mtype):
@@ -61,14 +66,42 @@ class AggregatorStub(object):
     def ignore_metric(cls, name):
         return name in cls.IGNORED_METRICS
 
+    def _normalize_metric_tags(self, tags):
+        """
+        Returns the normalized tags as a tuple and their index key, which are shared by all
+        the submissions with the same tags
+        """
+        tags = tuple(tags) if tags else ()
+        try:
+            return self._tags_cache[tags]
+        except KeyError:
+            normalized = tuple(to_native_string(tag) for tag in tags)
+            entry = self._tags_cache[tags] = (normalized, tuple(sorted(normalized)))
+            return entry
+
+    def _add_metric(self, name, mtype, value, tags, hostname, device):
+        normalized_tags, tags_key = self._normalize_metric_tags(tags)
+        if self.compact:
+            tags = normalized_tags
+
+        stub = MetricStub(name, mtype, value, tags, hostname, device)
+        self._metrics[name].append(stub)
+        self._metrics_by_tags[name][tags_key].append(stub)
+        self._metrics_by_hostname[name][ensure_unicode(hostname)].append(stub)
+
     def submit_metric(self, check, check_id, mtype, name, value, tags, hostname):
         if not self.ignore_metric(name):
-            self._metrics[name].append(MetricStub(name, mtype, value, tags, hostname, None))
+            self._add_metric(name, mtype, value, tags, hostname, None)
+
+    def submit_metrics(self, check, check_id, mtype, name, values, tags_list, hostnames):
+        if not self.ignore_metric(name):
+            for value, tags, hostname in zip(values, tags_list, hostnames):
+                self._add_metric(name, mtype, value, tags, hostname, None)
 
     def submit_metric_e2e(self, check, check_id, mtype, name, value, tags, hostname, device=None):
         # Device is only present in metrics read from the real agent in e2e tests. Normally it is submitted as a tag
         if not self.ignore_metric(name):
-            self._metrics[name].append(MetricStub(name, mtype, value, tags, hostname, device))
+            self._add_metric(name, mtype, value, tags, hostname, device)
 
     def submit_service_check(self, check, check_id, name, status, tags, hostname, message):
         self._service_checks[name].append(ServiceCheckStub(check_id, name, status, tags, hostname, message))
@@ -145,16 +178,17 @@ class AggregatorStub(object):
         """
         self._asserted.add(metric_name)
 
-        candidates = []
-        for metric in self.metrics(metric_name):
-            if tag in metric.tags:
-                candidates.append(metric)
+        tag = to_native_string(tag)
+        candidates = 0
+        for tags_key, stubs in iteritems(self._metrics_by_tags.get(to_native_string(metric_name), {})):
+            if tag in tags_key:
+                candidates += len(stubs)
 
         msg = "Candidates size assertion for `{}`, count: {}, at_least: {}) failed".format(metric_name, count, at_least)
         if count is not None:
-            assert len(candidates) == count, msg
+            assert candidates == count, msg
         else:
-            assert len(candidates) >= at_least, msg
+            assert candidates >= at_least, msg
 
     # Potential kwargs: aggregation_key, alert_type, event_type,
     # msg_title, source_type_name
@@ -215,15 +249,21 @@ class AggregatorStub(object):
         self._asserted.add(name)
         expected_tags = normalize_tags(tags, sort=True)
 
+        # Start from the smallest set of submissions that can match
+        metric_name = to_native_string(name)
+        if expected_tags:
+            submissions = self._metrics_by_tags.get(metric_name, {}).get(tuple(expected_tags), [])
+        elif hostname:
+            submissions = self._metrics_by_hostname.get(metric_name, {}).get(ensure_unicode(hostname), [])
+        else:
+            submissions = self._metrics.get(metric_name, [])
+
         candidates = []
-        for metric in self.metrics(name):
+        for metric in submissions:
             if value is not None and not self.is_aggregate(metric.type) and value != metric.value:
                 continue
 
-            if expected_tags and expected_tags != sorted(metric.tags):
-                continue
-
-            if hostname and hostname != metric.hostname:
+            if hostname and hostname != ensure_unicode(metric.hostname):
                 continue
 
             if metric_type is not None and metric_type != metric.type:
@@ -320,7 +360,16 @@ class AggregatorStub(object):
         """
         # metric types that intended to be called multiple times are ignored
         ignored_types = [self.COUNT, self.MONOTONIC_COUNT, self.COUNTER]
-        metric_stubs = [m for metrics in self._metrics.values() for m in metrics if m.type not in ignored_types]
+
+        # Only submissions sharing their name and tags with others can be duplicates
+        metric_stubs = [
+            m
+            for metrics_by_tags in self._metrics_by_tags.values()
+            for metrics in metrics_by_tags.values()
+            if len(metrics) > 1
+            for m in metrics
+            if m.type not in ignored_types
+        ]
 
         def stub_to_key_fn(stub):
             return stub.name, stub.type, str(sorted(stub.tags)), stub.hostname
@@ -365,11 +414,18 @@ class AggregatorStub(object):
 
         assert len(dup_contexts) == 0, "\n".join(err_msg_lines)
 
-    def reset(self):
+    def reset(self, compact=None):
         """
         Set the stub to its initial state
+
+        :param compact: whether to store submissions in compact mode, by default the mode
+        the stub was created with
         """
+        self.compact = self._default_compact if compact is None else compact
         self._metrics = defaultdict(list)
+        self._metrics_by_tags = defaultdict(lambda: defaultdict(list))
+        self._metrics_by_hostname = defaultdict(lambda: defaultdict(list))
+        self._tags_cache = {}
         self._asserted = set()
         self._service_checks = defaultdict(list)
         self._events = []
@@ -382,20 +438,19 @@ class AggregatorStub(object):
         return present_metrics - set(self._asserted)
 
     def assert_metric_has_tag_prefix(self, metric_name, tag_prefix, count=None, at_least=1):
-        candidates = []
+        candidates = 0
         self._asserted.add(metric_name)
 
-        for metric in self.metrics(metric_name):
-            tags = metric.tags
-            gtags = [t for t in tags if t.startswith(tag_prefix)]
-            if len(gtags) > 0:
-                candidates.append(metric)
+        tag_prefix = to_native_string(tag_prefix)
+        for tags_key, stubs in iteritems(self._metrics_by_tags.get(to_native_string(metric_name), {})):
+            if any(t.startswith(tag_prefix) for t in tags_key):
+                candidates += len(stubs)
 
         msg = "Candidates size assertion for `{}`, count: {}, at_least: {}) failed".format(metric_name, count, at_least)
         if count is not None:
-            assert len(candidates) == count, msg
+            assert candidates == count, msg
         else:
-            assert len(candidates) >= at_least, msg
+            assert candidates >= at_least, msg
 
     @property
     def metrics_asserted_pct(self):
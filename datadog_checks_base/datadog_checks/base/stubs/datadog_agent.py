@@ -6,6 +6,7 @@
 class DatadogAgentStub(object):
     def __init__(self):
         self._metadata = {}
+        self._cache = {}
         self._config = self.get_default_config()
 
     def get_default_config(self):
@@ -13,6 +14,7 @@ class DatadogAgentStub(object):
 
     def reset(self):
         self._metadata.clear()
+        self._cache.clear()
         self._config = self.get_default_config()
 
     def assert_metadata(self, check_id, data):
@@ -47,6 +49,12 @@ class DatadogAgentStub(object):
     def tracemalloc_enabled(self, *args, **kwargs):
         return False
 
+    def read_persistent_cache(self, key):
+        return self._cache.get(key, '')
+
+    def write_persistent_cache(self, key, value):
+        self._cache[key] = value
+
 
 # Use the stub as a singleton
 datadog_agent = DatadogAgentStub()
@@ -0,0 +1,261 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from timeit import default_timer
+
+from six import StringIO, iteritems
+
+from .common import METRIC_PROFILE_NAMESPACE
+from .memory import get_timestamp_filename, parse_package_path
+
+DEFAULT_MODE = 'deterministic'
+DEFAULT_SORT_KEY = 'cumulative'
+DEFAULT_KEY_LIMIT = 10
+DEFAULT_INTERVAL = 0.005
+
+VALID_MODES = ('deterministic', 'sampling')
+VALID_SORT_KEYS = ('cumulative', 'own')
+
+
+class CpuProfileMetric(object):
+    __slots__ = ('name', 'value', 'tags')
+
+    def __init__(self, name, value, tags=None):
+        self.name = '{}.cpu.{}'.format(METRIC_PROFILE_NAMESPACE, name)
+        self.value = float(value)
+        self.tags = tags or []
+
+
+class FunctionStat(object):
+    __slots__ = ('name', 'calls', 'own_time', 'cumulative_time')
+
+    def __init__(self, name, calls, own_time, cumulative_time):
+        self.name = name
+        self.calls = calls
+        self.own_time = own_time
+        self.cumulative_time = cumulative_time
+
+
+class StackSampler(object):
+    """
+    Periodically records the stack of a thread, from another thread, so that the profiled
+    code is not slowed down by a tracing hook. Stacks stop at the `root` frame, so that only
+    the functions called from it are recorded.
+    """
+
+    def __init__(self, thread_id, root, interval):
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cpu-profile-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None and frame is not self.root:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+
+            # The profiled function was not called yet or has already returned
+            if not stack:
+                continue
+
+            # Root first, like the collapsed stack format expects
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+
+def format_function(function):
+    filename, lineno, name = function
+
+    # Built-in functions have no file
+    if filename == '~':
+        return name
+
+    return '{}:{}({})'.format(parse_package_path(filename), lineno, name)
+
+
+def gather_deterministic_stats(stats):
+    functions = []
+    for function, (_, calls, own_time, cumulative_time, _) in iteritems(stats.stats):
+        # Ignore the call that stopped the profiler
+        if function[0] == '~' and '_lsprof.Profiler' in function[2]:
+            continue
+
+        functions.append(FunctionStat(format_function(function), calls, own_time, cumulative_time))
+
+    return functions
+
+
+def gather_sampling_stats(sampler):
+    own_samples = Counter()
+    cumulative_samples = Counter()
+
+    for stack, count in iteritems(sampler.stacks):
+        own_samples[stack[-1]] += count
+
+        # Recursive functions must only be counted once per stack
+        for function in set(stack):
+            cumulative_samples[function] += count
+
+    return [
+        FunctionStat(
+            format_function(function),
+            0,
+            own_samples[function] * sampler.interval,
+            cumulative_samples[function] * sampler.interval,
+        )
+        for function in cumulative_samples
+    ]
+
+
+def gather_top(metrics, functions, sort_by, limit):
+    if sort_by == 'own':
+        functions.sort(key=lambda stat: stat.own_time, reverse=True)
+    else:
+        functions.sort(key=lambda stat: stat.cumulative_time, reverse=True)
+
+    for stat in functions[:limit]:
+        tags = ['function:{}'.format(stat.name)]
+        metrics.append(CpuProfileMetric('function.cumulative_time', stat.cumulative_time, tags))
+        metrics.append(CpuProfileMetric('function.own_time', stat.own_time, tags))
+        if stat.calls:
+            metrics.append(CpuProfileMetric('function.calls', stat.calls, tags))
+
+
+def write_collapsed_stacks(path, sampler):
+    with open(path, 'w') as f:
+        for stack, count in sorted(iteritems(sampler.stacks), key=lambda item: item[1], reverse=True):
+            f.write('{} {}\n'.format(';'.join(format_function(function) for function in stack), count))
+
+
+def write_report(path, stats, sort_by, limit):
+    stream = StringIO()
+    stats.stream = stream
+    stats.sort_stats('cumulative' if sort_by == 'cumulative' else 'tottime').print_stats(limit)
+
+    with open(path, 'w') as f:
+        f.write(stream.getvalue())
+
+
+def profile_cpu(f, config, namespaces=None, args=(), kwargs=None):
+    """
+    This will measure where the time is spent during the execution of function ``f``.
+    The only assumption is that the ``config`` dictionary has an entry ``profile_cpu`` that
+    points to a directory with which to output the information for later consumption.
+
+    The available options (without prefix) are:
+
+      - mode: how to profile between:
+                * deterministic: trace every function call with cProfile, writing pstats files
+                * sampling: record the stack at a fixed interval, writing collapsed stacks files
+                            that can be rendered as flame graphs
+      - interval: the number of seconds between two samples in sampling mode
+      - sort: what to rank functions by between: cumulative | own
+      - limit: the number of top functions to report as metrics and in reports
+
+    :param f: the function to profile
+    :param config: a dictionary of options prefixed by ``profile_cpu_``
+    :param namespaces: if specified, additional sub-directories under ``profile_cpu`` root directory
+    :param args: arguments to pass to function ``f``
+    :param kwargs: keyword arguments to pass to function ``f``
+    :return:
+    """
+    if kwargs is None:
+        kwargs = {}
+
+    mode = config.get('profile_cpu_mode', DEFAULT_MODE)
+    if mode not in VALID_MODES:
+        raise ValueError('Setting `profile_cpu_mode` must be one of: {}'.format(', '.join(VALID_MODES)))
+
+    sort_by = config.get('profile_cpu_sort', DEFAULT_SORT_KEY)
+    if sort_by not in VALID_SORT_KEYS:
+        raise ValueError('Setting `profile_cpu_sort` must be one of: {}'.format(', '.join(VALID_SORT_KEYS)))
+
+    limit = int(config.get('profile_cpu_limit', DEFAULT_KEY_LIMIT))
+
+    if mode == 'sampling':
+        interval = float(config.get('profile_cpu_interval', DEFAULT_INTERVAL))
+        profiler = StackSampler(threading.current_thread().ident, sys._getframe(), interval)
+
+        start = default_timer()
+        profiler.start()
+        try:
+            f(*args, **kwargs)
+        finally:
+            profiler.stop()
+            elapsed = default_timer() - start
+
+        functions = gather_sampling_stats(profiler)
+    else:
+        profiler = cProfile.Profile()
+
+        start = default_timer()
+        try:
+            profiler.runcall(f, *args, **kwargs)
+        finally:
+            elapsed = default_timer() - start
+
+        stats = pstats.Stats(profiler)
+        functions = gather_deterministic_stats(stats)
+
+    # Metrics to send
+    metrics = [CpuProfileMetric('check_run_time', elapsed)]
+    gather_top(metrics, functions, sort_by, limit)
+
+    # We're running on a live Agent
+    if 'profile_cpu' not in config:
+        return metrics
+
+    if namespaces:
+        # Colons can't be part of Windows file paths
+        namespaces = [n.replace(':', '_') for n in namespaces]
+        location = os.path.join(config['profile_cpu'], *namespaces)
+    else:
+        location = config['profile_cpu']
+
+    if mode == 'sampling':
+        stacks_dir = os.path.join(location, 'collapsed')
+        if not os.path.isdir(stacks_dir):
+            os.makedirs(stacks_dir)
+
+        write_collapsed_stacks(os.path.join(stacks_dir, get_timestamp_filename('stacks')), profiler)
+    else:
+        # The raw stats can be loaded with the `pstats` module or tools like snakeviz
+        pstats_dir = os.path.join(location, 'pstats')
+        if not os.path.isdir(pstats_dir):
+            os.makedirs(pstats_dir)
+
+        stats.dump_stats(os.path.join(pstats_dir, get_timestamp_filename('profile')))
+
+        report_dir = os.path.join(location, 'reports')
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+
+        write_report(os.path.join(report_dir, get_timestamp_filename('report')), stats, sort_by, limit)
+
+    return metrics
@@ -4,16 +4,22 @@
 
 
 def should_profile_memory(datadog_agent, check_name):
-    tracemalloc_whitelist = datadog_agent.get_config('tracemalloc_whitelist') or ''
-    if tracemalloc_whitelist:
-        tracemalloc_whitelist = [check.strip() for check in tracemalloc_whitelist.split(',')]
-        tracemalloc_whitelist = [check for check in tracemalloc_whitelist if check]
-
-    tracemalloc_blacklist = datadog_agent.get_config('tracemalloc_blacklist') or ''
-    if tracemalloc_blacklist:
-        tracemalloc_blacklist = [check.strip() for check in tracemalloc_blacklist.split(',')]
-        tracemalloc_blacklist = [check for check in tracemalloc_blacklist if check]
-
-    return check_name not in tracemalloc_blacklist and (
-        check_name in tracemalloc_whitelist if tracemalloc_whitelist else True
-    )
+    return _should_profile(datadog_agent, check_name, 'tracemalloc')
+
+
+def should_profile_cpu(datadog_agent, check_name):
+    return _should_profile(datadog_agent, check_name, 'cpu_profiling')
+
+
+def _should_profile(datadog_agent, check_name, prefix):
+    whitelist = datadog_agent.get_config('{}_whitelist'.format(prefix)) or ''
+    if whitelist:
+        whitelist = [check.strip() for check in whitelist.split(',')]
+        whitelist = [check for check in whitelist if check]
+
+    blacklist = datadog_agent.get_config('{}_blacklist'.format(prefix)) or ''
+    if blacklist:
+        blacklist = [check.strip() for check in blacklist.split(',')]
+        blacklist = [check for check in blacklist if check]
+
+    return check_name not in blacklist and (check_name in whitelist if whitelist else True)
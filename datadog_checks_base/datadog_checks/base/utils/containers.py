@@ -1,7 +1,12 @@
 # (C) Datadog, Inc. 2010-present
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
-from six import iteritems
+import copy
+
+from six import PY2, binary_type, integer_types, iteritems, text_type
+
+# Types that are safe to share between copies of a configuration
+IMMUTABLE_TYPES = (binary_type, text_type, float, bool, type(None)) + integer_types
 
 
 def freeze(o):
@@ -37,3 +42,87 @@ def iter_unique(*iterables):
 
             seen.add(item_id)
             yield item
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError('This object is read-only, modify a copy of it instead')
+
+
+class ReadOnlyDict(dict):
+    """
+    A dictionary that raises a TypeError when modified. It is a real `dict` subclass so that
+    `isinstance` checks, JSON serialization and `dict(...)` keep working, and its `copy` method
+    returns a regular dictionary.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return mutable_copy(self)
+
+    def __reduce__(self):
+        return dict, (mutable_copy(self),)
+
+
+class ReadOnlyList(list):
+    """
+    A list that raises a TypeError when modified. Concatenation and slicing return regular lists.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    if PY2:
+        __setslice__ = __delslice__ = _read_only
+    else:
+        clear = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return mutable_copy(self)
+
+    def __reduce__(self):
+        return list, (mutable_copy(self),)
+
+
+def read_only(o):
+    """
+    Returns a read-only copy of a configuration, converting nested dictionaries and lists.
+    """
+    if isinstance(o, dict):
+        return ReadOnlyDict((k, read_only(v)) for k, v in iteritems(o))
+
+    if isinstance(o, list):
+        return ReadOnlyList(read_only(e) for e in o)
+
+    return o
+
+
+def mutable_copy(o):
+    """
+    Returns a deep copy of a configuration, which is much faster than `copy.deepcopy` for the
+    dictionaries, lists and scalars that make up parsed YAML. Read-only containers are converted
+    to regular ones and any other type of object is copied with `copy.deepcopy`.
+    """
+    cls = type(o)
+
+    if cls is dict or cls is ReadOnlyDict:
+        return {k: mutable_copy(v) for k, v in iteritems(o)}
+
+    if cls is list or cls is ReadOnlyList:
+        return [mutable_copy(e) for e in o]
+
+    if cls in IMMUTABLE_TYPES:
+        return o
+
+    return copy.deepcopy(o)
@@ -1,22 +1,85 @@
 # (C) Datadog, Inc. 2019-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
-from itertools import chain
+from functools import partial
+from itertools import chain, islice
+from timeit import default_timer
+
+from six.moves import queue
 
 from ...config import is_affirmative
+from ..agent.common import METRIC_PROFILE_NAMESPACE
 from ..containers import iter_unique
+from ..executor import iter_futures
 from .query import Query
 from .transform import COLUMN_TRANSFORMERS, EXTRA_TRANSFORMERS
-from .utils import SUBMISSION_METHODS, create_submission_transformer
+from .utils import SUBMISSION_METHODS, QueryScheduler, create_submission_transformer
+
+# The number of rows processed at once when the executor does not return a list
+DEFAULT_BATCH_SIZE = 1000
+
+
+def iter_batches(rows, size):
+    # Results that were fetched entirely are processed in one go
+    if isinstance(rows, (list, tuple)):
+        if rows:
+            yield rows
+        return
+
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+
+        yield batch
 
 
 class QueryManager(object):
-    def __init__(self, check, executor, queries=None, tags=None, error_handler=None):
+    """
+    QueryManager runs the configured queries with `executor` and submits their results.
+
+    When `executors` is set, each of them must use its own connection and queries are run
+    concurrently by the `task_executor` of the check, one per executor at a time. Rows are then
+    transformed in the calling thread while the next result sets are being fetched, which means
+    every result set is read entirely before being processed.
+
+    Rows are processed in batches of `batch_size`, or all at once when the executor returns a list.
+
+    Queries with a `collection_interval` only run when due, based on the `min_collection_interval` of the
+    instance. In between, nothing is submitted for them unless they set `cache_results`, in which case the
+    rows of their last successful run are submitted again.
+
+    Setting `query_debug_metrics` in the instance sends the duration and the number of rows of each
+    query. Without `executors`, rows are read while being processed so the duration includes both.
+    """
+
+    def __init__(
+        self,
+        check,
+        executor,
+        queries=None,
+        tags=None,
+        error_handler=None,
+        executors=None,
+        batch_size=DEFAULT_BATCH_SIZE,
+    ):
         self.check = check
         self.executor = executor
+        self.executors = list(executors or [])
         self.queries = queries or []
         self.tags = tags or []
         self.error_handler = error_handler
+        self.batch_size = batch_size
+        self.debug_metrics = is_affirmative(self.check.instance.get('query_debug_metrics', False))
+        self.scheduler = QueryScheduler(
+            float(
+                self.check.instance.get(
+                    'min_collection_interval', self.check.init_config.get('min_collection_interval', 15)
+                )
+            )
+        )
+        self.cached_results = {}
 
         custom_queries = list(self.check.instance.get('custom_queries', []))
         use_global_custom_queries = self.check.instance.get('use_global_custom_queries', True)
@@ -48,83 +111,111 @@ class QueryManager(object):
         for query in self.queries:
             query.compile(column_transformers, EXTRA_TRANSFORMERS.copy())
 
-    def execute(self):
-        logger = self.check.log
-        global_tags = self.tags
+        self.scheduler.schedule(self.queries)
 
+    def execute(self):
+        now = self.scheduler.timer()
+        queries = []
         for query in self.queries:
-            query_name = query.name
-            query_columns = query.columns
-            query_extras = query.extras
-            query_tags = query.tags
-            num_columns = len(query_columns)
+            if self.scheduler.is_due(query, now):
+                queries.append(query)
+            elif query in self.cached_results:
+                self.process_rows(query, self.cached_results[query])
+
+        if self.executors:
+            results = self.iter_concurrent_results(queries)
+        else:
+            results = self.iter_serial_results(queries)
+
+        for query, rows, elapsed in results:
+            # The error has already been logged
+            if rows is None:
+                self.cached_results.pop(query, None)
+                continue
+
+            start = default_timer()
+            if query.cache_results:
+                rows = self.cached_results[query] = list(rows)
+
+            num_rows = self.process_rows(query, rows)
+            elapsed += default_timer() - start
 
+            if self.debug_metrics:
+                self.submit_debug_metrics(query, elapsed, num_rows)
+
+    def iter_serial_results(self, queries):
+        for query in queries:
+            start = default_timer()
             try:
                 rows = self.execute_query(query.query)
             except Exception as e:
-                if self.error_handler:
-                    logger.error('Error querying %s: %s', query_name, self.error_handler(str(e)))
-                else:
-                    logger.error('Error querying %s: %s', query_name, e)
+                self.log_query_error(query, e)
+                rows = None
 
-                continue
+            yield query, rows, default_timer() - start
+
+    def iter_concurrent_results(self, queries):
+        executors = queue.Queue()
+        for executor in self.executors:
+            executors.put(executor)
+
+        # Results are processed in order while the following queries keep running. No more tasks than
+        # executors are submitted at once, so that tasks never wait for an executor on a shared thread.
+        pending = iter_futures(
+            self.check.task_executor, partial(self.fetch_rows, executors), queries, len(self.executors)
+        )
+        try:
+            for query in queries:
+                try:
+                    rows, elapsed = next(pending).result()
+                except Exception as e:
+                    self.log_query_error(query, e)
+                    rows, elapsed = None, 0
+
+                yield query, rows, elapsed
+        finally:
+            pending.close()
+
+    def fetch_rows(self, executors, query):
+        executor = executors.get()
+        try:
+            start = default_timer()
+            rows = list(self.execute_query(query.query, executor=executor))
+            return rows, default_timer() - start
+        finally:
+            executors.put(executor)
+
+    def process_rows(self, query, rows):
+        logger = self.check.log
+        process = query.processor.process
+        num_rows = 0
+
+        for batch in iter_batches(rows, self.batch_size):
+            num_rows += len(batch)
+            process(batch, self.tags, logger)
+
+        return num_rows
+
+    def log_query_error(self, query, error):
+        if self.error_handler:
+            self.check.log.error('Error querying %s: %s', query.name, self.error_handler(str(error)))
+        else:
+            self.check.log.error('Error querying %s: %s', query.name, error)
+
+    def submit_debug_metrics(self, query, elapsed, num_rows):
+        tags = ['query:{}'.format(query.name)]
+        tags.extend(self.tags)
+
+        self.check.gauge('{}.query.duration'.format(METRIC_PROFILE_NAMESPACE), elapsed, tags=tags, raw=True)
+        self.check.gauge('{}.query.rows'.format(METRIC_PROFILE_NAMESPACE), num_rows, tags=tags, raw=True)
 
-            for row in rows:
-                if not row:
-                    logger.debug('Query %s returned an empty result', query_name)
-                    continue
-
-                if num_columns != len(row):
-                    logger.error(
-                        'Query %s expected %d column%s, got %d',
-                        query_name,
-                        num_columns,
-                        's' if num_columns > 1 else '',
-                        len(row),
-                    )
-                    continue
-
-                sources = {}
-                submission_queue = []
-
-                tags = list(global_tags)
-                tags.extend(query_tags)
-
-                for (column_name, transformer), value in zip(query_columns, row):
-                    # Columns can be ignored via configuration
-                    if not column_name:
-                        continue
-
-                    sources[column_name] = value
-
-                    column_type, transformer = transformer
-
-                    # The transformer can be None for `source` types. Those such columns do not submit
-                    # anything but are collected into the row values for other columns to reference.
-                    if transformer is None:
-                        continue
-                    elif column_type == 'tag':
-                        tags.append(transformer(None, value))
-                    else:
-                        submission_queue.append((transformer, value))
-
-                for transformer, value in submission_queue:
-                    transformer(sources, value, tags=tags)
-
-                for name, transformer in query_extras:
-                    try:
-                        result = transformer(sources, tags=tags)
-                    except Exception as e:
-                        logger.error('Error transforming %s: %s', name, e)
-                        continue
-                    else:
-                        if result is not None:
-                            sources[name] = result
-
-    def execute_query(self, query):
-        rows = self.executor(query)
+    def execute_query(self, query, executor=None):
+        rows = (executor or self.executor)(query)
         if rows is None:
             return iter([])
+        # Results that were fetched entirely are kept as is so that they are processed in one go
+        elif isinstance(rows, (list, tuple)):
+            return rows
         else:
             rows = iter(rows)
 
@@ -5,8 +5,12 @@ from copy import deepcopy
 
 from six import raise_from
 
+from ...config import is_affirmative
 from .utils import create_extra_transformer
 
+# Column types whose transformers read the other values of the row
+SOURCE_COLUMN_TYPES = frozenset(('match',))
+
 
 class Query(object):
     def __init__(self, query_data):
@@ -16,6 +20,9 @@ class Query(object):
         self.columns = None
         self.extras = None
         self.tags = None
+        self.collection_interval = None
+        self.cache_results = False
+        self.processor = None
 
     def compile(self, column_transformers, extra_transformers):
         # Check for previous compilation
@@ -44,8 +51,18 @@ class Query(object):
         if tags is not None and not isinstance(tags, list):
             raise ValueError('field `tags` for {} must be a list'.format(query_name))
 
+        collection_interval = self.query_data.get('collection_interval')
+        if collection_interval is not None:
+            if isinstance(collection_interval, bool) or not isinstance(collection_interval, (int, float)):
+                raise ValueError('field `collection_interval` for {} must be a number'.format(query_name))
+            elif collection_interval <= 0:
+                raise ValueError('field `collection_interval` for {} must be a positive number'.format(query_name))
+
+        cache_results = is_affirmative(self.query_data.get('cache_results', False))
+
         # Keep track of all defined names
         sources = {}
+        needs_sources = False
 
         column_data = []
         for i, column in enumerate(columns, 1):
@@ -80,6 +97,8 @@ class Query(object):
                 continue
             elif column_type not in column_transformers:
                 raise ValueError('unknown type `{}` for column {} of {}'.format(column_type, column_name, query_name))
+            elif column_type in SOURCE_COLUMN_TYPES:
+                needs_sources = True
 
             modifiers = {key: value for key, value in column.items() if key not in ('name', 'type')}
 
@@ -169,4 +188,95 @@ class Query(object):
         self.columns = tuple(column_data)
         self.extras = tuple(extra_data)
         self.tags = tags
+        self.collection_interval = collection_interval
+        self.cache_results = cache_results
+        self.processor = RowProcessor(query_name, self.columns, self.extras, tags, needs_sources or bool(extra_data))
         del self.query_data
+
+
+class RowProcessor(object):
+    """
+    RowProcessor submits the rows of a compiled query. The position of every tag and submission
+    column is resolved ahead of time, and rows are only collected into a mapping of sources when
+    the extras or the column types need it, so that large result sets are cheap to process.
+    """
+
+    __slots__ = ('name', 'num_columns', 'tag_columns', 'submission_columns', 'source_columns', 'extras', 'tags')
+
+    def __init__(self, name, columns, extras, tags, needs_sources):
+        self.name = name
+        self.num_columns = len(columns)
+        self.tag_columns = []
+        self.submission_columns = []
+        self.source_columns = [] if needs_sources else None
+        self.extras = extras
+        self.tags = tags or []
+
+        for index, (column_name, transformer) in enumerate(columns):
+            # Columns can be ignored via configuration
+            if not column_name:
+                continue
+
+            column_type, transformer = transformer
+
+            if needs_sources:
+                self.source_columns.append((index, column_name))
+
+            # The transformer can be None for `source` types. Those such columns do not submit
+            # anything but are collected into the row values for other columns to reference.
+            if transformer is None:
+                continue
+            elif column_type == 'tag':
+                self.tag_columns.append((index, transformer))
+            else:
+                self.submission_columns.append((index, transformer))
+
+    def process(self, rows, global_tags, logger):
+        """
+        Submits a batch of rows, like the result of `cursor.fetchmany`
+        """
+        name = self.name
+        num_columns = self.num_columns
+        tag_columns = self.tag_columns
+        submission_columns = self.submission_columns
+        source_columns = self.source_columns
+        extras = self.extras
+
+        # Rows without tag columns all share the same list, which is never modified
+        static_tags = list(global_tags)
+        static_tags.extend(self.tags)
+        sources = None
+
+        for row in rows:
+            if not row:
+                logger.debug('Query %s returned an empty result', name)
+                continue
+
+            if num_columns != len(row):
+                logger.error(
+                    'Query %s expected %d column%s, got %d', name, num_columns, 's' if num_columns > 1 else '', len(row)
+                )
+                continue
+
+            if tag_columns:
+                tags = list(static_tags)
+                for index, transformer in tag_columns:
+                    tags.append(transformer(None, row[index]))
+            else:
+                tags = static_tags
+
+            if source_columns is not None:
+                sources = {column_name: row[index] for index, column_name in source_columns}
+
+            for index, transformer in submission_columns:
+                transformer(sources, row[index], tags=tags)
+
+            for extra_name, transformer in extras:
+                try:
+                    result = transformer(sources, tags=tags)
+                except Exception as e:
+                    logger.error('Error transforming %s: %s', extra_name, e)
+                    continue
+                else:
+                    if result is not None:
+                        sources[extra_name] = result
@@ -1,7 +1,9 @@
 # (C) Datadog, Inc. 2019-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
+from collections import defaultdict
 from itertools import chain
+from timeit import default_timer
 
 import pytz
 
@@ -63,3 +65,45 @@ def normalize_datetime(dt):
         dt = dt.replace(tzinfo=pytz.utc)
 
     return dt
+
+
+class QueryScheduler(object):
+    """
+    QueryScheduler decides which of the queries with a `collection_interval` are due on each check run.
+
+    Queries sharing the same interval are spread evenly across it so that expensive queries do not all
+    run at once, and a query is considered due if it would otherwise run late by more than half of
+    `check_interval`, the expected time between check runs.
+    """
+
+    def __init__(self, check_interval, timer=default_timer):
+        self.tolerance = check_interval / 2.0
+        self.timer = timer
+        self.next_runs = {}
+
+    def schedule(self, queries):
+        intervals = defaultdict(list)
+        for query in queries:
+            if query.collection_interval:
+                intervals[query.collection_interval].append(query)
+
+        now = self.timer()
+        for interval, scheduled_queries in intervals.items():
+            step = interval / float(len(scheduled_queries))
+            for i, query in enumerate(scheduled_queries):
+                self.next_runs[query] = now + i * step
+
+    def is_due(self, query, now):
+        next_run = self.next_runs.get(query)
+        if next_run is None:
+            return True
+        elif now + self.tolerance < next_run:
+            return False
+
+        # Keep the same phase if the check ran late, without catching up on missed runs
+        interval = query.collection_interval
+        while next_run <= now + self.tolerance:
+            next_run += interval
+
+        self.next_runs[query] = next_run
+        return True
@@ -0,0 +1,225 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import threading
+from collections import deque
+from concurrent import futures
+from itertools import islice
+from timeit import default_timer
+
+try:
+    import datadog_agent
+except ImportError:
+    from ..stubs import datadog_agent
+
+# The number of threads shared by all checks of the process
+DEFAULT_MAX_WORKERS = 32
+
+# The number of tasks of a single check instance that may run at once
+DEFAULT_MAX_CONCURRENCY = 4
+
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+class SharedExecutor(object):
+    """
+    SharedExecutor is the thread pool shared by all checks of the process, so that the number of
+    threads stays bounded no matter how many check instances run concurrent tasks. Checks should
+    not use it directly but through a `CheckExecutor`, which limits how many of its threads a
+    single instance can occupy.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.queued = 0
+
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self.queued += 1
+
+        return self._executor.submit(self._run, fn, args)
+
+    def _run(self, fn, args):
+        with self._lock:
+            self.queued -= 1
+
+        return fn(*args)
+
+
+def get_shared_executor():
+    """
+    Returns the SharedExecutor of the process, which is created on first use with the number of
+    threads set by the `shared_executor_max_workers` option of the Agent
+    """
+    global _shared_executor
+
+    if _shared_executor is None:
+        with _shared_executor_lock:
+            if _shared_executor is None:
+                max_workers = datadog_agent.get_config('shared_executor_max_workers') or DEFAULT_MAX_WORKERS
+                _shared_executor = SharedExecutor(int(max_workers))
+
+    return _shared_executor
+
+
+class CheckExecutor(object):
+    """
+    CheckExecutor runs the tasks of a check instance on the shared executor, at most `max_concurrency`
+    at a time. Tasks above that quota wait in a queue of the instance instead of occupying more threads.
+
+    `submit` and `map` behave like the methods of `concurrent.futures.Executor`, and `cancel` cancels
+    every task that has not started yet, for example when the check is unscheduled.
+    """
+
+    def __init__(self, shared_executor, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.shared_executor = shared_executor
+        self.max_concurrency = max_concurrency
+
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._futures = set()
+        self._dispatched = 0
+        self._running = 0
+        self._cancelled = False
+
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the counters of submitted tasks and their latency
+        """
+        self.submitted = 0
+        self.started = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        task = (future, fn, args, kwargs, default_timer())
+
+        with self._lock:
+            if self._cancelled:
+                raise RuntimeError('cannot schedule new tasks after the check was cancelled')
+
+            self.submitted += 1
+            self._futures.add(future)
+
+            if self._dispatched < self.max_concurrency:
+                self._dispatched += 1
+            else:
+                self._pending.append(task)
+                task = None
+
+        future.add_done_callback(self._futures.discard)
+
+        if task is not None:
+            self.shared_executor.submit(self._run, task)
+
+        return future
+
+    def map(self, fn, *iterables):
+        """
+        Returns an iterator over the results of `fn` called with the items of `iterables`, in order
+        """
+        fs = [self.submit(fn, *args) for args in zip(*iterables)]
+
+        def result_iterator():
+            try:
+                for future in fs:
+                    yield future.result()
+            finally:
+                for future in fs:
+                    future.cancel()
+
+        return result_iterator()
+
+    def cancel(self):
+        """
+        Cancels the tasks that have not started yet, and refuses new ones. Running tasks are not interrupted.
+        """
+        with self._lock:
+            self._cancelled = True
+            pending = list(self._futures)
+
+        for future in pending:
+            future.cancel()
+
+    def _run(self, task):
+        future, fn, args, kwargs, submitted_at = task
+
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+
+            latency = default_timer() - submitted_at
+            with self._lock:
+                self._running += 1
+                self.started += 1
+                self.total_latency += latency
+                if latency > self.max_latency:
+                    self.max_latency = latency
+
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self._lock:
+                    self._running -= 1
+        finally:
+            self._dispatch_next()
+
+    def _dispatch_next(self):
+        with self._lock:
+            if not self._pending:
+                self._dispatched -= 1
+                return
+
+            task = self._pending.popleft()
+
+        # Go through the queue of the shared executor again so that other checks get their turn
+        self.shared_executor.submit(self._run, task)
+
+    def get_stats(self):
+        """
+        Returns the state of the queue and the latency of the tasks as a list of (name, value) pairs
+        """
+        with self._lock:
+            queued = len(self._pending) + self._dispatched - self._running
+            running = self._running
+
+        return [
+            ('tasks.submitted', self.submitted),
+            ('tasks.queued', queued),
+            ('tasks.running', running),
+            ('tasks.latency.avg', self.total_latency / self.started if self.started else 0.0),
+            ('tasks.latency.max', self.max_latency),
+            ('shared.queued', self.shared_executor.queued),
+            ('shared.workers', self.shared_executor.max_workers),
+        ]
+
+
+def iter_futures(executor, fn, iterable, max_in_flight):
+    """
+    Submits `fn` called with each item of `iterable` to `executor` and yields the futures in order.
+    A new task is only submitted once the previous future was consumed, so that at most `max_in_flight`
+    tasks run or wait at once. Tasks that were not consumed are cancelled when the generator is closed.
+    """
+    items = iter(iterable)
+    pending = deque(executor.submit(fn, item) for item in islice(items, max_in_flight))
+
+    try:
+        while pending:
+            yield pending.popleft()
+
+            for item in islice(items, 1):
+                pending.append(executor.submit(fn, item))
+    finally:
+        for future in pending:
+            future.cancel()
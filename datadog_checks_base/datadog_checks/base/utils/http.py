@@ -1,22 +1,35 @@
 # (C) Datadog, Inc. 2019-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
+import copy
 import logging
 import os
+import ssl
+import sys
+import threading
 from contextlib import contextmanager
+from functools import partial
 from ipaddress import ip_address, ip_network
+from timeit import default_timer
 
 import requests
 from requests import auth as requests_auth
+from requests.adapters import HTTPAdapter
 from requests_toolbelt.adapters import host_header_ssl
-from six import iteritems, string_types
+from six import iteritems, itervalues, reraise, string_types
 from six.moves.urllib.parse import urlparse
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
+from urllib3.util.ssl_ import create_urllib3_context
 
 from ..config import is_affirmative
 from ..errors import ConfigurationError
 from .common import ensure_unicode
+from .executor import CheckExecutor, get_shared_executor, iter_futures
 from .headers import get_default_headers, update_headers
+from .json_stream import iter_json
+from .lru import LRUCache
 from .warnings_util import disable_warnings_ctx
 
 try:
@@ -41,12 +54,26 @@ LOGGER = logging.getLogger(__file__)
 # https://tools.ietf.org/html/rfc2988
 DEFAULT_TIMEOUT = 10
 
+# The default number of requests sent at once by `RequestsWrapper.map`, which is also the default
+# number of connections kept open to a host by `requests`
+DEFAULT_CONCURRENCY = 10
+
+HTTP_METHODS = frozenset(('get', 'post', 'head', 'put', 'patch', 'delete'))
+
+# The number of bytes read from the socket at once by `RequestsWrapper.stream_json`
+JSON_STREAM_CHUNK_SIZE = 65536
+
+# Resuming a TLS session requires the `session` argument of `SSLContext.wrap_socket`, added in Python 3.6
+TLS_SESSION_RESUMPTION_SUPPORTED = hasattr(ssl, 'SSLSession')
+
 STANDARD_FIELDS = {
     'auth_type': 'basic',
     'aws_host': None,
     'aws_region': None,
     'aws_service': None,
     'connect_timeout': None,
+    'connection_pool_size': None,
+    'connection_stats': False,
     'extra_headers': None,
     'headers': None,
     'kerberos_auth': None,
@@ -57,17 +84,24 @@ STANDARD_FIELDS = {
     'kerberos_keytab': None,
     'kerberos_principal': None,
     'log_requests': False,
+    'max_retries': 0,
     'ntlm_domain': None,
     'password': None,
     'persist_connections': False,
     'proxy': None,
     'read_timeout': None,
+    'response_cache': False,
+    'response_cache_max_size': 128,
+    'response_cache_ttl': 0,
+    'retry_backoff_factor': 0,
+    'retry_status_codes': None,
     'skip_proxy': False,
     'tls_ca_cert': None,
     'tls_cert': None,
     'tls_use_host_header': False,
     'tls_ignore_warning': False,
     'tls_private_key': None,
+    'tls_session_resumption': False,
     'tls_verify': True,
     'timeout': DEFAULT_TIMEOUT,
     'username': None,
@@ -93,6 +127,8 @@ KERBEROS_STRATEGIES = {}
 class RequestsWrapper(object):
     __slots__ = (
         '_session',
+        'connection_stats',
+        'pool_options',
         'tls_use_host_header',
         'ignore_tls_warning',
         'log_requests',
@@ -101,6 +137,8 @@ class RequestsWrapper(object):
         'options',
         'persist_connections',
         'request_hooks',
+        'response_cache',
+        'task_executor',
     )
 
     def __init__(self, instance, init_config, remapper=None, logger=None):
@@ -109,6 +147,9 @@ class RequestsWrapper(object):
 
         # Update the default behavior for global settings
         default_fields['log_requests'] = init_config.get('log_requests', default_fields['log_requests'])
+        default_fields['persist_connections'] = init_config.get(
+            'persist_connections', default_fields['persist_connections']
+        )
         default_fields['skip_proxy'] = init_config.get('skip_proxy', default_fields['skip_proxy'])
         default_fields['timeout'] = init_config.get('timeout', default_fields['timeout'])
         default_fields['tls_ignore_warning'] = init_config.get(
@@ -259,11 +300,56 @@ class RequestsWrapper(object):
         # Ignore warnings for lack of SSL validation
         self.ignore_tls_warning = is_affirmative(config['tls_ignore_warning'])
 
+        # Cache of the responses to GET requests, revalidated with conditional requests when they expire
+        self.response_cache = None
+        if is_affirmative(config['response_cache']):
+            self.response_cache = ResponseCache(
+                float(config['response_cache_ttl']), int(config['response_cache_max_size'])
+            )
+
+        # Counters of new and reused connections, only available for persistent connections
+        self.connection_stats = ConnectionStats() if is_affirmative(config['connection_stats']) else None
+
+        # The `task_executor` of the check running concurrent requests, see `map`
+        self.task_executor = None
+
+        # Options of the transport adapter mounted on the session, if the defaults must be changed
+        # https://requests.readthedocs.io/en/master/api/#requests.adapters.HTTPAdapter
+        # https://urllib3.readthedocs.io/en/latest/reference/urllib3.util.html#urllib3.util.Retry
+        pool_options = {}
+        if config['connection_pool_size'] is not None:
+            pool_options['pool_maxsize'] = int(config['connection_pool_size'])
+
+        max_retries = int(config['max_retries'])
+        if max_retries:
+            pool_options['max_retries'] = Retry(
+                total=max_retries,
+                backoff_factor=float(config['retry_backoff_factor']),
+                status_forcelist=[int(code) for code in config['retry_status_codes'] or ()] or None,
+                # Return the last response instead of raising once retries are exhausted
+                raise_on_status=False,
+            )
+
+        if is_affirmative(config['tls_session_resumption']):
+            if TLS_SESSION_RESUMPTION_SUPPORTED:
+                pool_options['tls_session_resumption'] = True
+            else:
+                self.logger.warning('TLS session resumption requires Python 3.6 or later')
+
+        if self.connection_stats is not None:
+            pool_options['connection_stats'] = self.connection_stats
+
+        self.pool_options = pool_options
+
         # For connection and cookie persistence, if desired. See:
         # https://en.wikipedia.org/wiki/HTTP_persistent_connection#Advantages
         # http://docs.python-requests.org/en/master/user/advanced/#session-objects
         # http://docs.python-requests.org/en/master/user/advanced/#keep-alive
-        self.persist_connections = self.tls_use_host_header or is_affirmative(config['persist_connections'])
+        #
+        # Tuning the connection pool only makes sense for persistent connections.
+        self.persist_connections = (
+            self.tls_use_host_header or bool(pool_options) or is_affirmative(config['persist_connections'])
+        )
         self._session = None
 
         # Whether or not to log request information like method and url
@@ -297,7 +383,117 @@ class RequestsWrapper(object):
     def delete(self, url, **options):
         return self._request('delete', url, options)
 
+    def map(self, requests_spec, concurrency=DEFAULT_CONCURRENCY, return_exceptions=False, **options):
+        """
+        Sends requests concurrently and returns their responses in the same order.
+
+        Each element of `requests_spec` is either a URL to send a GET request to, or a dictionary
+        with a `url`, an optional `method` and any option accepted by the other methods of this
+        class like `params` or `timeout`. Options passed to this method apply to every request,
+        unless overridden by a request. Requests use persistent connections by default, and the
+        connection pool is grown to `concurrency` connections per host if need be.
+
+        Requests are sent by the thread pool shared by all checks, through the `task_executor`
+        of the check when set, so that they also count against the quota of its tasks.
+
+        :param requests_spec: the requests to send
+        :param concurrency: the maximum number of requests sent at once
+        :param return_exceptions: whether to return the exception raised by a failed request in
+                                  place of its response, rather than raising the first one once
+                                  all requests are done
+        """
+        prepared_requests = []
+        for spec in requests_spec:
+            request_options = dict(options)
+            request_options.setdefault('persist', True)
+
+            if isinstance(spec, string_types):
+                method = 'get'
+                url = spec
+            else:
+                spec = dict(spec)
+                method = spec.pop('method', 'get').lower()
+                url = spec.pop('url')
+                request_options.update(spec)
+
+            if method not in HTTP_METHODS:
+                raise ValueError('Unsupported HTTP method `{}`'.format(method))
+
+            prepared_requests.append((method, url, request_options))
+
+        concurrency = min(int(concurrency), len(prepared_requests))
+        if concurrency > 1 and any(request_options['persist'] for _, _, request_options in prepared_requests):
+            # Also creates the session before it is used by several threads
+            self._grow_connection_pool(concurrency)
+
+        results = []
+        exc_info = None
+
+        with ExitStack() as stack:
+            # Hooks modify the state of the process so they must only be entered once
+            for hook in self.request_hooks:
+                stack.enter_context(hook())
+
+            if concurrency > 1:
+                executor = self.task_executor or CheckExecutor(get_shared_executor(), concurrency)
+                pending = iter_futures(executor, lambda request: self._send(*request), prepared_requests, concurrency)
+                stack.callback(pending.close)
+            else:
+                pending = None
+
+            for request in prepared_requests:
+                try:
+                    if pending is None:
+                        result = self._send(*request)
+                    else:
+                        result = next(pending).result()
+                except Exception as e:
+                    if not return_exceptions:
+                        exc_info = exc_info or sys.exc_info()
+
+                    result = e
+
+                results.append(result)
+
+        if exc_info is not None:
+            reraise(*exc_info)
+
+        return results
+
+    def stream_json(self, url, path, method='get', chunk_size=JSON_STREAM_CHUNK_SIZE, **options):
+        """
+        Yields the `(key, value)` pairs found at `path` in the JSON body of the response while it is
+        being downloaded, so that large documents never have to be held in memory at once. See
+        `datadog_checks.base.utils.json_stream.iter_json` for the syntax of the path.
+
+        The request is only sent once iteration starts, and an `HTTPError` is raised for
+        error status codes.
+
+        :param url: the URL to send the request to
+        :param path: the path of the values to yield, like `items.*`
+        :param method: the HTTP method of the request
+        :param chunk_size: the number of bytes to read from the socket at once
+        :param options: any option accepted by the other methods of this class
+        """
+        options['stream'] = True
+        response = self._request(method, url, options)
+
+        try:
+            response.raise_for_status()
+
+            for item in iter_json(response.iter_content(chunk_size), path, encoding=response.encoding or 'utf-8'):
+                yield item
+        finally:
+            response.close()
+
     def _request(self, method, url, options):
+        with ExitStack() as stack:
+            for hook in self.request_hooks:
+                stack.enter_context(hook())
+
+            return self._send(method, url, options)
+
+    def _send(self, method, url, options):
         if self.log_requests:
             self.logger.debug(u'Sending %s request to %s', method.upper(), url)
 
@@ -315,14 +511,50 @@ class RequestsWrapper(object):
             new_options['headers'] = new_options['headers'].copy()
             new_options['headers'].update(extra_headers)
 
-        with ExitStack() as stack:
-            for hook in self.request_hooks:
-                stack.enter_context(hook())
+        if self.response_cache is not None and method == 'get' and not new_options.get('stream'):
+            return self._send_cached(url, new_options, persist)
 
-            if persist:
-                return getattr(self.session, method)(url, **new_options)
-            else:
-                return getattr(requests, method)(url, **new_options)
+        if persist:
+            return getattr(self.session, method)(url, **new_options)
+        else:
+            return getattr(requests, method)(url, **new_options)
+
+    def _send_cached(self, url, options, persist):
+        cache = self.response_cache
+        key = cache.get_key(url, options)
+        entry = cache.get(key)
+
+        if entry is not None:
+            if entry.is_fresh():
+                return entry.get_response()
+
+            validators = entry.get_validators()
+            if validators:
+                # The options may be the defaults of the wrapper
+                options = options.copy()
+                options['headers'] = options['headers'].copy()
+                options['headers'].update(validators)
+
+        if persist:
+            response = self.session.get(url, **options)
+        else:
+            response = requests.get(url, **options)
+
+        if entry is not None and entry.matches(response):
+            response.close()
+            entry.refresh()
+            return entry.get_response()
+
+        response.from_cache = False
+        cache.set(key, response)
+        return response
+
+    def _grow_connection_pool(self, size):
+        for adapter in itervalues(self.session.adapters):
+            if isinstance(adapter, HTTPAdapter) and adapter._pool_maxsize < size:
+                poolmanager = adapter.poolmanager
+                adapter.init_poolmanager(adapter._pool_connections, size, block=adapter._pool_block)
+                poolmanager.clear()
 
     def populate_options(self, options):
         # Avoid needless dictionary update if there are no options
@@ -345,10 +577,18 @@ class RequestsWrapper(object):
         if self._session is None:
             self._session = requests.Session()
 
+            if self.pool_options:
+                self._session.mount('http://', ConnectionPoolAdapter(**self.pool_options))
+
             # Enables HostHeaderSSLAdapter
             # https://toolbelt.readthedocs.io/en/latest/adapters.html#hostheaderssladapter
             if self.tls_use_host_header:
-                self._session.mount('https://', host_header_ssl.HostHeaderSSLAdapter())
+                if self.pool_options:
+                    self._session.mount('https://', HostHeaderConnectionPoolAdapter(**self.pool_options))
+                else:
+                    self._session.mount('https://', host_header_ssl.HostHeaderSSLAdapter())
+            elif self.pool_options:
+                self._session.mount('https://', ConnectionPoolAdapter(**self.pool_options))
 
             # Attributes can't be passed to the constructor
             for option, value in iteritems(self.options):
@@ -365,6 +605,336 @@ class RequestsWrapper(object):
             pass
 
 
+class CachedResponse(object):
+    """
+    A response stored by a `ResponseCache`, with what is needed to know if it is still valid.
+    """
+
+    __slots__ = ('response', 'ttl', 'expires_at')
+
+    def __init__(self, response, ttl):
+        self.response = response
+        self.ttl = ttl
+        self.refresh()
+
+    def refresh(self):
+        self.expires_at = default_timer() + self.ttl
+
+    def is_fresh(self):
+        return default_timer() < self.expires_at
+
+    def get_validators(self):
+        """
+        Returns the headers of a conditional request for the cached response
+        """
+        headers = {}
+
+        etag = self.response.headers.get('ETag')
+        if etag:
+            headers['If-None-Match'] = etag
+
+        last_modified = self.response.headers.get('Last-Modified')
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        return headers
+
+    def matches(self, response):
+        """
+        Whether the response to a revalidation means the cached response can be used
+        """
+        if response.status_code == 304:
+            return True
+
+        # Consul does not support conditional requests, but its index only changes with the content, see:
+        # https://www.consul.io/api/features/blocking.html
+        consul_index = self.response.headers.get('X-Consul-Index')
+        return (
+            consul_index is not None
+            and response.status_code == 200
+            and response.headers.get('X-Consul-Index') == consul_index
+        )
+
+    def get_response(self):
+        # Responses are returned as shallow copies so that the cached attributes can't be replaced
+        response = copy.copy(self.response)
+        response.from_cache = True
+
+        return response
+
+
+class ResponseCache(object):
+    """
+    ResponseCache stores the successful responses to GET requests, keyed by URL, headers and auth,
+    for `ttl` seconds and up to `max_size` responses. Expired responses are revalidated with conditional
+    requests. Cached responses are returned with the `from_cache` attribute set to True, so that checks
+    can skip processing them again.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.entries = LRUCache(max_size)
+
+        # Requests may be sent concurrently with `RequestsWrapper.map`
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(url, options):
+        prepared_request = requests.PreparedRequest()
+        prepared_request.prepare_url(url, options.get('params'))
+
+        headers = tuple(sorted((str(name).lower(), str(value)) for name, value in iteritems(options['headers'])))
+
+        auth = options.get('auth')
+        if isinstance(auth, list):
+            auth = tuple(auth)
+        elif auth is not None and not isinstance(auth, tuple):
+            # Authentication handlers like `HTTPDigestAuth` can't be hashed, so they are identified by their user
+            auth = (type(auth), getattr(auth, 'username', None))
+
+        return prepared_request.url, headers, auth
+
+    def get(self, key):
+        with self._lock:
+            return self.entries.get(key)
+
+    def set(self, key, response):
+        if response.status_code != 200 or 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+
+        with self._lock:
+            self.entries.set(key, CachedResponse(response, self.ttl))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+class ConnectionStats(object):
+    """
+    Counters of the connections opened by a `ConnectionPoolAdapter`, meant to be reset after each check run.
+
+    Connections are counted by the connection pools as they are checked out, so the counters hold
+    even when requests are sent concurrently with `RequestsWrapper.map`.
+    """
+
+    __slots__ = (
+        'new_connections',
+        'reused_connections',
+        'tls_handshakes',
+        'tls_handshake_time',
+        'tls_sessions_reused',
+        '_lock',
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.new_connections = 0
+            self.reused_connections = 0
+            self.tls_handshakes = 0
+            self.tls_handshake_time = 0.0
+            self.tls_sessions_reused = 0
+
+    def add_new_connection(self, tls_handshake_time=None, tls_session_reused=False):
+        with self._lock:
+            self.new_connections += 1
+
+            if tls_handshake_time is not None:
+                self.tls_handshakes += 1
+                self.tls_handshake_time += tls_handshake_time
+            if tls_session_reused:
+                self.tls_sessions_reused += 1
+
+    def add_reused_connection(self):
+        with self._lock:
+            self.reused_connections += 1
+
+    def get_stats(self):
+        """
+        Returns the counters as a list of (name, value) pairs
+        """
+        with self._lock:
+            return [
+                ('connections.new', self.new_connections),
+                ('connections.reused', self.reused_connections),
+                ('tls.handshakes', self.tls_handshakes),
+                ('tls.handshake_time', self.tls_handshake_time),
+                ('tls.sessions_reused', self.tls_sessions_reused),
+            ]
+
+
+class _ResumingSSLContext(object):
+    """
+    Proxy of an SSL context that resumes a TLS session when wrapping a socket.
+    """
+
+    __slots__ = ('_context', '_session')
+
+    def __init__(self, context, session):
+        object.__setattr__(self, '_context', context)
+        object.__setattr__(self, '_session', session)
+
+    def wrap_socket(self, *args, **kwargs):
+        kwargs.setdefault('session', self._session)
+        return self._context.wrap_socket(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._context, name, value)
+
+
+class _TrackedHTTPConnection(HTTPConnectionPool.ConnectionCls):
+    connection_stats = None
+
+    def connect(self):
+        super(_TrackedHTTPConnection, self).connect()
+
+        if self.connection_stats is not None:
+            self.connection_stats.add_new_connection()
+
+
+class _TrackedHTTPSConnection(HTTPSConnectionPool.ConnectionCls):
+    connection_stats = None
+    tls_sessions = None
+
+    _tcp_connect_time = 0.0
+
+    def _new_conn(self):
+        start = default_timer()
+        conn = super(_TrackedHTTPSConnection, self)._new_conn()
+        self._tcp_connect_time = default_timer() - start
+
+        return conn
+
+    def connect(self):
+        context = self.ssl_context
+        session_key = (self.host, self.port)
+
+        # Sessions can only be resumed with the context that created them
+        if self.tls_sessions is not None and isinstance(context, ssl.SSLContext):
+            session = self.tls_sessions.get(session_key)
+            if session is not None:
+                self.ssl_context = _ResumingSSLContext(context, session)
+
+        start = default_timer()
+        try:
+            super(_TrackedHTTPSConnection, self).connect()
+        finally:
+            self.ssl_context = context
+        handshake_time = max(default_timer() - start - self._tcp_connect_time, 0.0)
+
+        if self.tls_sessions is not None:
+            self._save_tls_session()
+
+        if self.connection_stats is not None:
+            self.connection_stats.add_new_connection(
+                tls_handshake_time=handshake_time,
+                tls_session_reused=self.tls_sessions is not None and getattr(self.sock, 'session_reused', False),
+            )
+
+    def close(self):
+        # With TLS 1.3 the session tickets are only received after the handshake
+        if self.tls_sessions is not None and self.sock is not None:
+            self._save_tls_session()
+
+        super(_TrackedHTTPSConnection, self).close()
+
+    def _save_tls_session(self):
+        session = getattr(self.sock, 'session', None)
+        if session is not None and session.has_ticket:
+            self.tls_sessions[(self.host, self.port)] = session
+
+
+class _TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TrackedHTTPConnection
+
+    def __init__(self, host, port=None, connection_stats=None, **kwargs):
+        super(_TrackedHTTPConnectionPool, self).__init__(host, port, **kwargs)
+        self.connection_stats = connection_stats
+
+    def _get_conn(self, timeout=None):
+        conn = super(_TrackedHTTPConnectionPool, self)._get_conn(timeout=timeout)
+
+        # Connections that are not connected yet are counted as new ones when they connect
+        if self.connection_stats is not None and conn.sock is not None:
+            self.connection_stats.add_reused_connection()
+
+        return conn
+
+    def _new_conn(self):
+        conn = super(_TrackedHTTPConnectionPool, self)._new_conn()
+        conn.connection_stats = self.connection_stats
+
+        return conn
+
+
+class _TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TrackedHTTPSConnection
+
+    def __init__(self, host, port=None, connection_stats=None, tls_sessions=None, **kwargs):
+        super(_TrackedHTTPSConnectionPool, self).__init__(host, port, **kwargs)
+        self.connection_stats = connection_stats
+        self.tls_sessions = tls_sessions
+
+    def _get_conn(self, timeout=None):
+        conn = super(_TrackedHTTPSConnectionPool, self)._get_conn(timeout=timeout)
+
+        # Connections that are not connected yet are counted as new ones when they connect
+        if self.connection_stats is not None and conn.sock is not None:
+            self.connection_stats.add_reused_connection()
+
+        return conn
+
+    def _new_conn(self):
+        conn = super(_TrackedHTTPSConnectionPool, self)._new_conn()
+        conn.connection_stats = self.connection_stats
+        conn.tls_sessions = self.tls_sessions
+
+        return conn
+
+
+class ConnectionPoolAdapter(HTTPAdapter):
+    """
+    Transport adapter that can count new and reused connections, time TLS handshakes
+    and resume TLS sessions when connections to the same host must be opened again.
+    """
+
+    def __init__(self, connection_stats=None, tls_session_resumption=False, **kwargs):
+        # Must be set before `init_poolmanager` is called by the parent constructor
+        self.connection_stats = connection_stats
+        self.tls_sessions = {} if tls_session_resumption else None
+
+        # All connections must share the same context for their sessions to be resumed, including the ones
+        # of the pool managers created when the pool grows. Hostnames are then verified by urllib3, so that
+        # the context can be used whether certificates are verified or not.
+        self.ssl_context = create_urllib3_context(cert_reqs=ssl.CERT_NONE) if tls_session_resumption else None
+
+        super(ConnectionPoolAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs.setdefault('ssl_context', self.ssl_context)
+
+        super(ConnectionPoolAdapter, self).init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': partial(_TrackedHTTPConnectionPool, connection_stats=self.connection_stats),
+            'https': partial(
+                _TrackedHTTPSConnectionPool, connection_stats=self.connection_stats, tls_sessions=self.tls_sessions
+            ),
+        }
+
+
+class HostHeaderConnectionPoolAdapter(host_header_ssl.HostHeaderSSLAdapter, ConnectionPoolAdapter):
+    pass
+
+
 @contextmanager
 def handle_kerberos_keytab(keytab_file):
     # There are no keytab options in any wrapper libs. The env var will be
@@ -0,0 +1,216 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import codecs
+import json
+
+from six import string_types
+
+# Matches every key of an object or every item of an array
+WILDCARD = '*'
+
+WHITESPACE = ' \t\n\r'
+
+# Consumed text is dropped from the buffer once it is larger than this
+COMPACT_THRESHOLD = 65536
+
+DECODER = json.JSONDecoder()
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class _Buffer(object):
+    """
+    Text read from a sequence of chunks, only keeping what has not been consumed yet.
+    """
+
+    __slots__ = ('chunks', 'decoder', 'text', 'pos', 'eof')
+
+    def __init__(self, chunks, encoding):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)('strict')
+        self.text = u''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        """
+        Reads at least as much text as is currently buffered, returning False at the end of the stream
+        """
+        if self.eof:
+            return False
+
+        if self.pos > COMPACT_THRESHOLD:
+            self.text = self.text[self.pos :]
+            self.pos = 0
+
+        wanted = max(len(self.text) - self.pos, 1)
+        parts = [self.text]
+        read = 0
+        while read < wanted:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                parts.append(self.decoder.decode(b'', final=True))
+                self.eof = True
+                break
+
+            if isinstance(chunk, bytes):
+                chunk = self.decoder.decode(chunk)
+
+            parts.append(chunk)
+            read += len(chunk)
+
+        self.text = u''.join(parts)
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or an empty string at the end of the stream
+        """
+        while True:
+            text = self.text
+            pos = self.pos
+            length = len(text)
+
+            while pos < length and text[pos] in WHITESPACE:
+                pos += 1
+
+            self.pos = pos
+            if pos < length:
+                return text[pos]
+
+            if not self.read():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise JSONStreamError('Expecting `{}` at position {}'.format(char, self.pos))
+
+        self.pos += 1
+
+    def decode(self):
+        """
+        Decodes the next value, reading more text until it is complete
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.text, self.pos)
+            except ValueError as e:
+                if not self.read():
+                    raise JSONStreamError(str(e))
+                continue
+
+            # Numbers and literals can only be known to be complete when followed by another character
+            if end == len(self.text) and self.read():
+                continue
+
+            self.pos = end
+            return value
+
+
+def _matches(segment, key):
+    return segment == WILDCARD or segment == key
+
+
+def _iter_path(buf, path, depth):
+    char = buf.peek()
+    segment = path[depth]
+    last = depth == len(path) - 1
+
+    if char == '{':
+        buf.pos += 1
+        if buf.peek() == '}':
+            buf.pos += 1
+            return
+
+        while True:
+            if buf.peek() != '"':
+                raise JSONStreamError('Expecting an object key at position {}'.format(buf.pos))
+
+            key = buf.decode()
+            buf.expect(':')
+
+            if not _matches(segment, key):
+                buf.decode()
+            elif last:
+                yield key, buf.decode()
+            else:
+                for item in _iter_path(buf, path, depth + 1):
+                    yield item
+
+            char = buf.peek()
+            buf.pos += 1
+            if char == '}':
+                return
+            elif char != ',':
+                raise JSONStreamError('Expecting `,` or `}}` at position {}'.format(buf.pos - 1))
+
+    elif char == '[':
+        buf.pos += 1
+        if buf.peek() == ']':
+            buf.pos += 1
+            return
+
+        index = 0
+        while True:
+            if not _matches(segment, str(index)):
+                buf.decode()
+            elif last:
+                yield index, buf.decode()
+            else:
+                for item in _iter_path(buf, path, depth + 1):
+                    yield item
+
+            char = buf.peek()
+            buf.pos += 1
+            if char == ']':
+                return
+            elif char != ',':
+                raise JSONStreamError('Expecting `,` or `]` at position {}'.format(buf.pos - 1))
+
+            index += 1
+
+    elif char:
+        # Scalars and null have no members to descend into
+        buf.decode()
+
+    else:
+        raise JSONStreamError('Unexpected end of the JSON document')
+
+
+def iter_json(chunks, path, encoding='utf-8'):
+    """
+    Yields the `(key, value)` pairs found at `path` in a JSON document read from `chunks`, only
+    decoding one value at a time. Members outside of the path are decoded and discarded.
+
+    The path is a dot-separated string or a sequence of object keys and array indices, where
+    `*` matches every key of an object or every item of an array. Keys of the yielded array
+    items are their indices. For example, with `nodes.*` the document:
+
+        {"cluster_name": "foo", "nodes": {"abc": {"name": "bar"}, "def": {"name": "baz"}}}
+
+    yields `('abc', {'name': 'bar'})` and `('def', {'name': 'baz'})`.
+
+    :param chunks: an iterable of bytes or text, like `response.iter_content(chunk_size)`
+    :param path: the path of the values to yield
+    :param encoding: the encoding of the chunks that are bytes
+    """
+    if isinstance(path, string_types):
+        path = path.split('.') if path else []
+    else:
+        path = [str(segment) for segment in path]
+
+    buf = _Buffer(chunks, encoding)
+
+    if path:
+        for item in _iter_path(buf, path, 0):
+            yield item
+    else:
+        yield None, buf.decode()
+
+    if buf.peek():
+        raise JSONStreamError('Extra data at position {}'.format(buf.pos))
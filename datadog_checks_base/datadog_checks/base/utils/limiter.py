@@ -1,6 +1,78 @@
 # (C) Datadog, Inc. 2018-present
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
+import math
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+DEFAULT_PRECISION = 12
+
+MASK_64 = (1 << 64) - 1
+
+
+def mix_hash(value):
+    """
+    Returns the 64-bit hash of `value`, with its bits mixed so that they are evenly distributed
+    even for values like small integers whose built-in hash is the value itself.
+    """
+    # The finalizer of SplitMix64
+    x = hash(value) & MASK_64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return x ^ (x >> 31)
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog estimates the number of distinct objects added to it using a fixed amount of memory:
+    2 ** precision bytes, for a standard error of about 1.04 / sqrt(2 ** precision).
+    """
+
+    __slots__ = ('precision', 'num_registers', 'registers', 'alpha')
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError('The precision must be between {} and {}'.format(MIN_PRECISION, MAX_PRECISION))
+
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+
+        if self.num_registers == 16:
+            self.alpha = 0.673
+        elif self.num_registers == 32:
+            self.alpha = 0.697
+        elif self.num_registers == 64:
+            self.alpha = 0.709
+        else:
+            self.alpha = 0.7213 / (1 + 1.079 / self.num_registers)
+
+    def add(self, value):
+        x = mix_hash(value)
+        index = x & (self.num_registers - 1)
+
+        # The position of the leftmost 1 in the remaining bits
+        rank = 65 - self.precision - (x >> self.precision).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        """
+        Returns the estimated number of distinct objects added since the last reset
+        """
+        m = self.num_registers
+        estimate = self.alpha * m * m / sum(2.0 ** -register for register in self.registers)
+
+        # Linear counting is more accurate for small cardinalities
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(b'\x00')
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)
+
+        return int(round(estimate))
+
+    def reset(self):
+        self.registers = bytearray(self.num_registers)
 
 
 class Limiter(object):
@@ -8,19 +80,24 @@ class Limiter(object):
     Limiter implements a simple cut-off capping logic for object count.
     It is used by the AgentCheck class to limit the number of sets of tags
     that can be set by an instance.
+
+    In compact mode, only the hashes of the uids are kept, which uses a fraction of the
+    memory at the cost of very rare collisions between distinct uids.
     """
 
-    def __init__(self, check_name, object_name, object_limit, warning_func=None):
+    def __init__(self, check_name, object_name, object_limit, warning_func=None, compact=False):
         """
         :param check_name: name of the check using this limiter
         :param object_name: (plural) name of counted objects for warning wording
         :param object_limit: maximum number of objects to accept before limiting
         :param warning_func: callback function, called with a string when limit is exceeded
+        :param compact: whether to only store the hashes of the uids
         """
         self.warning = warning_func
         self.name = object_name
         self.limit = object_limit
         self.check_name = check_name
+        self.compact = compact
 
         self.reached_limit = False
         self.count = 0
@@ -49,6 +126,9 @@ class Limiter(object):
             return True
 
         if uid:
+            if self.compact:
+                uid = hash(uid)
+
             if uid in self.seen:
                 return False
             self.count += 1
@@ -0,0 +1,64 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    LRUCache is a mapping bounded to `max_size` entries, the least recently used
+    entry is evicted when a new one doesn't fit. It keeps track of its hits, misses
+    and evictions until `reset_stats` is called.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: maximum number of entries to keep
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """
+        Returns the value of `key` and marks it as the most recently used, or `default`
+        """
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Stores `value` for `key`, evicting the least recently used entries if needed
+        """
+        entries = self.entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+        entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
@@ -0,0 +1,93 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+
+
+class NormalizationCache(object):
+    """
+    NormalizationCache memoizes the tags normalized and the metric names formatted by
+    the AgentCheck class, so that static tag lists sent many times per run are only
+    encoded once. It is meant to be reset after each run.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.names = {}
+
+        self.tags_hits = 0
+        self.tags_misses = 0
+        self.names_hits = 0
+        self.names_misses = 0
+
+    def reset(self):
+        """
+        Empties the cache and resets the hit counters
+        """
+        self.tags.clear()
+        self.names.clear()
+
+        self.tags_hits = 0
+        self.tags_misses = 0
+        self.names_hits = 0
+        self.names_misses = 0
+
+    @staticmethod
+    def tags_key(tags, device_name=None):
+        """
+        Returns the tags as a tuple, which is safe to iterate even if a generator was
+        passed, and the key to use with `get_tags` and `set_tags`, or None if the tags
+        cannot be hashed.
+        """
+        tags = tuple(tags)
+
+        try:
+            key = (device_name, tags)
+            hash(key)
+        except TypeError:
+            key = None
+
+        return tags, key
+
+    def get_tags(self, key):
+        """
+        Returns a new list with the normalized tags stored for `key`, or None
+        """
+        try:
+            normalized_tags = self.tags[key]
+        except KeyError:
+            self.tags_misses += 1
+            return None
+
+        self.tags_hits += 1
+        return list(normalized_tags)
+
+    def set_tags(self, key, normalized_tags):
+        if key is not None:
+            self.tags[key] = tuple(normalized_tags)
+
+    def get_name(self, name, raw):
+        """
+        Returns the formatted metric name stored for `name`, or None
+        """
+        try:
+            formatted_name = self.names[(name, raw)]
+        except KeyError:
+            self.names_misses += 1
+            return None
+
+        self.names_hits += 1
+        return formatted_name
+
+    def set_name(self, name, raw, formatted_name):
+        self.names[(name, raw)] = formatted_name
+
+    def get_stats(self):
+        """
+        Returns the hit counters as a list of (name, value) pairs
+        """
+        return [
+            ('tags.hits', self.tags_hits),
+            ('tags.misses', self.tags_misses),
+            ('names.hits', self.names_hits),
+            ('names.misses', self.names_misses),
+        ]
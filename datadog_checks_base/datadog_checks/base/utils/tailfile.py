@@ -2,17 +2,198 @@
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
 import binascii
+import ctypes
+import ctypes.util
+import errno
+import json
 import os
+import struct
+import sys
 from stat import ST_INO, ST_SIZE
+from timeit import default_timer
+
+from six import PY3
 
 from .common import ensure_bytes
 
+# The number of bytes read at once by `TailFile.tail_batches`
+DEFAULT_BLOCK_SIZE = 65536
+
+# The minimum number of seconds between two writes of a checkpoint
+DEFAULT_CHECKPOINT_INTERVAL = 10
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events of the parent directory that mean the path may now refer to another file
+IN_REPLACED = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    """
+    Watcher that always reports that the path may have changed, so that it is checked every time
+    the end of the file is reached.
+    """
+
+    def changed(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Watcher that only reports that the path may have changed after inotify notified that an entry
+    with its name was created, moved, deleted or modified in its directory.
+    """
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self._name = ensure_bytes(os.path.basename(path))
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        directory = ensure_bytes(os.path.dirname(os.path.abspath(path)))
+        if libc.inotify_add_watch(self._fd, directory, IN_REPLACED) < 0:
+            error = ctypes.get_errno()
+            self.close()
+            raise OSError(error, 'inotify_add_watch failed')
+
+    @classmethod
+    def create(cls, path, log):
+        """
+        Returns an InotifyWatcher when inotify is available, a PollingWatcher otherwise
+        """
+        if sys.platform.startswith('linux'):
+            try:
+                return cls(path)
+            except (OSError, AttributeError) as e:
+                log.debug('Unable to watch %s with inotify, falling back to polling: %s', path, e)
+
+        return PollingWatcher()
+
+    def changed(self):
+        changed = False
+
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset : offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW or name == self._name:
+                    changed = True
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class TailFileCheckpoint(object):
+    """
+    TailFileCheckpoint records the position of a `TailFile` in the persistent cache of a check, so that
+    it resumes where it stopped after an Agent restart. The position is the inode, the offset of the first
+    line that was not processed yet and the CRC of the beginning of the file.
+
+    Updates are only kept in memory and written by `flush`, at most once every `interval` seconds
+    unless forced.
+    """
+
+    def __init__(self, check, key, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        """
+        :param check: the AgentCheck whose persistent cache is used
+        :param key: the key of the checkpoint, unique among the files tailed by the check
+        :param interval: the minimum number of seconds between two writes
+        """
+        self.check = check
+        self.key = key
+        self.interval = interval
+
+        self.position = None
+        self.dirty = False
+        self.last_write = None
+
+    def load(self):
+        """
+        Returns the stored position as a tuple of (inode, offset, crc), or None
+        """
+        try:
+            data = self.check.read_persistent_cache(self.key)
+            if not data:
+                return None
+
+            position = json.loads(data)
+            self.position = (position['inode'], position['offset'], position['crc'])
+        except Exception as e:
+            self.check.log.warning('Unable to load the checkpoint %s: %s', self.key, e)
+            return None
+
+        return self.position
+
+    def update(self, inode, offset, crc):
+        position = (inode, offset, crc)
+        if position != self.position:
+            self.position = position
+            self.dirty = True
+
+    def flush(self, force=False):
+        if not self.dirty:
+            return
+
+        now = default_timer()
+        if not force and self.last_write is not None and now - self.last_write < self.interval:
+            return
+
+        inode, offset, crc = self.position
+        try:
+            self.check.write_persistent_cache(self.key, json.dumps({'inode': inode, 'offset': offset, 'crc': crc}))
+        except Exception as e:
+            self.check.log.warning('Unable to write the checkpoint %s: %s', self.key, e)
+            return
+
+        self.dirty = False
+        self.last_write = now
+
+
+def read_at(f, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+
+    position = f.tell()
+    try:
+        f.seek(offset)
+        return f.read(size)
+    finally:
+        f.seek(position)
+
 
 class TailFile(object):
 
     CRC_SIZE = 16
 
-    def __init__(self, logger, path, callback):
+    def __init__(self, logger, path, callback, checkpoint=None):
         self._path = path
         self._f = None
         self._inode = None
@@ -20,6 +201,8 @@ class TailFile(object):
         self._crc = None
         self._log = logger
         self._callback = callback
+        self._watcher = None
+        self._checkpoint = checkpoint
 
     def _open_file(self, move_end=False, pos=False):
 
@@ -105,3 +288,179 @@ class TailFile(object):
             # log but survive
             self._log.exception(e)
             raise StopIteration(e)
+
+    def tail_batches(self, batch_callback=None, move_end=True, block_size=DEFAULT_BLOCK_SIZE, use_inotify=True):
+        """
+        Read the file in blocks and run `batch_callback` on the list of complete lines of each block,
+        or the line callback on each of them by default. Yields every time the end of the file is reached.
+
+        Rotation and truncation are only checked at the end of the file, and the path is only looked up
+        again when inotify reports a change to its directory entry, or every time without inotify.
+
+        With a `TailFileCheckpoint`, reading resumes from the stored position if it still refers to the
+        same file, or starts from the beginning of the file if it was rotated in the meantime.
+
+        batch_callback: called with the list of lines of each block
+        move_end: start from the end of the file
+        block_size: the number of bytes to read at once
+        use_inotify: whether to watch the path with inotify when available
+        """
+        if batch_callback is None:
+            batch_callback = self._run_line_callback
+
+        checkpoint = self._checkpoint
+
+        try:
+            if not self._resume():
+                self._open_binary_file(move_end=move_end)
+
+            if checkpoint is not None:
+                checkpoint.update(self._inode, self._f.tell(), self._crc)
+
+            if use_inotify:
+                self._watcher = InotifyWatcher.create(self._path, self._log)
+            else:
+                self._watcher = PollingWatcher()
+
+            # Incomplete last line of the previous block
+            partial = b''
+
+            while True:
+                data = self._f.read(block_size)
+                if data:
+                    data = partial + data
+                    end = data.rfind(b'\n')
+                    if end == -1:
+                        partial = data
+                        continue
+
+                    partial = data[end + 1 :]
+                    batch_callback(self._split_lines(data[:end]))
+
+                    if checkpoint is not None:
+                        checkpoint.update(self._inode, self._f.tell() - len(partial), self._crc)
+                else:
+                    if checkpoint is not None:
+                        checkpoint.flush()
+
+                    yield True
+
+                    if self._reopen_if_replaced():
+                        partial = b''
+                        if checkpoint is not None:
+                            checkpoint.update(self._inode, 0, self._crc)
+
+        except Exception as e:
+            # log but survive
+            self._log.exception(e)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._checkpoint is not None:
+            self._checkpoint.flush(force=True)
+
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _resume(self):
+        """
+        Opens the file at the position of the checkpoint, returns whether there was one
+        """
+        if self._checkpoint is None:
+            return False
+
+        position = self._checkpoint.load()
+        if position is None:
+            return False
+
+        inode, offset, crc = position
+        self._open_binary_file()
+        size = os.fstat(self._f.fileno())[ST_SIZE]
+
+        # Files that were too small to have a CRC can only be recognized by their inode
+        if inode == self._inode and offset <= size and (crc is None or crc == self._crc):
+            self._log.debug("Resuming file %s at %s", self._path, offset)
+            self._f.seek(offset)
+        else:
+            self._log.debug("File %s changed since the last checkpoint, reading it from the start", self._path)
+
+        return True
+
+    def _run_line_callback(self, lines):
+        callback = self._callback
+        for line in lines:
+            callback(line)
+
+    @staticmethod
+    def _split_lines(data):
+        if PY3:
+            data = data.decode('utf-8', 'replace')
+
+        lines = data.split('\n')
+
+        # A truncate may have created holes in the file
+        if '\0' in data:
+            lines = [line.strip('\0') for line in lines]
+
+        return lines
+
+    def _open_binary_file(self, move_end=False):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+        self._f = open(self._path, 'rb')
+        stat = os.fstat(self._f.fileno())
+        self._inode = stat[ST_INO]
+        self._crc = self._read_crc(stat[ST_SIZE])
+
+        if move_end:
+            self._log.debug("Opening file %s", self._path)
+            self._f.seek(0, os.SEEK_END)
+
+    def _read_crc(self, size):
+        if size < self.CRC_SIZE:
+            return None
+
+        return binascii.crc32(read_at(self._f, self.CRC_SIZE, 0))
+
+    def _reopen_if_replaced(self):
+        """
+        Called at the end of the file, returns whether it was read again from the beginning
+        """
+        if self._watcher.changed():
+            try:
+                inode = os.stat(self._path)[ST_INO]
+            except OSError:
+                # The file was removed, keep the current one until it is created again
+                inode = self._inode
+
+            if inode != self._inode:
+                self._log.debug("File removed, reopening")
+                self._open_binary_file()
+                return True
+
+        size = os.fstat(self._f.fileno())[ST_SIZE]
+        if size < self._f.tell():
+            self._log.debug("File truncated, reopening")
+        else:
+            # Check if file has been truncated and too much data has
+            # already been written (copytruncate and opened files...)
+            crc = self._read_crc(size)
+            if self._crc is None:
+                self._crc = crc
+                return False
+            elif crc == self._crc:
+                return False
+
+            self._log.debug("Beginning of file modified, reopening")
+
+        self._f.seek(0)
+        self._crc = self._read_crc(size)
+        return True
@@ -0,0 +1,127 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import pytest
+
+from datadog_checks.base import AgentCheck
+from datadog_checks.base.stubs.aggregator import AggregatorStub
+
+
+@pytest.fixture(params=[False, True], ids=['default', 'compact'])
+def stub(request):
+    return AggregatorStub(compact=request.param)
+
+
+def submit(stub, name, value, tags=None, hostname='', mtype=AggregatorStub.GAUGE):
+    stub.submit_metric(None, 'test', mtype, name, value, tags, hostname)
+
+
+class TestIndexes:
+    def test_assert_metric_by_tags(self, stub):
+        submit(stub, 'foo', 1, ['a:1', 'b:1'])
+        submit(stub, 'foo', 2, ['b:1', 'a:1'])
+        submit(stub, 'foo', 3, ['a:2'])
+
+        stub.assert_metric('foo', tags=['b:1', 'a:1'], count=2)
+        stub.assert_metric('foo', value=2, tags=['a:1', 'b:1'], count=1)
+        stub.assert_metric('foo', tags=['a:2'], count=1)
+        stub.assert_metric('foo', tags=['a:3'], count=0)
+        stub.assert_metric('foo', count=3)
+
+    def test_assert_metric_by_hostname(self, stub):
+        submit(stub, 'foo', 1, ['a:1'], hostname='h1')
+        submit(stub, 'foo', 2, ['a:1'], hostname='h2')
+        submit(stub, 'foo', 3, ['a:2'], hostname='h2')
+
+        stub.assert_metric('foo', hostname='h2', count=2)
+        stub.assert_metric('foo', tags=['a:1'], hostname='h2', value=2, count=1)
+        stub.assert_metric('foo', hostname='h3', count=0)
+
+    def test_assert_metric_failure(self, stub):
+        submit(stub, 'foo', 1, ['a:1'])
+
+        with pytest.raises(AssertionError, match="Needed at least 1 candidates for 'foo', got 0"):
+            stub.assert_metric('foo', tags=['a:2'])
+
+    def test_aggregate_value(self, stub):
+        submit(stub, 'foo', 1, ['a:1'], mtype=stub.COUNT)
+        submit(stub, 'foo', 2, ['a:1'], mtype=stub.COUNT)
+
+        stub.assert_metric('foo', value=3, tags=['a:1'])
+
+    def test_assert_metric_has_tag(self, stub):
+        submit(stub, 'foo', 1, ['a:1', 'b:1'])
+        submit(stub, 'foo', 2, ['a:1', 'b:2'])
+        submit(stub, 'foo', 3)
+
+        stub.assert_metric_has_tag('foo', 'a:1', count=2)
+        stub.assert_metric_has_tag('foo', 'b:2', count=1)
+        stub.assert_metric_has_tag_prefix('foo', 'b:', count=2)
+
+        with pytest.raises(AssertionError):
+            stub.assert_metric_has_tag('foo', 'c:1')
+
+    def test_no_duplicate(self, stub):
+        submit(stub, 'foo', 1, ['a:1', 'b:1'])
+        submit(stub, 'foo', 2, ['a:1', 'b:1'], hostname='h1')
+        submit(stub, 'foo', 3, ['a:1', 'b:1'], mtype=stub.RATE)
+        submit(stub, 'bar', 1, ['a:1', 'b:1'], mtype=stub.COUNT)
+        submit(stub, 'bar', 1, ['a:1', 'b:1'], mtype=stub.COUNT)
+
+        stub.assert_no_duplicate_metrics()
+
+        submit(stub, 'foo', 4, ['b:1', 'a:1'])
+        with pytest.raises(AssertionError, match='Duplicate metrics found'):
+            stub.assert_no_duplicate_metrics()
+
+    def test_reset(self, stub):
+        submit(stub, 'foo', 1, ['a:1'])
+        stub.reset()
+
+        stub.assert_metric('foo', tags=['a:1'], count=0)
+        assert stub.metric_names == []
+
+    def test_check_submission(self, aggregator):
+        check = AgentCheck('test', {}, [{}])
+        check.gauge('foo', 1, tags=['a:1'], hostname='h1')
+        check.gauge('foo', 2, tags=['a:2'])
+
+        aggregator.assert_metric('foo', value=1, tags=['a:1'], hostname='h1')
+        aggregator.assert_metric('foo', value=2, tags=['a:2'])
+        aggregator.assert_all_metrics_covered()
+
+
+class TestCompact:
+    def test_shared_tags(self):
+        stub = AggregatorStub(compact=True)
+        submit(stub, 'foo', 1, ['a:1'])
+        submit(stub, 'bar', 2, ['a:1'])
+
+        foo, bar = stub._metrics['foo'][0], stub._metrics['bar'][0]
+        assert foo.tags == ('a:1',)
+        assert foo.tags is bar.tags
+
+    def test_metrics(self):
+        stub = AggregatorStub(compact=True)
+        submit(stub, 'foo', 1, ['a:1'], hostname='h1')
+
+        metric = stub.metrics('foo')[0]
+        assert metric.tags == ['a:1']
+        assert metric.hostname == 'h1'
+
+    def test_reset_mode(self):
+        stub = AggregatorStub()
+        assert stub.compact is False
+
+        stub.reset(compact=True)
+        assert stub.compact is True
+
+        stub.reset()
+        assert stub.compact is False
+
+    def test_similar_message(self):
+        stub = AggregatorStub(compact=True)
+        submit(stub, 'foo', 1, ['b:1', 'a:1'])
+
+        with pytest.raises(AssertionError, match=r"tags=\['a:1', 'b:1'\]"):
+            stub.assert_metric('foo', value=2)
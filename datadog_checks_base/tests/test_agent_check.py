@@ -445,6 +445,56 @@ class TestMetrics:
             check.gauge(metric_name, '85k')
         aggregator.assert_metric(metric_name, count=0)
 
+    def test_submit_batch(self, aggregator):
+        check = AgentCheck()
+        check.__NAMESPACE__ = 'test'
+        tags = [u'foo:bar', b'baz:qux']
+
+        check.submit_batch(
+            aggregator.GAUGE, 'metric', [1, '2', None, 3.5], [tags, tags, None, None], [None, None, None, 'host']
+        )
+
+        aggregator.assert_metric('test.metric', value=1, tags=['foo:bar', 'baz:qux'], hostname='', count=1)
+        aggregator.assert_metric('test.metric', value=2, tags=['foo:bar', 'baz:qux'], hostname='', count=1)
+        aggregator.assert_metric('test.metric', value=3.5, tags=[], hostname='host', count=1)
+        aggregator.assert_all_metrics_covered()
+
+    def test_submit_batch_raw(self, aggregator):
+        check = AgentCheck()
+        check.__NAMESPACE__ = 'test'
+
+        check.submit_batch(aggregator.COUNT, 'metric', [1, 2], raw=True)
+
+        aggregator.assert_metric('metric', value=3, metric_type=aggregator.COUNT)
+
+    def test_submit_batch_without_batch_support(self, aggregator):
+        check = AgentCheck()
+
+        with mock.patch('datadog_checks.base.checks.base.aggregator') as agent_aggregator:
+            agent_aggregator.mock_add_spec(['submit_metric'])
+            check.submit_batch(aggregator.GAUGE, 'metric', [1, 2], [['foo:bar'], ['foo:baz']])
+
+        agent_aggregator.submit_metric.assert_has_calls(
+            [
+                mock.call(check, check.check_id, aggregator.GAUGE, 'metric', 1.0, ['foo:bar'], ''),
+                mock.call(check, check.check_id, aggregator.GAUGE, 'metric', 2.0, ['foo:baz'], ''),
+            ]
+        )
+
+    def test_submit_batch_length_mismatch(self, aggregator):
+        check = AgentCheck()
+
+        with pytest.raises(ValueError):
+            check.submit_batch(aggregator.GAUGE, 'metric', [1, 2], [['foo:bar']])
+        aggregator.assert_metric('metric', count=0)
+
+    def test_submit_batch_non_float_metric(self, aggregator):
+        check = AgentCheck()
+
+        with pytest.raises(ValueError):
+            check.submit_batch(aggregator.GAUGE, 'metric', [1, '85k'])
+        aggregator.assert_metric('metric', count=0)
+
 
 class TestEvents:
     def test_valid_event(self, aggregator):
@@ -621,6 +671,254 @@ class TestTags:
                 set_external_tags.assert_called_with([('hostnam\xc3\xa9', {'src_name': ['key1:val1']})])
 
 
+class TestNormalizationCache:
+    def test_default_disabled(self):
+        check = AgentCheck('test', {}, [{}])
+
+        assert check._normalization_cache is None
+
+    @pytest.mark.parametrize(
+        'init_config, instance, enabled',
+        [
+            pytest.param({}, {'normalization_cache': True}, True, id='instance'),
+            pytest.param({'normalization_cache': True}, {}, True, id='init_config'),
+            pytest.param({'normalization_cache': True}, {'normalization_cache': 'false'}, False, id='override'),
+        ],
+    )
+    def test_config(self, init_config, instance, enabled):
+        check = AgentCheck('test', init_config, [instance])
+
+        assert (check._normalization_cache is not None) is enabled
+
+    def test_cached_submissions(self, aggregator):
+        check = AgentCheck('test', {}, [{'normalization_cache': True}])
+        check.__NAMESPACE__ = 'test'
+        tags = [u'foo:bar', b'baz:qux', None]
+
+        for value in range(3):
+            check.gauge('metric', value, tags=tags)
+        check.service_check('sc', AgentCheck.OK, tags=tags)
+
+        aggregator.assert_metric('test.metric', tags=['foo:bar', 'baz:qux'], count=3)
+        aggregator.assert_service_check('test.sc', tags=['foo:bar', 'baz:qux'])
+        assert check._normalization_cache.get_stats() == [
+            ('tags.hits', 3),
+            ('tags.misses', 1),
+            ('names.hits', 2),
+            ('names.misses', 2),
+        ]
+
+    def test_returns_new_list(self):
+        check = AgentCheck('test', {}, [{'normalization_cache': True}])
+
+        tags = check._normalize_tags_type(['foo:bar'])
+        tags.append('baz:qux')
+
+        assert check._normalize_tags_type(['foo:bar']) == ['foo:bar']
+
+    def test_device_name(self):
+        check = AgentCheck('test', {}, [{'normalization_cache': True}])
+
+        assert check._normalize_tags_type(['foo:bar'], device_name='dev') == ['device:dev', 'foo:bar']
+        assert check._normalize_tags_type(['foo:bar']) == ['foo:bar']
+
+    def test_generator(self):
+        check = AgentCheck('test', {}, [{'normalization_cache': True}])
+
+        assert check._normalize_tags_type(tag for tag in ['foo:bar']) == ['foo:bar']
+        assert check._normalize_tags_type(tag for tag in ['foo:bar']) == ['foo:bar']
+
+    def test_stats_sent_and_reset_after_run(self, aggregator):
+        class TestCheck(AgentCheck):
+            def check(self, _):
+                self.gauge('metric', 0, tags=['foo:bar'])
+                self.gauge('metric', 1, tags=['foo:bar'])
+
+        check = TestCheck('test', {}, [{'normalization_cache': True}])
+        check.check_id = 'test:123'
+        check.run()
+
+        tags = ['check_name:test', 'check_version:{}'.format(check.check_version)]
+        aggregator.assert_metric('datadog.agent.profile.normalization_cache.tags.hits', value=1, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.normalization_cache.tags.misses', value=1, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.normalization_cache.names.hits', value=1, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.normalization_cache.names.misses', value=1, tags=tags)
+        assert not check._normalization_cache.tags
+        assert not check._normalization_cache.names
+        assert check._normalization_cache.get_stats() == [
+            ('tags.hits', 0),
+            ('tags.misses', 0),
+            ('names.hits', 0),
+            ('names.misses', 0),
+        ]
+
+    def test_stats_counted_in_current_run(self, aggregator):
+        class TestCheck(LimitedCheck):
+            def check(self, _):
+                self.gauge('metric', 0)
+
+        check = TestCheck('test', {}, [{'normalization_cache': True}])
+        check.run()
+
+        # The stats are limited along with the metrics of the run, not with the ones of the next run
+        assert check.metric_limiter.count == 0
+        aggregator.assert_metric('datadog.agent.profile.normalization_cache.tags.hits')
+
+
+class TestCpuProfiling:
+    @staticmethod
+    def busy(n):
+        return sum(i * i for i in range(n))
+
+    def get_check(self, init_config):
+        busy = self.busy
+
+        class TestCheck(AgentCheck):
+            def check(self, _):
+                busy(500000)
+                self.gauge('metric', 0)
+
+        check = TestCheck('test', init_config, [{}])
+        check.check_id = 'test:123'
+        return check
+
+    @pytest.mark.parametrize('mode, directory', [('deterministic', 'pstats'), ('sampling', 'collapsed')])
+    def test_output(self, aggregator, tmpdir, mode, directory):
+        check = self.get_check(
+            {
+                'profile_cpu': str(tmpdir),
+                'profile_cpu_mode': mode,
+                'profile_cpu_interval': 0.001,
+                'profile_cpu_limit': 3,
+            }
+        )
+
+        assert check.run() == ''
+
+        aggregator.assert_metric('metric', count=1)
+        tags = ['check_name:test', 'check_version:{}'.format(check.check_version)]
+        aggregator.assert_metric('datadog.agent.profile.cpu.check_run_time', tags=tags, count=1)
+
+        functions = aggregator.metrics('datadog.agent.profile.cpu.function.cumulative_time')
+        assert 0 < len(functions) <= 5
+        for metric in functions:
+            assert metric.tags[:2] == tags
+            assert metric.tags[2].startswith('function:')
+
+        assert any('(busy)' in metric.tags[2] for metric in functions)
+        assert len(tmpdir.join('test', '123', directory).listdir()) == 1
+
+    def test_agent_toggle(self, aggregator):
+        def get_config(key):
+            return 'true' if key == 'cpu_profiling_enabled' else ''
+
+        check = self.get_check({})
+        with mock.patch('datadog_checks.base.stubs.datadog_agent.get_config', side_effect=get_config):
+            check.run()
+
+        aggregator.assert_metric('datadog.agent.profile.cpu.check_run_time', count=1)
+
+    def test_default_disabled(self, aggregator):
+        check = self.get_check({})
+        check.run()
+
+        aggregator.assert_metric('metric', count=1)
+        assert not aggregator.metrics('datadog.agent.profile.cpu.check_run_time')
+
+    def test_invalid_mode(self):
+        check = self.get_check({'profile_cpu': '', 'profile_cpu_mode': 'foo'})
+
+        assert 'Setting `profile_cpu_mode` must be one of' in check.run()
+
+
+class TestFrozenInstance:
+    def test_default_copy(self):
+        class TestCheck(AgentCheck):
+            def check(self, instance):
+                instance['tags'].append('foo:bar')
+                instance['new'] = True
+
+        instance = {'tags': ['baz:qux']}
+        check = TestCheck('test', {}, [instance])
+
+        assert check.run() == ''
+        assert check.run() == ''
+        assert instance == {'tags': ['baz:qux']}
+        assert check._frozen_instance is None
+
+    def test_frozen_reused(self):
+        instances = []
+
+        class TestCheck(AgentCheck):
+            FROZEN_INSTANCE = True
+
+            def check(self, instance):
+                instances.append(instance)
+
+        instance = {'tags': ['baz:qux'], 'nested': {'foo': [{'bar': 'baz'}]}}
+        check = TestCheck('test', {}, [instance])
+
+        assert check.run() == ''
+        assert check.run() == ''
+        assert instances[0] is instances[1]
+        assert instances[0] == instance
+        assert isinstance(instances[0], dict)
+        assert json.loads(json.dumps(instances[0])) == instance
+
+    def test_frozen_built_after_initializations(self):
+        class TestCheck(AgentCheck):
+            FROZEN_INSTANCE = True
+
+            def __init__(self, *args, **kwargs):
+                super(TestCheck, self).__init__(*args, **kwargs)
+                self.check_initializations.append(self.set_default)
+
+            def set_default(self):
+                self.instance.setdefault('timeout', 10)
+
+            def check(self, instance):
+                self.gauge('timeout', instance['timeout'])
+
+        check = TestCheck('test', {}, [{}])
+        assert check.run() == ''
+        assert check._frozen_instance == {'timeout': 10}
+
+    @pytest.mark.parametrize(
+        'mutate',
+        [
+            pytest.param(lambda instance: instance.update(foo='bar'), id='update'),
+            pytest.param(lambda instance: instance.__setitem__('foo', 'bar'), id='setitem'),
+            pytest.param(lambda instance: instance['tags'].append('foo:bar'), id='nested list'),
+            pytest.param(lambda instance: instance['nested'].pop('foo'), id='nested dict'),
+        ],
+    )
+    def test_frozen_mutation(self, mutate):
+        class TestCheck(AgentCheck):
+            FROZEN_INSTANCE = True
+
+            def check(self, instance):
+                mutate(instance)
+
+        instance = {'tags': ['baz:qux'], 'nested': {'foo': 'bar'}}
+        check = TestCheck('test', {}, [instance])
+
+        assert 'This object is read-only' in check.run()
+        assert instance == {'tags': ['baz:qux'], 'nested': {'foo': 'bar'}}
+
+    def test_frozen_copy(self):
+        class TestCheck(AgentCheck):
+            FROZEN_INSTANCE = True
+
+            def check(self, instance):
+                tags = instance['tags'] + ['foo:bar']
+                config = instance.copy()
+                config['tags'] = tags
+                self.gauge('metric', 0, tags=config['tags'])
+
+        check = TestCheck('test', {}, [{'tags': ['baz:qux']}])
+        assert check.run() == ''
+
+
 class LimitedCheck(AgentCheck):
     DEFAULT_METRIC_LIMIT = 10
 
@@ -640,6 +938,17 @@ class TestLimits:
         assert uid != check._context_uid(aggregator.GAUGE, "test.metric", ["two"], None)
         assert uid != check._context_uid(aggregator.GAUGE, "test.metric", ["one", "two"], "host")
 
+    def test_context_hash(self, aggregator):
+        check = LimitedCheck()
+
+        context_hash = check._context_hash(aggregator.GAUGE, "test.metric", ["one", "two"], None)
+        assert context_hash == check._context_hash(aggregator.GAUGE, "test.metric", ["two", "one"], None)
+
+        assert context_hash != check._context_hash(aggregator.RATE, "test.metric", ["one", "two"], None)
+        assert context_hash != check._context_hash(aggregator.GAUGE, "test.metric2", ["one", "two"], None)
+        assert context_hash != check._context_hash(aggregator.GAUGE, "test.metric", ["two"], None)
+        assert context_hash != check._context_hash(aggregator.GAUGE, "test.metric", ["one", "two"], "host")
+
     def test_metric_limit_gauges(self, aggregator):
         check = LimitedCheck()
         assert check.get_warnings() == []
@@ -671,6 +980,22 @@ class TestLimits:
         assert len(check.get_warnings()) == 1
         assert len(aggregator.metrics("metric")) == 29
 
+    def test_metric_limit_batch(self, aggregator):
+        check = LimitedCheck()
+
+        check.submit_batch(aggregator.GAUGE, "metric", [0] * 20)
+        assert len(check.get_warnings()) == 1
+        assert len(aggregator.metrics("metric")) == 10
+
+    def test_metric_limit_batch_count(self, aggregator):
+        check = LimitedCheck()
+
+        # Repeated contexts do not count towards the limit
+        hostnames = ["host-{}".format(i % 5) for i in range(0, 20)] + ["host-{}".format(i) for i in range(5, 15)]
+        check.submit_batch(aggregator.COUNT, "metric", [0] * 30, hostnames=hostnames)
+        assert len(check.get_warnings()) == 1
+        assert len(aggregator.metrics("metric")) == 25
+
     def test_metric_limit_instance_config(self, aggregator):
         instances = [{"max_returned_metrics": 42}]
         check = AgentCheck("test", {}, instances)
@@ -737,6 +1062,172 @@ class TestLimits:
             check.gauge("metric", 0)
         assert len(aggregator.metrics("metric")) == 10
 
+    @pytest.mark.parametrize(
+        "init_config, instance, compact",
+        [
+            pytest.param({}, {}, False, id="default"),
+            pytest.param({}, {"compact_metric_limiter": True}, True, id="instance"),
+            pytest.param({"compact_metric_limiter": True}, {}, True, id="init_config"),
+            pytest.param({"compact_metric_limiter": True}, {"compact_metric_limiter": "false"}, False, id="override"),
+        ],
+    )
+    def test_compact_metric_limiter_config(self, init_config, instance, compact):
+        check = LimitedCheck("test", init_config, [instance])
+
+        assert check.metric_limiter.compact is compact
+
+    def test_compact_metric_limiter(self, aggregator):
+        check = LimitedCheck("test", {}, [{"compact_metric_limiter": True}])
+
+        hostnames = ["host-{}".format(i % 5) for i in range(0, 20)] + ["host-{}".format(i) for i in range(5, 15)]
+        check.submit_batch(aggregator.COUNT, "metric", [0] * 30, hostnames=hostnames)
+        for i in range(0, 20):
+            check.histogram("histogram", 0, hostname="host-{}".format(i))
+
+        assert len(check.get_warnings()) == 1
+        assert len(aggregator.metrics("metric")) == 25
+        assert len(aggregator.metrics("histogram")) == 0
+        assert all(isinstance(uid, int) for uid in check.metric_limiter.seen)
+
+
+class TestContextCardinality:
+    def test_default(self):
+        check = AgentCheck("test", {}, [{}])
+
+        assert check._context_cardinality is None
+
+    def test_config(self):
+        check = AgentCheck(
+            "test",
+            {"context_cardinality": True},
+            [{"context_cardinality_precision": 8}, {"context_cardinality": False}],
+        )
+
+        assert check._context_cardinality.precision == 8
+
+    @pytest.mark.parametrize("precision", ["foo", 2])
+    def test_invalid_precision(self, precision):
+        check = AgentCheck("test", {}, [{"context_cardinality": True, "context_cardinality_precision": precision}])
+
+        assert check._context_cardinality.precision == 12
+        assert len(check.get_warnings()) == 1
+
+    def test_metrics(self, aggregator):
+        class TestCheck(LimitedCheck):
+            def check(self, _):
+                for i in range(0, 20):
+                    self.gauge("metric", 0, tags=["tag:{}".format(i % 5)])
+                self.submit_batch(aggregator.COUNT, "count", [0] * 10, hostnames=["host"] * 10)
+                self.histogram("histogram", 0)
+
+        check = TestCheck("test", {}, [{"context_cardinality": True, "max_returned_metrics": 100}])
+        check.run()
+        check.run()
+
+        tags = ["check_name:test", "check_version:{}".format(check.check_version)]
+        aggregator.assert_metric("datadog.agent.profile.contexts.estimated", value=7, tags=tags, count=2)
+        aggregator.assert_metric("datadog.agent.profile.contexts.limit", value=100, tags=tags, count=2)
+
+    def test_metrics_not_limited(self, aggregator):
+        class TestCheck(LimitedCheck):
+            def check(self, _):
+                for i in range(0, 10):
+                    self.gauge("metric", 0, tags=["tag:{}".format(i)])
+
+        check = TestCheck("test", {}, [{"context_cardinality": True}])
+        check.run()
+        check.run()
+
+        # The metric limit is reached by the check, and the estimate only counts the metrics of the check
+        aggregator.assert_metric("metric", count=20)
+        aggregator.assert_metric("datadog.agent.profile.contexts.estimated", value=10, count=2)
+        aggregator.assert_metric("datadog.agent.profile.contexts.limit", value=10, count=2)
+
+    def test_no_limit(self, aggregator):
+        check = AgentCheck("test", {}, [{"context_cardinality": True}])
+        check.gauge("metric", 0)
+        check.run()
+
+        aggregator.assert_metric("datadog.agent.profile.contexts.estimated", value=1)
+        aggregator.assert_metric("datadog.agent.profile.contexts.limit", count=0)
+
+
+class TestTaskExecutor:
+    def test_default(self):
+        check = AgentCheck('test', {}, [{}])
+
+        assert check.task_executor is check.task_executor
+        assert check.task_executor.max_concurrency == 4
+
+    @pytest.mark.parametrize(
+        'init_config, instance, max_concurrency',
+        [
+            pytest.param({}, {'max_concurrent_tasks': 2}, 2, id='instance'),
+            pytest.param({'max_concurrent_tasks': 3}, {}, 3, id='init_config'),
+            pytest.param({'max_concurrent_tasks': 3}, {'max_concurrent_tasks': '2'}, 2, id='override'),
+        ],
+    )
+    def test_config(self, init_config, instance, max_concurrency):
+        check = AgentCheck('test', init_config, [instance])
+
+        assert check.task_executor.max_concurrency == max_concurrency
+
+    def test_cancel(self):
+        check = AgentCheck('test', {}, [{}])
+        check.cancel()
+
+        check.task_executor.submit(lambda: None).result(5)
+        check.cancel()
+
+        with pytest.raises(RuntimeError):
+            check.task_executor.submit(lambda: None)
+
+    def test_metrics(self, aggregator):
+        class TestCheck(AgentCheck):
+            def check(self, _):
+                list(self.task_executor.map(lambda x: x, range(3)))
+
+        check = TestCheck('test', {}, [{}])
+        check.run()
+
+        tags = ['check_name:test', 'check_version:{}'.format(check.check_version)]
+        aggregator.assert_metric('datadog.agent.profile.executor.tasks.submitted', value=3, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.executor.tasks.running', value=0, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.executor.tasks.latency.max', tags=tags)
+        assert check.task_executor.submitted == 0
+
+    def test_no_metrics_without_tasks(self, aggregator):
+        AgentCheck('test', {}, [{}]).run()
+
+        assert not [name for name in aggregator.metric_names if '.executor.' in name]
+
+    def test_metrics_only_for_runs_with_tasks(self, aggregator):
+        tasks_per_run = [3, 0]
+
+        class TestCheck(LimitedCheck):
+            def check(self, _):
+                list(self.task_executor.map(lambda x: x, range(tasks_per_run.pop(0))))
+
+        check = TestCheck('test', {}, [{}])
+        check.run()
+        check.run()
+
+        # Only the first run submitted tasks, and its stats were limited along with its metrics
+        aggregator.assert_metric('datadog.agent.profile.executor.tasks.submitted', value=3, count=1)
+        assert check.metric_limiter.count == 0
+
+
+class TestPersistentCache:
+    def test_read_write(self, datadog_agent):
+        check = AgentCheck('test', {}, [{}])
+        check.check_id = 'test:123'
+
+        assert check.read_persistent_cache('foo') == ''
+
+        check.write_persistent_cache('foo', 'bar')
+        assert check.read_persistent_cache('foo') == 'bar'
+        assert datadog_agent.read_persistent_cache('test:123_foo') == 'bar'
+
 
 class TestCheckInitializations:
     def test_default(self):
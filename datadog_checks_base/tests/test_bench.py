@@ -0,0 +1,158 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import copy
+import io
+import logging
+import os
+import re
+
+import mock
+import pytest
+import requests
+
+from datadog_checks.base import AgentCheck, OpenMetricsBaseCheck
+from datadog_checks.base.stubs.aggregator import AggregatorStub
+from datadog_checks.base.utils.containers import mutable_copy
+from datadog_checks.base.utils.db import Query, QueryManager
+from datadog_checks.base.utils.tailfile import TailFile
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'prometheus')
+
+
+def response(payload):
+    res = requests.Response()
+    res.status_code = 200
+    res.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    res.raw = io.BytesIO(payload)
+    return res
+
+
+@pytest.mark.parametrize('parse_as_bytes', [False, True], ids=['lines', 'bytes'])
+@pytest.mark.parametrize('fixture', ['ksm.txt', 'metrics.txt'])
+def test_parse_payload(benchmark, fixture, parse_as_bytes):
+    with open(os.path.join(FIXTURES_DIR, fixture), 'rb') as f:
+        payload = f.read()
+
+    instance = {
+        'prometheus_url': 'http://fake.endpoint:10055/metrics',
+        'namespace': 'bench',
+        'metrics': ['*'],
+        'parse_as_bytes': parse_as_bytes,
+    }
+    check = OpenMetricsBaseCheck('bench', {}, [instance])
+    scraper_config = check.get_scraper_config(instance)
+
+    def parse():
+        for _ in check.parse_metric_family(response(payload), scraper_config):
+            pass
+
+    benchmark(parse)
+
+
+def large_instance(fixture):
+    with open(os.path.join(FIXTURES_DIR, fixture), 'r') as f:
+        metric_names = sorted(set(re.findall(r'^# TYPE (\S+)', f.read(), re.M)))
+
+    return {
+        'prometheus_url': 'http://fake.endpoint:10055/metrics',
+        'namespace': 'bench',
+        'metrics': [{name: name.replace('_', '.')} for name in metric_names],
+        'label_joins': {name: {'labels_to_match': ['pod'], 'labels_to_get': ['node']} for name in metric_names},
+        'tags': ['env:bench', 'team:agent'],
+    }
+
+
+@pytest.mark.parametrize('mode', ['deepcopy', 'copy', 'frozen'])
+@pytest.mark.parametrize('fixture', ['ksm.txt', 'metrics.txt'])
+def test_run_instance(benchmark, fixture, mode):
+    class InstanceCheck(OpenMetricsBaseCheck):
+        FROZEN_INSTANCE = mode == 'frozen'
+
+        def check(self, instance):
+            pass
+
+    instance = large_instance(fixture)
+    check = InstanceCheck('bench', {}, [instance])
+
+    if mode == 'deepcopy':
+        # The copy that was made every run before `mutable_copy`
+        with mock.patch('datadog_checks.base.checks.base.mutable_copy', copy.deepcopy):
+            benchmark(check.run)
+    else:
+        benchmark(check.run)
+
+
+def test_mutable_copy_equals_deepcopy():
+    instance = large_instance('ksm.txt')
+
+    assert mutable_copy(instance) == copy.deepcopy(instance)
+
+
+def test_query_manager_execute(benchmark):
+    rows = [['db{}'.format(i % 10), 'table{}'.format(i), i, i * 2, i * 3] for i in range(5000)]
+    check = AgentCheck('test', {}, [{}])
+    query_manager = QueryManager(
+        check,
+        lambda _: rows,
+        [
+            Query(
+                {
+                    'name': 'tables',
+                    'query': 'foo',
+                    'columns': [
+                        {'name': 'db', 'type': 'tag'},
+                        {'name': 'table', 'type': 'tag'},
+                        {'name': 'rows', 'type': 'gauge'},
+                        {'name': 'reads', 'type': 'monotonic_count'},
+                        {'name': 'writes', 'type': 'monotonic_count'},
+                    ],
+                }
+            )
+        ],
+        tags=['server:localhost'],
+    )
+    query_manager.compile_queries()
+
+    benchmark(query_manager.execute)
+
+
+@pytest.mark.parametrize('mode', ['line', 'batch'])
+def test_tail_file(benchmark, tmpdir, mode):
+    num_lines = 100000
+    path = str(tmpdir.join('perfdata.log'))
+    with open(path, 'w') as f:
+        for i in range(num_lines):
+            f.write('[{}] SERVICE PERFDATA;host{};service{};time=0.1s;;;0.0 size=1234B;;;0\n'.format(i, i % 10, i))
+
+    def tail():
+        lines = []
+        tail_file = TailFile(logging.getLogger(__name__), path, lines.append)
+        if mode == 'line':
+            gen = tail_file.tail(line_by_line=True, move_end=False)
+        else:
+            gen = tail_file.tail_batches(move_end=False)
+
+        next(gen)
+        gen.close()
+        return lines
+
+    assert len(benchmark(tail)) == num_lines
+    benchmark.extra_info['lines_per_second'] = num_lines / benchmark.stats.stats.mean
+
+
+@pytest.mark.parametrize('compact', [False, True], ids=['default', 'compact'])
+def test_aggregator_assert_metric(benchmark, compact):
+    aggregator = AggregatorStub(compact=compact)
+    check = AgentCheck('test', {}, [{}])
+    for i in range(50000):
+        aggregator.submit_metric(
+            check, 'test', aggregator.GAUGE, 'metric{}'.format(i % 10), i, ['pod:{}'.format(i), 'env:prod'], ''
+        )
+
+    def assert_metrics():
+        for i in range(0, 50000, 500):
+            aggregator.assert_metric('metric{}'.format(i % 10), value=i, tags=['env:prod', 'pod:{}'.format(i)])
+        aggregator.assert_no_duplicate_metrics()
+
+    benchmark(assert_metrics)
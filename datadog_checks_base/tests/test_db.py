@@ -2,6 +2,7 @@
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
 import logging
+import threading
 from datetime import datetime, timedelta
 
 import pytest
@@ -10,6 +11,7 @@ import pytz
 from datadog_checks.base import AgentCheck
 from datadog_checks.base.stubs.aggregator import AggregatorStub
 from datadog_checks.base.utils.db import Query, QueryManager
+from datadog_checks.base.utils.db.core import iter_batches
 
 pytestmark = pytest.mark.db
 
@@ -120,6 +122,23 @@ class TestQueryCompilation:
         with pytest.raises(ValueError, match='^field `tags` for test query must be a list$'):
             query_manager.compile_queries()
 
+    @pytest.mark.parametrize('collection_interval', ['60', True], ids=['string', 'boolean'])
+    def test_collection_interval_not_number(self, collection_interval):
+        query_manager = create_query_manager(
+            {'name': 'test query', 'query': 'foo', 'columns': [{}], 'collection_interval': collection_interval}
+        )
+
+        with pytest.raises(ValueError, match='^field `collection_interval` for test query must be a number$'):
+            query_manager.compile_queries()
+
+    def test_collection_interval_not_positive(self):
+        query_manager = create_query_manager(
+            {'name': 'test query', 'query': 'foo', 'columns': [{}], 'collection_interval': 0}
+        )
+
+        with pytest.raises(ValueError, match='^field `collection_interval` for test query must be a positive number$'):
+            query_manager.compile_queries()
+
     def test_column_not_dict(self):
         query_manager = create_query_manager(
             {'name': 'test query', 'query': 'foo', 'columns': [['column']], 'tags': ['test:bar']}
@@ -1185,6 +1204,319 @@ class TestSubmission:
         aggregator.assert_all_metrics_covered()
 
 
+class TestRowProcessing:
+    def test_iter_batches_list(self):
+        rows = [[1], [2], [3]]
+
+        assert list(iter_batches(rows, 2)) == [rows]
+        assert list(iter_batches([], 2)) == []
+
+    def test_iter_batches_iterator(self):
+        assert list(iter_batches(iter([[1], [2], [3]]), 2)) == [[[1], [2]], [[3]]]
+        assert list(iter_batches(iter([]), 2)) == []
+
+    def test_batch_size(self, aggregator):
+        def executor(_):
+            for i in range(5):
+                yield [i, 'tag{}'.format(i % 2)]
+
+        query_manager = create_query_manager(
+            {
+                'name': 'test query',
+                'query': 'foo',
+                'columns': [{'name': 'test.foo', 'type': 'gauge'}, {'name': 'tag', 'type': 'tag'}],
+                'tags': ['test:bar'],
+            },
+            executor=executor,
+            batch_size=2,
+            tags=['test:foo'],
+        )
+        query_manager.compile_queries()
+        query_manager.execute()
+
+        for i in range(5):
+            aggregator.assert_metric(
+                'test.foo', i, metric_type=aggregator.GAUGE, tags=['test:foo', 'test:bar', 'tag:tag{}'.format(i % 2)]
+            )
+        aggregator.assert_all_metrics_covered()
+
+    def test_plan(self):
+        query_manager = create_query_manager(
+            {
+                'name': 'test query',
+                'query': 'foo',
+                'columns': [
+                    {'name': 'tag', 'type': 'tag'},
+                    None,
+                    {'name': 'test.foo', 'type': 'gauge'},
+                    {'name': 'test.bar', 'type': 'source'},
+                ],
+            }
+        )
+        query_manager.compile_queries()
+        processor = query_manager.queries[0].processor
+
+        assert processor.num_columns == 4
+        assert [index for index, _ in processor.tag_columns] == [0]
+        assert [index for index, _ in processor.submission_columns] == [2]
+        assert processor.source_columns is None
+
+    @pytest.mark.parametrize(
+        'query_data',
+        [
+            pytest.param(
+                {'extras': [{'name': 'test.baz', 'expression': 'test.foo + test.bar', 'submit_type': 'gauge'}]},
+                id='extras',
+            ),
+            pytest.param(
+                {
+                    'columns': [
+                        {'name': 'test.foo', 'type': 'source'},
+                        {'name': 'test.bar', 'type': 'source'},
+                        {
+                            'name': 'test.baz',
+                            'type': 'match',
+                            'source': 'test.foo',
+                            'items': {'foo': {'name': 'test.foo', 'type': 'gauge'}},
+                        },
+                    ]
+                },
+                id='match',
+            ),
+        ],
+    )
+    def test_plan_sources(self, query_data):
+        query = {
+            'name': 'test query',
+            'query': 'foo',
+            'columns': [{'name': 'test.foo', 'type': 'source'}, {'name': 'test.bar', 'type': 'source'}],
+        }
+        query.update(query_data)
+        query_manager = create_query_manager(query)
+        query_manager.compile_queries()
+
+        assert [name for _, name in query_manager.queries[0].processor.source_columns] == [
+            column['name'] for column in query['columns']
+        ]
+
+
+class Timer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduling:
+    @staticmethod
+    def create_query_manager(*queries, **kwargs):
+        calls = []
+
+        def executor(query):
+            calls.append(query)
+            return [[len(calls)]]
+
+        query_manager = create_query_manager(
+            *[
+                dict(
+                    {'name': name, 'query': name, 'columns': [{'name': 'test.{}'.format(name), 'type': 'gauge'}]},
+                    **data
+                )
+                for name, data in queries
+            ],
+            executor=executor,
+            **kwargs
+        )
+        query_manager.scheduler.timer = Timer()
+        query_manager.compile_queries()
+
+        return query_manager, calls
+
+    @staticmethod
+    def run(query_manager, now):
+        query_manager.scheduler.timer.now = now
+        query_manager.execute()
+
+    def test_collection_interval(self, aggregator):
+        query_manager, calls = self.create_query_manager(('foo', {}), ('bar', {'collection_interval': 60}))
+
+        for now in (0, 15, 30, 45, 60, 75):
+            self.run(query_manager, now)
+
+        assert calls == ['foo', 'bar', 'foo', 'foo', 'foo', 'foo', 'bar', 'foo']
+        aggregator.assert_metric('test.bar', count=2)
+        aggregator.assert_metric('test.foo', count=6)
+
+    def test_jitter(self):
+        query_manager, calls = self.create_query_manager(('foo', {'collection_interval': 30}))
+
+        for now in (0, 15.2, 29.9, 45.1, 60.3):
+            self.run(query_manager, now)
+
+        assert calls == ['foo', 'foo', 'foo']
+
+    def test_late_run(self):
+        query_manager, calls = self.create_query_manager(('foo', {'collection_interval': 30}))
+
+        for now in (0, 100, 105, 120):
+            self.run(query_manager, now)
+
+        # The phase is kept, so the query is due again at 120 rather than 130
+        assert calls == ['foo', 'foo', 'foo']
+
+    def test_spread(self):
+        query_manager, calls = self.create_query_manager(
+            ('foo', {'collection_interval': 60}),
+            ('bar', {'collection_interval': 60}),
+            ('baz', {'collection_interval': 60}),
+            ('qux', {'collection_interval': 60}),
+        )
+
+        runs = []
+        for now in (0, 15, 30, 45, 60):
+            self.run(query_manager, now)
+            runs.append(list(calls))
+            del calls[:]
+
+        assert runs == [['foo'], ['bar'], ['baz'], ['qux'], ['foo']]
+
+    def test_check_interval(self):
+        query_manager, calls = self.create_query_manager(
+            ('foo', {'collection_interval': 60}), check=AgentCheck('test', {}, [{'min_collection_interval': 30}])
+        )
+
+        for now in (0, 30, 59, 90):
+            self.run(query_manager, now)
+
+        assert calls == ['foo', 'foo']
+
+    def test_cache_results(self, aggregator):
+        query_manager, calls = self.create_query_manager(('foo', {'collection_interval': 60, 'cache_results': True}))
+
+        for now in (0, 15, 30):
+            self.run(query_manager, now)
+
+        assert calls == ['foo']
+        aggregator.assert_metric('test.foo', 1, count=3)
+        aggregator.assert_all_metrics_covered()
+
+    def test_cache_results_error(self, aggregator):
+        query_manager, calls = self.create_query_manager(('foo', {'collection_interval': 30, 'cache_results': True}))
+
+        self.run(query_manager, 0)
+
+        def executor(_):
+            raise ValueError('no result set')
+
+        query_manager.executor = executor
+        for now in (30, 45):
+            self.run(query_manager, now)
+
+        aggregator.assert_metric('test.foo', 1, count=1)
+        aggregator.assert_all_metrics_covered()
+
+
+class TestConcurrentExecution:
+    @staticmethod
+    def create_queries(*names):
+        return [
+            {'name': name, 'query': name, 'columns': [{'name': 'test.{}'.format(name), 'type': 'gauge'}]}
+            for name in names
+        ]
+
+    def test_concurrent(self, aggregator):
+        second_started = threading.Event()
+        calls = []
+
+        def first_executor(query):
+            calls.append(('first', query))
+            assert second_started.wait(5), 'The queries did not run concurrently'
+            return [[1]]
+
+        def second_executor(query):
+            calls.append(('second', query))
+            second_started.set()
+            return [[2]]
+
+        query_manager = create_query_manager(
+            *self.create_queries('foo', 'bar'), executors=[first_executor, second_executor], tags=['test:foo']
+        )
+        query_manager.compile_queries()
+        query_manager.execute()
+
+        assert sorted(calls) == [('first', 'foo'), ('second', 'bar')]
+        assert query_manager.check.task_executor.submitted == 2
+        aggregator.assert_metric('test.foo', 1, metric_type=aggregator.GAUGE, tags=['test:foo'])
+        aggregator.assert_metric('test.bar', 2, metric_type=aggregator.GAUGE, tags=['test:foo'])
+        aggregator.assert_all_metrics_covered()
+
+    def test_more_queries_than_executors(self, aggregator):
+        query_manager = create_query_manager(
+            *self.create_queries('foo', 'bar', 'baz'), executors=[mock_executor([[1], [2]])]
+        )
+        query_manager.compile_queries()
+        query_manager.execute()
+
+        for name in ('foo', 'bar', 'baz'):
+            aggregator.assert_metric('test.{}'.format(name), 1, metric_type=aggregator.GAUGE)
+            aggregator.assert_metric('test.{}'.format(name), 2, metric_type=aggregator.GAUGE)
+        aggregator.assert_all_metrics_covered()
+
+    def test_query_execution_error(self, caplog, aggregator):
+        def executor(query):
+            if query == 'foo':
+                raise ValueError('no result set')
+            return [[1]]
+
+        query_manager = create_query_manager(
+            *self.create_queries('foo', 'bar'), executors=[executor, executor], error_handler=lambda s: s.upper()
+        )
+        query_manager.compile_queries()
+        query_manager.execute()
+
+        expected_message = 'Error querying foo: NO RESULT SET'
+        matches = [level for _, level, message in caplog.record_tuples if message == expected_message]
+
+        assert len(matches) == 1, 'Expected log with message: {}'.format(expected_message)
+        assert matches[0] == logging.ERROR
+
+        aggregator.assert_metric('test.bar', 1, metric_type=aggregator.GAUGE)
+        aggregator.assert_all_metrics_covered()
+
+
+class TestDebugMetrics:
+    @pytest.mark.parametrize('concurrent', [False, True], ids=['serial', 'concurrent'])
+    def test_debug_metrics(self, aggregator, concurrent):
+        executor = mock_executor([[1], [2], [3]])
+        query_manager = create_query_manager(
+            {'name': 'test query', 'query': 'foo', 'columns': [{'name': 'test.foo', 'type': 'gauge'}]},
+            check=AgentCheck('test', {}, [{'query_debug_metrics': True}]),
+            executor=executor,
+            executors=[executor] if concurrent else None,
+            tags=['test:foo'],
+        )
+        query_manager.compile_queries()
+        query_manager.execute()
+
+        tags = ['query:test query', 'test:foo']
+        aggregator.assert_metric('datadog.agent.profile.query.rows', 3, metric_type=aggregator.GAUGE, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.query.duration', metric_type=aggregator.GAUGE, tags=tags)
+        aggregator.assert_metric('test.foo', count=3)
+        aggregator.assert_all_metrics_covered()
+
+    def test_disabled(self, aggregator):
+        query_manager = create_query_manager(
+            {'name': 'test query', 'query': 'foo', 'columns': [{'name': 'test.foo', 'type': 'gauge'}]},
+            executor=mock_executor([[1]]),
+        )
+        query_manager.compile_queries()
+        query_manager.execute()
+
+        aggregator.assert_metric('test.foo', 1)
+        aggregator.assert_all_metrics_covered()
+
+
 class TestColumnTransformers:
     def test_tag_boolean(self, aggregator):
         query_manager = create_query_manager(
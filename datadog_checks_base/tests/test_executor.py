@@ -0,0 +1,221 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+from datadog_checks.base.checks.libs.thread_pool import SharedPool, TimeoutError
+from datadog_checks.base.utils.executor import CheckExecutor, SharedExecutor, get_shared_executor, iter_futures
+
+
+@pytest.fixture
+def shared_executor():
+    return SharedExecutor(max_workers=4)
+
+
+class Tracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.release = threading.Event()
+
+    def __call__(self, value):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        self.release.wait(5)
+
+        with self.lock:
+            self.running -= 1
+
+        return value
+
+
+class TestCheckExecutor:
+    def test_submit(self, shared_executor):
+        executor = CheckExecutor(shared_executor)
+
+        assert executor.submit(lambda x, y=0: x + y, 1, y=2).result(5) == 3
+
+    def test_exception(self, shared_executor):
+        executor = CheckExecutor(shared_executor)
+
+        with pytest.raises(ZeroDivisionError):
+            executor.submit(lambda: 1 / 0).result(5)
+
+    def test_map(self, shared_executor):
+        executor = CheckExecutor(shared_executor, max_concurrency=2)
+
+        assert list(executor.map(lambda x: x * 2, range(10))) == list(range(0, 20, 2))
+
+    def test_quota(self, shared_executor):
+        tracker = Tracker()
+        executor = CheckExecutor(shared_executor, max_concurrency=2)
+
+        fs = [executor.submit(tracker, i) for i in range(6)]
+        time.sleep(0.1)
+        stats = dict(executor.get_stats())
+
+        tracker.release.set()
+
+        assert [future.result(5) for future in fs] == list(range(6))
+        assert tracker.max_running == 2
+        assert stats['tasks.submitted'] == 6
+        assert stats['tasks.running'] == 2
+        assert stats['tasks.queued'] == 4
+        assert stats['shared.workers'] == 4
+
+    def test_quotas_are_per_check(self, shared_executor):
+        tracker = Tracker()
+        executors = [CheckExecutor(shared_executor, max_concurrency=1) for _ in range(3)]
+
+        fs = [executor.submit(tracker, i) for executor in executors for i in range(2)]
+        time.sleep(0.1)
+        tracker.release.set()
+        futures.wait(fs, 5)
+
+        assert tracker.max_running == 3
+
+    def test_cancel(self, shared_executor):
+        tracker = Tracker()
+        executor = CheckExecutor(shared_executor, max_concurrency=1)
+
+        fs = [executor.submit(tracker, i) for i in range(3)]
+        time.sleep(0.1)
+        executor.cancel()
+        tracker.release.set()
+
+        assert fs[0].result(5) == 0
+        assert fs[1].cancelled()
+        assert fs[2].cancelled()
+
+        with pytest.raises(RuntimeError, match='^cannot schedule new tasks after the check was cancelled$'):
+            executor.submit(tracker, 3)
+
+    def test_latency(self, shared_executor):
+        executor = CheckExecutor(shared_executor, max_concurrency=1)
+
+        futures.wait([executor.submit(time.sleep, 0.05) for _ in range(2)], 5)
+        stats = dict(executor.get_stats())
+
+        assert stats['tasks.latency.max'] >= 0.04
+        assert 0 < stats['tasks.latency.avg'] <= stats['tasks.latency.max']
+
+        executor.reset()
+        stats = dict(executor.get_stats())
+        assert stats['tasks.submitted'] == 0
+        assert stats['tasks.latency.max'] == 0
+
+    def test_shared_executor_singleton(self):
+        assert get_shared_executor() is get_shared_executor()
+
+    def test_iter_futures(self):
+        executor = CheckExecutor(get_shared_executor(), 10)
+        event = threading.Event()
+        submitted = []
+
+        def submit(fn, *args):
+            submitted.append(args[0])
+            return CheckExecutor.submit(executor, fn, *args)
+
+        def task(x):
+            if x:
+                event.wait(5)
+            return x * 2
+
+        executor.submit = submit
+        pending = iter_futures(executor, task, range(5), 2)
+
+        # A task is only submitted once a future was consumed
+        assert next(pending).result(5) == 0
+        assert submitted == [0, 1]
+        second = next(pending)
+        assert submitted == [0, 1, 2]
+
+        pending.close()
+        event.set()
+        assert second.result(5) == 2
+        assert executor.submitted == 3
+
+
+class TestSharedPool:
+    def test_nworkers(self):
+        assert SharedPool(3).get_nworkers() == 3
+        assert SharedPool(1, executor=CheckExecutor(get_shared_executor(), 2)).get_nworkers() == 2
+
+    def test_apply(self):
+        pool = SharedPool(2)
+
+        assert pool.apply(lambda x, y: x + y, (1, 2)) == 3
+
+    def test_map(self):
+        pool = SharedPool(2)
+
+        assert pool.map(lambda x: x * 2, range(5)) == [0, 2, 4, 6, 8]
+        assert list(pool.imap(lambda x: x * 2, range(5))) == [0, 2, 4, 6, 8]
+        assert sorted(pool.imap_unordered(lambda x: x * 2, range(5))) == [0, 2, 4, 6, 8]
+
+    def test_async(self):
+        pool = SharedPool(2)
+        results = []
+
+        result = pool.map_async(lambda x: x * 2, range(3), callback=results.append)
+
+        assert result.get(5) == [0, 2, 4]
+        assert result.successful()
+        assert list(pool.imap_async(lambda x: x, range(3)).get(5)) == [0, 1, 2]
+        assert sorted(pool.imap_unordered_async(lambda x: x, range(3)).get(5)) == [0, 1, 2]
+
+        # Callbacks run after the result is set
+        for _ in range(50):
+            if results:
+                break
+            time.sleep(0.01)
+        assert results == [[0, 2, 4]]
+
+    def test_timeout(self):
+        pool = SharedPool(1)
+        event = threading.Event()
+
+        result = pool.apply_async(event.wait, (5,))
+        with pytest.raises(TimeoutError):
+            result.get(0.01)
+
+        assert not result.ready()
+        event.set()
+        assert result.get(5) is True
+
+    def test_exception(self):
+        pool = SharedPool(1)
+
+        result = pool.apply_async(lambda: 1 / 0)
+        result.wait(5)
+
+        assert result.successful() is False
+        with pytest.raises(ZeroDivisionError):
+            result.get()
+
+    def test_terminate(self):
+        pool = SharedPool(1)
+        started = threading.Event()
+        event = threading.Event()
+
+        def task():
+            started.set()
+            return event.wait(5)
+
+        first = pool.apply_async(task)
+        second = pool.apply_async(task)
+        started.wait(5)
+        pool.terminate()
+        event.set()
+        pool.join()
+
+        assert first.get() is True
+        assert second.ready()
+        assert dict(pool._executor.get_stats())['tasks.running'] == 0
@@ -1,8 +1,11 @@
 # (C) Datadog, Inc. 2019-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
+import json
 import logging
 import os
+import ssl
+import threading
 from collections import OrderedDict
 
 import mock
@@ -12,16 +15,23 @@ import requests_kerberos
 import requests_ntlm
 from aws_requests_auth import boto_utils as requests_aws
 from requests import auth as requests_auth
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectTimeout, ProxyError
-from six import iteritems
+from requests_toolbelt.adapters import host_header_ssl
+from six import PY3, iteritems
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
 from urllib3.exceptions import InsecureRequestWarning
 
 from datadog_checks.base import AgentCheck, ConfigurationError
-from datadog_checks.base.utils.http import STANDARD_FIELDS, RequestsWrapper
+from datadog_checks.base.utils.http import STANDARD_FIELDS, ConnectionPoolAdapter, RequestsWrapper
 from datadog_checks.dev import EnvVars
 from datadog_checks.dev.utils import running_on_windows_ci
 
-pytestmark = pytest.mark.http
+TLS_FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'tls')
+TLS_CERT = os.path.join(TLS_FIXTURES_DIR, 'server.crt')
+TLS_KEY = os.path.join(TLS_FIXTURES_DIR, 'server.key')
+
 
 DEFAULT_OPTIONS = {
     'auth': None,
@@ -923,6 +933,459 @@ class TestSession:
             assert getattr(http.session, key) == value
 
 
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.respond(self.path, headers={'ETag': '"v1"'})
+        elif self.path == '/consul':
+            self.respond(self.path, headers={'X-Consul-Index': '7'})
+        elif self.path == '/json':
+            self.respond(json.dumps({'items': [{'id': i} for i in range(100)]}))
+        else:
+            self.respond(self.path)
+
+    def do_POST(self):
+        self.server.requests.append('POST ' + self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.respond('POST ' + self.path)
+
+    def respond(self, body, headers=None):
+        if self.path.startswith('/status/'):
+            self.send_response(int(self.path.split('/')[2]))
+        else:
+            self.send_response(200)
+
+        for name, value in iteritems(headers or {}):
+            self.send_header(name, value)
+
+        body = body.encode('utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('localhost', 0), KeepAliveHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def keep_alive_server(http_server):
+    return 'http://localhost:{}'.format(http_server.server_address[1])
+
+
+@pytest.fixture
+def https_server():
+    server = ThreadingHTTPServer(('localhost', 0), KeepAliveHandler)
+    server.requests = []
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(TLS_CERT, TLS_KEY)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield 'https://localhost:{}'.format(server.server_address[1])
+
+    server.shutdown()
+    server.server_close()
+
+
+class TestConnectionPool:
+    def test_default(self):
+        http = RequestsWrapper({}, {})
+
+        assert http.persist_connections is False
+        assert http.pool_options == {}
+        assert http.connection_stats is None
+        assert type(http.session.get_adapter('https://www.google.com')) is HTTPAdapter
+
+    def test_persist_init_config(self):
+        http = RequestsWrapper({}, {'persist_connections': True})
+
+        assert http.persist_connections is True
+
+    def test_persist_instance_override(self):
+        http = RequestsWrapper({'persist_connections': False}, {'persist_connections': True})
+
+        assert http.persist_connections is False
+
+    def test_options(self):
+        instance = {
+            'connection_pool_size': 20,
+            'max_retries': 3,
+            'retry_backoff_factor': 0.5,
+            'retry_status_codes': [503],
+        }
+        http = RequestsWrapper(instance, {})
+
+        assert http.persist_connections is True
+
+        adapter = http.session.get_adapter('https://www.google.com')
+        assert isinstance(adapter, ConnectionPoolAdapter)
+        assert adapter._pool_maxsize == 20
+        assert adapter.max_retries.total == 3
+        assert adapter.max_retries.backoff_factor == 0.5
+        assert adapter.max_retries.status_forcelist == [503]
+        assert adapter.tls_sessions is None
+
+    def test_tls_use_host_header(self):
+        http = RequestsWrapper({'tls_use_host_header': True, 'headers': {'Host': 'foo'}, 'max_retries': 1}, {})
+
+        adapter = http.session.get_adapter('https://www.google.com')
+        assert isinstance(adapter, host_header_ssl.HostHeaderSSLAdapter)
+        assert isinstance(adapter, ConnectionPoolAdapter)
+
+    @pytest.mark.skipif(not PY3, reason='TLS session resumption requires Python 3.6')
+    def test_tls_session_resumption(self):
+        http = RequestsWrapper({'tls_session_resumption': True}, {})
+
+        assert http.session.get_adapter('https://www.google.com').tls_sessions == {}
+
+    @pytest.mark.skipif(not PY3, reason='TLS session resumption requires Python 3.6')
+    def test_tls_sessions_reused(self, https_server):
+        http = RequestsWrapper({'tls_session_resumption': True, 'tls_ca_cert': TLS_CERT, 'connection_stats': True}, {})
+
+        # The server closes every connection so each request needs a handshake
+        for _ in range(3):
+            assert http.get(https_server + '/close').status_code == 200
+
+        stats = dict(http.connection_stats.get_stats())
+        assert stats['tls.handshakes'] == 3
+        assert stats['tls.sessions_reused'] == 2
+        assert list(http.session.get_adapter(https_server).tls_sessions) == [
+            ('localhost', int(https_server.split(':')[-1]))
+        ]
+
+    @pytest.mark.skipif(not PY3, reason='TLS session resumption requires Python 3.6')
+    def test_tls_session_resumption_verifies_certificates(self, https_server):
+        http = RequestsWrapper({'tls_session_resumption': True}, {})
+
+        with pytest.raises(requests.exceptions.SSLError):
+            http.get(https_server)
+
+    @pytest.mark.skipif(not PY3, reason='TLS session resumption requires Python 3.6')
+    def test_tls_session_resumption_verifies_hostnames(self, https_server):
+        http = RequestsWrapper({'tls_session_resumption': True, 'tls_ca_cert': TLS_CERT}, {})
+
+        assert http.get(https_server).status_code == 200
+
+        # The certificate is only valid for `localhost`
+        with pytest.raises(requests.exceptions.SSLError):
+            http.get(https_server.replace('localhost', '127.0.0.1'))
+
+    @pytest.mark.skipif(not PY3, reason='TLS session resumption requires Python 3.6')
+    def test_tls_session_resumption_without_verification(self, https_server):
+        http = RequestsWrapper({'tls_session_resumption': True, 'tls_verify': False}, {})
+
+        assert http.get(https_server).status_code == 200
+
+    def test_connection_stats(self, keep_alive_server):
+        http = RequestsWrapper({'connection_stats': True}, {})
+
+        for _ in range(3):
+            http.get(keep_alive_server)
+        for _ in range(2):
+            http.get(keep_alive_server + '/close')
+
+        assert http.connection_stats.get_stats() == [
+            ('connections.new', 2),
+            ('connections.reused', 3),
+            ('tls.handshakes', 0),
+            ('tls.handshake_time', 0.0),
+            ('tls.sessions_reused', 0),
+        ]
+
+    def test_connection_stats_submitted(self, aggregator, keep_alive_server):
+        class TestCheck(AgentCheck):
+            DEFAULT_METRIC_LIMIT = 10
+
+            def check(self, _):
+                self.http.get(keep_alive_server)
+                self.http.get(keep_alive_server)
+
+        check = TestCheck('test', {}, [{'connection_stats': True}])
+        check.run()
+
+        # The stats are limited along with the metrics of the run, not with the ones of the next run
+        assert check.metric_limiter.count == 0
+
+        tags = ['check_name:test', 'check_version:{}'.format(check.check_version)]
+        aggregator.assert_metric('datadog.agent.profile.http.connections.new', value=1, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.http.connections.reused', value=1, tags=tags)
+        aggregator.assert_metric('datadog.agent.profile.http.tls.handshakes', value=0, tags=tags)
+        assert check.http.connection_stats.new_connections == 0
+
+
+class TestMap:
+    def test_order(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+        urls = ['{}/{}'.format(keep_alive_server, i) for i in range(20)]
+
+        responses = http.map(urls, concurrency=5)
+
+        assert [response.text for response in responses] == ['/{}'.format(i) for i in range(20)]
+
+    def test_check_task_executor(self, keep_alive_server):
+        check = AgentCheck('test', {}, [{}])
+        urls = ['{}/{}'.format(keep_alive_server, i) for i in range(10)]
+
+        responses = check.http.map(urls, concurrency=5)
+
+        assert [response.text for response in responses] == ['/{}'.format(i) for i in range(10)]
+        assert check.task_executor.submitted == 10
+
+    def test_connection_stats(self, keep_alive_server):
+        http = RequestsWrapper({'connection_stats': True}, {})
+        urls = ['{}/{}'.format(keep_alive_server, i) for i in range(50)]
+
+        http.map(urls, concurrency=5)
+
+        # Every request either opens a connection or reuses one, whatever the order the requests run in
+        stats = dict(http.connection_stats.get_stats())
+        assert stats['connections.new'] + stats['connections.reused'] == 50
+        assert 1 <= stats['connections.new'] <= 5
+
+    def test_grows_connection_pool(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+
+        http.map([keep_alive_server] * 2, concurrency=20)
+        adapter = http.session.get_adapter(keep_alive_server)
+        assert adapter._pool_maxsize == 10
+
+        poolmanager = adapter.poolmanager
+        assert len(poolmanager.pools) == 1
+
+        http.map([keep_alive_server] * 20, concurrency=20)
+        assert adapter._pool_maxsize == 20
+
+        # The connections of the previous pools are closed
+        assert len(poolmanager.pools) == 0
+
+    def test_spec(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+
+        responses = http.map(
+            [
+                keep_alive_server + '/foo',
+                {'url': keep_alive_server + '/bar', 'method': 'POST', 'data': 'baz'},
+                {'url': keep_alive_server + '/qux', 'params': {'page': 2}},
+            ],
+            concurrency=2,
+        )
+
+        assert [response.text for response in responses] == ['/foo', 'POST /bar', '/qux?page=2']
+
+    def test_options(self):
+        http = RequestsWrapper({}, {})
+        options = http.options.copy()
+        options['timeout'] = 1
+
+        with mock.patch('datadog_checks.base.utils.http.RequestsWrapper.session'):
+            http.map(['https://www.google.com', {'url': 'https://www.google.com', 'timeout': 2}], timeout=1)
+
+            assert http.session.get.call_args_list == [
+                mock.call('https://www.google.com', **options),
+                mock.call('https://www.google.com', **dict(options, timeout=2)),
+            ]
+
+    def test_not_persistent(self):
+        http = RequestsWrapper({}, {})
+
+        with mock.patch('requests.get'):
+            http.map(['https://www.google.com'], persist=False)
+            requests.get.assert_called_once_with('https://www.google.com', **http.options)
+
+    def test_unsupported_method(self):
+        http = RequestsWrapper({}, {})
+
+        with pytest.raises(ValueError, match='Unsupported HTTP method `options`'):
+            http.map([{'url': 'https://www.google.com', 'method': 'options'}])
+
+    def test_errors(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+        urls = [keep_alive_server, 'http://localhost:0', keep_alive_server]
+
+        with pytest.raises(requests.exceptions.ConnectionError):
+            http.map(urls, concurrency=3)
+
+        responses = http.map(urls, concurrency=3, return_exceptions=True)
+        assert responses[0].status_code == 200
+        assert isinstance(responses[1], requests.exceptions.ConnectionError)
+        assert responses[2].status_code == 200
+
+    @pytest.mark.skipif(not PY3, reason='TLS session resumption requires Python 3.6')
+    def test_grows_connection_pool_tls_session_resumption(self, https_server):
+        http = RequestsWrapper({'tls_session_resumption': True, 'tls_ca_cert': TLS_CERT}, {})
+
+        for _ in range(3):
+            assert http.get(https_server + '/close').status_code == 200
+
+        responses = http.map([https_server] * 12, concurrency=12, return_exceptions=True)
+
+        assert [getattr(response, 'status_code', response) for response in responses] == [200] * 12
+        assert http.session.get_adapter(https_server)._pool_maxsize == 12
+
+    def test_hooks_entered_once(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+        hook = mock.MagicMock()
+        http.request_hooks.append(hook)
+
+        http.map([keep_alive_server] * 5, concurrency=5)
+
+        hook.assert_called_once_with()
+
+
+class TestResponseCache:
+    def test_default(self):
+        http = RequestsWrapper({}, {})
+
+        assert http.response_cache is None
+
+    def test_config(self):
+        http = RequestsWrapper({'response_cache': True, 'response_cache_ttl': 30, 'response_cache_max_size': 5}, {})
+
+        assert http.response_cache.ttl == 30
+        assert http.response_cache.entries.max_size == 5
+
+    def test_ttl(self, http_server, keep_alive_server):
+        http = RequestsWrapper({'response_cache': True, 'response_cache_ttl': 60}, {})
+
+        first = http.get(keep_alive_server + '/foo')
+        second = http.get(keep_alive_server + '/foo')
+        http.get(keep_alive_server + '/foo', params={'bar': 'baz'})
+        http.get(keep_alive_server + '/foo', extra_headers={'Accept': 'application/json'})
+
+        assert first.from_cache is False
+        assert second.from_cache is True
+        assert second.text == '/foo'
+        assert http_server.requests == ['/foo', '/foo?bar=baz', '/foo']
+
+    def test_digest_auth(self, http_server, keep_alive_server):
+        http = RequestsWrapper(
+            {
+                'response_cache': True,
+                'response_cache_ttl': 60,
+                'auth_type': 'digest',
+                'username': 'user',
+                'password': 'pass',
+            },
+            {},
+        )
+
+        first = http.get(keep_alive_server + '/foo')
+        second = http.get(keep_alive_server + '/foo')
+
+        assert first.from_cache is False
+        assert second.from_cache is True
+        assert http_server.requests == ['/foo']
+
+    def test_key_auth_user(self):
+        http = RequestsWrapper({'response_cache': True}, {})
+        options = {'headers': {}}
+
+        key = http.response_cache.get_key('http://foo', dict(options, auth=requests_auth.HTTPDigestAuth('a', 'p')))
+
+        assert key == http.response_cache.get_key(
+            'http://foo', dict(options, auth=requests_auth.HTTPDigestAuth('a', 'p'))
+        )
+        assert key != http.response_cache.get_key(
+            'http://foo', dict(options, auth=requests_auth.HTTPDigestAuth('b', 'p'))
+        )
+        assert key != http.response_cache.get_key('http://foo', dict(options, auth=('a', 'p')))
+
+    def test_expired_without_validators(self, http_server, keep_alive_server):
+        http = RequestsWrapper({'response_cache': True}, {})
+
+        http.get(keep_alive_server + '/foo')
+        response = http.get(keep_alive_server + '/foo')
+
+        assert response.from_cache is False
+        assert http_server.requests == ['/foo', '/foo']
+
+    def test_etag(self, http_server, keep_alive_server):
+        http = RequestsWrapper({'response_cache': True}, {})
+
+        http.get(keep_alive_server + '/etag')
+        response = http.get(keep_alive_server + '/etag')
+
+        assert response.from_cache is True
+        assert response.status_code == 200
+        assert response.text == '/etag'
+        assert len(http_server.requests) == 2
+        assert 'If-None-Match' not in http.options['headers']
+
+    def test_consul_index(self, http_server, keep_alive_server):
+        http = RequestsWrapper({'response_cache': True}, {})
+
+        http.get(keep_alive_server + '/consul')
+        response = http.get(keep_alive_server + '/consul')
+
+        assert response.from_cache is True
+        assert len(http_server.requests) == 2
+
+    def test_only_successful_get_requests(self, http_server, keep_alive_server):
+        http = RequestsWrapper({'response_cache': True, 'response_cache_ttl': 60}, {})
+
+        for _ in range(2):
+            http.get(keep_alive_server + '/status/500')
+            http.post(keep_alive_server + '/foo')
+
+        assert http_server.requests == ['/status/500', 'POST /foo', '/status/500', 'POST /foo']
+
+    def test_max_size(self, http_server, keep_alive_server):
+        http = RequestsWrapper({'response_cache': True, 'response_cache_ttl': 60, 'response_cache_max_size': 1}, {})
+
+        for path in ('/foo', '/bar', '/foo'):
+            http.get(keep_alive_server + path)
+
+        assert http_server.requests == ['/foo', '/bar', '/foo']
+
+
+class TestStreamJSON:
+    def test_items(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+
+        items = list(http.stream_json(keep_alive_server + '/json', 'items.*', chunk_size=16))
+
+        assert items == [(i, {'id': i}) for i in range(100)]
+
+    def test_error_status(self, keep_alive_server):
+        http = RequestsWrapper({}, {})
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            list(http.stream_json(keep_alive_server + '/status/500', 'items.*'))
+
+
 class TestRemapper:
     def test_legacy_no_proxy(self):
         instance = {'no_proxy': True}
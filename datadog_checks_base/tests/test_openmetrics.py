@@ -4,24 +4,34 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 import copy
+import fnmatch
 import io
 import logging
 import math
 import os
+import re
+import threading
+import time
 
 import mock
 import pytest
 import requests
+from google.protobuf.internal.encoder import _VarintBytes  # pylint: disable=E0611,E0401
 from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily, SummaryMetricFamily
 from prometheus_client.samples import Sample
 from six import iteritems
 from urllib3.exceptions import InsecureRequestWarning
 
 from datadog_checks.base import ensure_bytes
+from datadog_checks.base.checks.libs.prometheus import bytes_to_metric_families, protobuf_to_metric_families
+from datadog_checks.base.checks.openmetrics.label_joins import LabelJoinIndex
+from datadog_checks.base.utils.lru import LRUCache
+from datadog_checks.base.utils.prometheus import metrics_pb2
 from datadog_checks.checks.openmetrics import OpenMetricsBaseCheck
 from datadog_checks.dev import get_here
 
 text_content_type = 'text/plain; version=0.0.4'
+protobuf_content_type = 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited'
 
 
 class MockResponse:
@@ -38,6 +48,9 @@ class MockResponse:
         for elt in self.content.split("\n"):
             yield elt
 
+    def iter_content(self, **_):
+        yield ensure_bytes(self.content)
+
     def close(self):
         pass
 
@@ -1385,6 +1398,47 @@ def test_decumulate_histogram_buckets_no_buckets(p_check, mocked_prometheus_scra
     assert sorted(expected_metric.samples, key=lambda i: i[0]) == sorted(current_metric.samples, key=lambda i: i[0])
 
 
+def test_decumulate_histogram_buckets_cached_bounds(p_check, mocked_prometheus_scraper_config):
+    text_data = (
+        '# HELP rest_client_request_latency_seconds Request latency in seconds. Broken down by verb and URL.\n'
+        '# TYPE rest_client_request_latency_seconds histogram\n'
+        'rest_client_request_latency_seconds_bucket{verb="GET",le="0.002"} 621\n'
+        'rest_client_request_latency_seconds_bucket{verb="GET",le="0.001"} 254\n'
+        'rest_client_request_latency_seconds_bucket{verb="GET",le="+Inf"} 755\n'
+        'rest_client_request_latency_seconds_bucket{verb="POST",le="0.002"} 20\n'
+        'rest_client_request_latency_seconds_bucket{verb="POST",le="0.001"} 10\n'
+        'rest_client_request_latency_seconds_bucket{verb="POST",le="+Inf"} 30\n'
+    )
+    expected_samples = [
+        Sample(
+            'rest_client_request_latency_seconds_bucket', {'verb': 'GET', 'le': '0.002', 'lower_bound': '0.001'}, 367.0
+        ),
+        Sample('rest_client_request_latency_seconds_bucket', {'verb': 'GET', 'le': '0.001', 'lower_bound': '0'}, 254.0),
+        Sample(
+            'rest_client_request_latency_seconds_bucket', {'verb': 'GET', 'le': '+Inf', 'lower_bound': '0.002'}, 134.0
+        ),
+        Sample(
+            'rest_client_request_latency_seconds_bucket', {'verb': 'POST', 'le': '0.002', 'lower_bound': '0.001'}, 10.0
+        ),
+        Sample('rest_client_request_latency_seconds_bucket', {'verb': 'POST', 'le': '0.001', 'lower_bound': '0'}, 10.0),
+        Sample(
+            'rest_client_request_latency_seconds_bucket', {'verb': 'POST', 'le': '+Inf', 'lower_bound': '0.002'}, 10.0
+        ),
+    ]
+
+    for _ in range(2):
+        response = MockResponse(text_data, text_content_type)
+        metric = next(p_check.parse_metric_family(response, mocked_prometheus_scraper_config))
+        p_check._decumulate_histogram_buckets(metric, mocked_prometheus_scraper_config)
+
+        assert metric.samples == expected_samples
+
+    # Both contexts share the same boundaries, which are only computed once
+    assert mocked_prometheus_scraper_config['_bucket_bounds'] == {
+        'rest_client_request_latency_seconds': {('0.002', '0.001', '+Inf'): ((1, '0'), (0, '0.001'), (2, '0.002'))}
+    }
+
+
 def test_parse_one_summary(p_check, mocked_prometheus_scraper_config):
     """
     name: "http_response_size_bytes"
@@ -2057,6 +2111,118 @@ def test_label_joins(aggregator, mocked_prometheus_check, mocked_prometheus_scra
     )
 
 
+def test_label_joins_without_dry_run(aggregator, mocked_prometheus_check, mocked_prometheus_scraper_config, mock_get):
+    """ Tests that metrics are joined with labels exposed after them from the first scrape """
+    check = mocked_prometheus_check
+    mocked_prometheus_scraper_config['namespace'] = 'ksm'
+    mocked_prometheus_scraper_config['label_joins_dry_run'] = False
+    mocked_prometheus_scraper_config['label_joins'] = {
+        'kube_pod_info': {'label_to_match': 'pod', 'labels_to_get': ['node']},
+        'kube_pod_labels': {'labels_to_match': ['pod', 'namespace'], 'labels_to_get': ['*']},
+    }
+    mocked_prometheus_scraper_config['metrics_mapper'] = {
+        'kube_pod_status_ready': 'pod.ready',
+        'kube_pod_info': 'pod.info',
+    }
+
+    check.process(mocked_prometheus_scraper_config)
+
+    aggregator.assert_metric(
+        'ksm.pod.ready',
+        1.0,
+        tags=[
+            'pod:fluentd-gcp-v2.0.9-6dj58',
+            'namespace:kube-system',
+            'condition:true',
+            'node:gke-foobar-test-kube-default-pool-9b4ff111-0kch',
+            'label_k8s_app:fluentd-gcp',
+            'label_kubernetes_io_cluster_service:true',
+            'label_pod_template_generation:1',
+            'label_version:v2.0.9',
+            'label_controller_revision_hash:3483772856',
+        ],
+        count=1,
+    )
+    aggregator.assert_metric('ksm.pod.info', count=15)
+
+
+def test_label_join_index_generations():
+    label_join_index = LabelJoinIndex(
+        {'kube_pod_info': {'labels_to_match': ['pod', 'namespace'], 'labels_to_get': ['node']}}
+    )
+    key = ('namespace', 'pod')
+
+    def pod_info(*pods):
+        metric = GaugeMetricFamily('kube_pod_info', 'Pod info', labels=['pod', 'namespace', 'node'])
+        for pod in pods:
+            metric.add_metric([pod, 'default', 'node-1'], 1)
+        return metric
+
+    def pod_ready(*pods):
+        metric = GaugeMetricFamily('kube_pod_status_ready', 'Pod ready', labels=['pod', 'namespace'])
+        for pod in pods:
+            metric.add_metric([pod, 'default'], 1)
+        return metric
+
+    label_join_index.store(pod_info('a', 'b'))
+    assert label_join_index.mapping(key) == {('default', 'a'): {'node': 'node-1'}, ('default', 'b'): {'node': 'node-1'}}
+    label_join_index.expire()
+
+    # Only `a` is used during the second run
+    metric = pod_ready('a')
+    label_join_index.join(metric)
+    assert metric.samples[0].labels == {'pod': 'a', 'namespace': 'default', 'node': 'node-1'}
+    label_join_index.expire()
+    assert list(label_join_index.mapping(key)) == [('default', 'a')]
+
+    # Metrics without the labels to match are left untouched
+    metric = GaugeMetricFamily('kube_node_info', 'Node info', labels=['node'])
+    metric.add_metric(['node-1'], 1)
+    assert not label_join_index.needs_join(metric)
+    label_join_index.join(metric)
+    assert metric.samples[0].labels == {'node': 'node-1'}
+
+    label_join_index.expire()
+    assert label_join_index.mapping(key) == {}
+
+
+def test_label_join_index_new_labels():
+    label_join_index = LabelJoinIndex(
+        {
+            'kube_pod_info': {'labels_to_match': ['pod'], 'labels_to_get': ['node']},
+            'kube_deployment_labels': {'labels_to_match': ['deployment'], 'labels_to_get': ['label_app']},
+        }
+    )
+    pod_info = GaugeMetricFamily('kube_pod_info', 'Pod info', labels=['pod', 'node'])
+    pod_info.add_metric(['a', 'node-1'], 1)
+    deployment_labels = GaugeMetricFamily('kube_deployment_labels', 'Labels', labels=['deployment', 'label_app'])
+    deployment_labels.add_metric(['d', 'app'], 1)
+    label_join_index.store(pod_info)
+    label_join_index.store(deployment_labels)
+
+    def pod_ready(*label_names):
+        metric = GaugeMetricFamily('kube_pod_status_ready', 'Pod ready', labels=label_names)
+        metric.add_metric(['a', 'd'][: len(label_names)], 1)
+        return metric
+
+    # The labels to match only show up in the samples of later scrapes
+    assert not label_join_index.needs_join(pod_ready())
+
+    metric = pod_ready('pod')
+    assert label_join_index.needs_join(metric)
+    label_join_index.join(metric)
+    assert metric.samples[0].labels == {'pod': 'a', 'node': 'node-1'}
+
+    metric = pod_ready('pod', 'deployment')
+    label_join_index.join(metric)
+    assert metric.samples[0].labels == {'pod': 'a', 'deployment': 'd', 'node': 'node-1', 'label_app': 'app'}
+
+    # Keys applied once still apply to the samples that have their labels
+    metric = pod_ready('pod')
+    label_join_index.join(metric)
+    assert metric.samples[0].labels == {'pod': 'a', 'node': 'node-1'}
+
+
 def test_label_joins_gc(aggregator, mocked_prometheus_check, mocked_prometheus_scraper_config, mock_get):
     """ Tests label join GC on text format """
     check = mocked_prometheus_check
@@ -2096,16 +2262,17 @@ def test_label_joins_gc(aggregator, mocked_prometheus_check, mocked_prometheus_s
         count=1,
     )
 
-    assert 15 == len(mocked_prometheus_scraper_config['_label_mapping']['pod'])
+    label_join_index = mocked_prometheus_scraper_config['_label_join_index']
+    assert 15 == len(label_join_index.mapping(('pod',)))
     text_data = mock_get.replace('dd-agent-62bgh', 'dd-agent-1337')
     mock_response = mock.MagicMock(
         status_code=200, iter_lines=lambda **kwargs: text_data.split("\n"), headers={'Content-Type': text_content_type}
     )
     with mock.patch('requests.get', return_value=mock_response, __name__="get"):
         check.process(mocked_prometheus_scraper_config)
-        assert 'dd-agent-1337' in mocked_prometheus_scraper_config['_label_mapping']['pod']
-        assert 'dd-agent-62bgh' not in mocked_prometheus_scraper_config['_label_mapping']['pod']
-        assert 15 == len(mocked_prometheus_scraper_config['_label_mapping']['pod'])
+        assert 'dd-agent-1337' in label_join_index.mapping(('pod',))
+        assert 'dd-agent-62bgh' not in label_join_index.mapping(('pod',))
+        assert 15 == len(label_join_index.mapping(('pod',)))
 
 
 def test_label_joins_missconfigured(aggregator, mocked_prometheus_check, mocked_prometheus_scraper_config, mock_get):
@@ -2249,8 +2416,9 @@ def test_label_join_state_change(aggregator, mocked_prometheus_check, mocked_pro
     check.process(mocked_prometheus_scraper_config)
 
     # check that 15 pods are in phase:Running
-    assert 15 == len(mocked_prometheus_scraper_config['_label_mapping']['pod'])
-    for _, tags in iteritems(mocked_prometheus_scraper_config['_label_mapping']['pod']):
+    label_join_index = mocked_prometheus_scraper_config['_label_join_index']
+    assert 15 == len(label_join_index.mapping(('pod',)))
+    for _, tags in iteritems(label_join_index.mapping(('pod',))):
         assert tags.get('phase') == 'Running'
 
     text_data = mock_get.replace(
@@ -2263,8 +2431,195 @@ def test_label_join_state_change(aggregator, mocked_prometheus_check, mocked_pro
     )
     with mock.patch('requests.get', return_value=mock_response, __name__="get"):
         check.process(mocked_prometheus_scraper_config)
-        assert 15 == len(mocked_prometheus_scraper_config['_label_mapping']['pod'])
-        assert mocked_prometheus_scraper_config['_label_mapping']['pod']['dd-agent-62bgh']['phase'] == 'Test'
+        assert 15 == len(label_join_index.mapping(('pod',)))
+        assert label_join_index.mapping(('pod',))['dd-agent-62bgh']['phase'] == 'Test'
+
+
+def test_label_joins_skip_unwanted_families(
+    aggregator, mocked_prometheus_check, mocked_prometheus_scraper_config, mock_get
+):
+    """ Tests that label joins still work when unwanted families are skipped while parsing """
+    check = mocked_prometheus_check
+    mocked_prometheus_scraper_config['namespace'] = 'ksm'
+    mocked_prometheus_scraper_config['skip_unwanted_families'] = True
+    mocked_prometheus_scraper_config['label_joins'] = {
+        'kube_pod_info': {'label_to_match': 'pod', 'labels_to_get': ['node', 'pod_ip']}
+    }
+    mocked_prometheus_scraper_config['metrics_mapper'] = {'kube_pod_status_ready': 'pod.ready'}
+    # dry run to build mapping
+    check.process(mocked_prometheus_scraper_config)
+    # run with submit
+    check.process(mocked_prometheus_scraper_config)
+
+    aggregator.assert_metric(
+        'ksm.pod.ready',
+        1.0,
+        tags=[
+            'pod:fluentd-gcp-v2.0.9-6dj58',
+            'namespace:kube-system',
+            'condition:true',
+            'node:gke-foobar-test-kube-default-pool-9b4ff111-0kch',
+            'pod_ip:11.132.0.7',
+        ],
+        count=1,
+    )
+    aggregator.assert_all_metrics_covered()
+
+    wanted_families = mocked_prometheus_scraper_config['_wanted_families']
+    assert wanted_families[('kube_pod_info', 'gauge')] is True
+    assert wanted_families[('kube_pod_status_ready', 'gauge')] is True
+    assert wanted_families[('kube_pod_status_phase', 'gauge')] is False
+
+
+def test_parse_skip_unwanted_families(p_check, mocked_prometheus_scraper_config):
+    text_data = (
+        '# HELP skipped_total A counter that is not collected\n'
+        '# TYPE skipped_total counter\n'
+        'skipped_total{foo="bar"} 1\n'
+        'skipped_total{foo="baz"} 2\n'
+        '# HELP wanted A gauge that is collected\n'
+        '# TYPE wanted gauge\n'
+        'wanted{foo="bar"} 3\n'
+        'untyped_not_wanted 4\n'
+        '# HELP ignored A gauge that is ignored\n'
+        '# TYPE ignored gauge\n'
+        'ignored 5\n'
+        '# HELP wanted_histogram A histogram that is collected with a wildcard\n'
+        '# TYPE wanted_histogram histogram\n'
+        'wanted_histogram_bucket{le="+Inf"} 6\n'
+        'wanted_histogram_sum 7\n'
+        'wanted_histogram_count 6\n'
+    )
+    mocked_prometheus_scraper_config['skip_unwanted_families'] = True
+    mocked_prometheus_scraper_config['metrics_mapper'] = {'wanted': 'wanted', 'ignored': 'ignored', 'wanted_h*': ''}
+    mocked_prometheus_scraper_config['_wildcards_re'] = re.compile(fnmatch.translate('wanted_h*'))
+    mocked_prometheus_scraper_config['_ignored_metrics'] = {'ignored'}
+
+    metrics = list(
+        p_check.parse_metric_family(MockResponse(text_data, text_content_type), mocked_prometheus_scraper_config)
+    )
+
+    assert [(metric.name, metric.type, len(metric.samples)) for metric in metrics] == [
+        ('wanted', 'gauge', 1),
+        ('wanted_histogram', 'histogram', 3),
+    ]
+    assert metrics[0].samples == [Sample('wanted', {'foo': 'bar'}, 3.0)]
+
+
+def test_parse_as_bytes(p_check, mocked_prometheus_scraper_config, text_data):
+    """ Tests that parsing the payload as bytes yields the same metrics as the line by line parser """
+    expected = list(
+        p_check.parse_metric_family(MockResponse(text_data, text_content_type), mocked_prometheus_scraper_config)
+    )
+
+    mocked_prometheus_scraper_config['parse_as_bytes'] = True
+    metrics = list(
+        p_check.parse_metric_family(MockResponse(text_data, text_content_type), mocked_prometheus_scraper_config)
+    )
+
+    assert len(metrics) == len(expected) == 40
+    for metric, expected_metric in zip(metrics, expected):
+        assert metric.name == expected_metric.name
+        assert metric.type == expected_metric.type
+        assert metric.documentation == expected_metric.documentation
+        assert repr(metric.samples) == repr(expected_metric.samples)
+
+
+def test_bytes_to_metric_families():
+    text_data = (
+        b'# HELP escaped A "gauge" with\\ escaped \\n help\n'
+        b'# TYPE escaped gauge\n'
+        b'escaped{path="C:\\\\dir",quote="\\"q\\"",text="\xc3\xa9t\xc3\xa9"} 1.5 1395066363000\n'
+        b'\n'
+        b'untyped 2\n'
+        b'spaced {a="b", c="d"} +Inf\n'
+    )
+
+    metrics = list(bytes_to_metric_families(bytearray(text_data)))
+
+    assert [(metric.name, metric.type) for metric in metrics] == [
+        ('escaped', 'gauge'),
+        ('untyped', 'unknown'),
+        ('spaced', 'unknown'),
+    ]
+    assert metrics[0].documentation == 'A "gauge" with\\ escaped \n help'
+    assert metrics[0].samples == [Sample('escaped', {'path': 'C:\\dir', 'quote': '"q"', 'text': u'\xe9t\xe9'}, 1.5)]
+    assert metrics[1].samples == [Sample('untyped', {}, 2.0)]
+    assert metrics[2].samples == [Sample('spaced', {'a': 'b', 'c': 'd'}, float('inf'))]
+
+    with pytest.raises(ValueError):
+        list(bytes_to_metric_families(bytearray(b'no_value_metric\n')))
+
+
+def test_tags_cache(aggregator, mocked_openmetrics_check_factory, mock_get):
+    instance = dict(
+        OPENMETRICS_CHECK_INSTANCE,
+        namespace='ksm',
+        metrics=[{'kube_pod_status_ready': 'pod.ready'}],
+        tags_cache_size=30,
+        telemetry=True,
+    )
+    check = mocked_openmetrics_check_factory(instance)
+    scraper_config = check.get_scraper_config(instance)
+
+    check.process(scraper_config)
+    expected_tags = [
+        'pod:fluentd-gcp-v2.0.9-6dj58',
+        'namespace:kube-system',
+        'condition:true',
+    ]
+    aggregator.assert_metric('ksm.pod.ready', 1.0, tags=expected_tags, count=1)
+    # 15 pods with 3 conditions each
+    aggregator.assert_metric('ksm.telemetry.tags_cache.miss.count', 45, count=1)
+    aggregator.assert_metric('ksm.telemetry.tags_cache.eviction.count', 15, count=1)
+    aggregator.assert_metric('ksm.telemetry.tags_cache.size', 30, count=1)
+    aggregator.reset()
+
+    # Tags can change dynamically, they are not cached
+    scraper_config['_metric_tags'] = ['dynamic:tag']
+    check.process(scraper_config)
+    aggregator.assert_metric('ksm.pod.ready', 1.0, tags=expected_tags + ['dynamic:tag'], count=1)
+    aggregator.assert_metric('ksm.telemetry.tags_cache.hit.count', 0, count=1)
+    aggregator.assert_metric('ksm.telemetry.tags_cache.miss.count', 45, count=1)
+    aggregator.reset()
+
+    scraper_config['_tags_cache'] = LRUCache(45)
+    check.process(scraper_config)
+    check.process(scraper_config)
+    aggregator.assert_metric('ksm.pod.ready', 1.0, tags=expected_tags + ['dynamic:tag'], count=2)
+    aggregator.assert_metric('ksm.telemetry.tags_cache.hit.count', 45, count=1)
+    aggregator.assert_metric('ksm.telemetry.tags_cache.eviction.count', 0, count=2)
+
+
+def test_telemetry_scrape_timings(aggregator, mocked_openmetrics_check_factory, mock_get):
+    instance = dict(
+        OPENMETRICS_CHECK_INSTANCE,
+        namespace='ksm',
+        metrics=[{'kube_pod_status_ready': 'pod.ready'}],
+        telemetry=True,
+        telemetry_top_families=2,
+    )
+    check = mocked_openmetrics_check_factory(instance)
+    scraper_config = check.get_scraper_config(instance)
+
+    check.process(scraper_config)
+
+    for phase in ('http_wait', 'first_byte', 'parse', 'label_join', 'filter', 'submit'):
+        aggregator.assert_metric(
+            'ksm.telemetry.scrape.{}.time'.format(phase), metric_type=aggregator.HISTOGRAM, count=1
+        )
+    aggregator.assert_metric('ksm.telemetry.metrics.family.samples', count=2)
+    aggregator.assert_metric('ksm.telemetry.metrics.family.time', count=2)
+
+    # The sample counts are only sent for the families that are timed
+    families = {tuple(metric.tags) for metric in aggregator.metrics('ksm.telemetry.metrics.family.time')}
+    assert {tuple(metric.tags) for metric in aggregator.metrics('ksm.telemetry.metrics.family.samples')} == families
+    if ('metric_family:kube_pod_status_ready',) in families:
+        aggregator.assert_metric(
+            'ksm.telemetry.metrics.family.samples', 45, tags=['metric_family:kube_pod_status_ready'], count=1
+        )
+    assert scraper_config['_telemetry_timings'] is None
+    assert scraper_config['_telemetry_families'] is None
 
 
 def test_label_to_match_single(benchmark, mocked_prometheus_check, mocked_prometheus_scraper_config, mock_get):
@@ -2516,3 +2871,386 @@ def test_http_handler(mocked_openmetrics_check_factory):
 
     assert http_handler.options['headers']['accept-encoding'] == 'gzip'
     assert http_handler.options['headers']['accept'] == 'text/plain'
+
+
+def test_http_handler_prefer_protobuf(mocked_openmetrics_check_factory):
+    instance = dict(OPENMETRICS_CHECK_INSTANCE, prefer_protobuf=True)
+    check = mocked_openmetrics_check_factory(instance)
+    scraper_config = check.get_scraper_config(instance)
+
+    http_handler = check.get_http_handler(scraper_config)
+
+    assert http_handler.options['headers']['accept'] == (
+        'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,'
+        'text/plain;version=0.0.4;q=0.3'
+    )
+
+
+def test_prefer_protobuf_text_filter_blacklist(mocked_openmetrics_check_factory, text_data):
+    instance = dict(OPENMETRICS_CHECK_INSTANCE, prefer_protobuf=True)
+    check = mocked_openmetrics_check_factory(instance)
+    scraper_config = check.get_scraper_config(instance)
+    scraper_config['_text_filter_blacklist'] = ['go_gc_duration_seconds']
+
+    mock_response = mock.MagicMock(
+        status_code=200, iter_lines=lambda **kwargs: text_data.split("\n"), headers={'Content-Type': text_content_type}
+    )
+    with mock.patch('requests.get', return_value=mock_response, __name__="get") as mock_get:
+        response = check.poll(scraper_config)
+        messages = list(check.parse_metric_family(response, scraper_config))
+
+    # The blacklist only applies to the text format, so it must be requested instead of protobuf
+    assert mock_get.call_args[1]['headers']['accept'] == 'text/plain'
+    assert messages
+    assert not [sample for metric in messages for sample in metric.samples if 'go_gc_duration_seconds' in sample.name]
+
+
+def test_parse_protobuf(mocked_openmetrics_check_factory):
+    instance = dict(OPENMETRICS_CHECK_INSTANCE, prefer_protobuf=True)
+    check = mocked_openmetrics_check_factory(instance)
+    scraper_config = check.get_scraper_config(instance)
+
+    f_name = os.path.join(os.path.dirname(__file__), 'fixtures', 'prometheus', 'protobuf.bin')
+    with open(f_name, 'rb') as f:
+        bin_data = f.read()
+
+    metrics = list(check.parse_metric_family(MockResponse(bin_data, protobuf_content_type), scraper_config))
+
+    assert len(metrics) == 61
+    summary = metrics[0]
+    assert summary.name == 'go_gc_duration_seconds'
+    assert summary.type == 'summary'
+    assert summary.samples[0] == Sample('go_gc_duration_seconds', {'quantile': '0.0'}, 2.0686e-05)
+    assert [sample.name for sample in summary.samples[-2:]] == [
+        'go_gc_duration_seconds_sum',
+        'go_gc_duration_seconds_count',
+    ]
+    gauge = metrics[-1]
+    assert gauge.name == 'process_virtual_memory_bytes'
+    assert gauge.type == 'gauge'
+    assert gauge.samples == [Sample('process_virtual_memory_bytes', {}, 39211008.0)]
+
+
+def test_protobuf_to_metric_families_histogram():
+    family = metrics_pb2.MetricFamily(
+        name='request_duration_seconds', help='Request duration', type=metrics_pb2.HISTOGRAM
+    )
+    metric = family.metric.add()
+    metric.label.add(name='handler', value='/api')
+    metric.histogram.sample_count = 10
+    metric.histogram.sample_sum = 4.5
+    for upper_bound, cumulative_count in ((0.1, 2), (1.0, 7)):
+        metric.histogram.bucket.add(upper_bound=upper_bound, cumulative_count=cumulative_count)
+    message = family.SerializeToString()
+    payload = _VarintBytes(len(message)) + message
+
+    # Split the payload so that the length and the message are received in several chunks
+    metrics = list(protobuf_to_metric_families(payload[i : i + 3] for i in range(0, len(payload), 3)))
+
+    assert len(metrics) == 1
+    assert metrics[0].name == 'request_duration_seconds'
+    assert metrics[0].type == 'histogram'
+    assert metrics[0].samples == [
+        Sample('request_duration_seconds_bucket', {'handler': '/api', 'le': '0.1'}, 2.0),
+        Sample('request_duration_seconds_bucket', {'handler': '/api', 'le': '1.0'}, 7.0),
+        Sample('request_duration_seconds_bucket', {'handler': '/api', 'le': '+Inf'}, 10.0),
+        Sample('request_duration_seconds_sum', {'handler': '/api'}, 4.5),
+        Sample('request_duration_seconds_count', {'handler': '/api'}, 10.0),
+    ]
+
+    assert list(protobuf_to_metric_families([payload], family_filter=lambda name, typ: typ != 'histogram')) == []
+
+    with pytest.raises(ValueError):
+        list(protobuf_to_metric_families([payload[:-1]]))
+
+
+def _concurrent_scrape_check(concurrent_scrapes, endpoints, **options):
+    instances = [
+        dict(
+            OPENMETRICS_CHECK_INSTANCE,
+            prometheus_url=endpoint,
+            concurrent_scrapes=concurrent_scrapes,
+            tags=['url:{}'.format(endpoint)],
+            **options
+        )
+        for endpoint in endpoints
+    ]
+    check = OpenMetricsBaseCheck('openmetrics_check', {}, instances)
+    check.check_id = 'test:123'
+    return check, [check.get_scraper_config(instance) for instance in instances]
+
+
+def _wait_for_tasks(check):
+    for _ in range(500):
+        stats = dict(check.task_executor.get_stats())
+        if not stats['tasks.running'] and not stats['tasks.queued']:
+            return
+        time.sleep(0.01)
+
+
+def _text_response(text):
+    text = '# TYPE process_virtual_memory_bytes gauge\n' + text
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = text_content_type
+    response.raw = io.BytesIO(ensure_bytes(text))
+    return response
+
+
+def test_process_all_concurrently(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints)
+
+    threads = []
+    in_flight = []
+    all_in_flight = threading.Event()
+
+    def get(url, **_):
+        threads.append(threading.current_thread())
+        if len(threads) == len(endpoints):
+            all_in_flight.set()
+        # Only returns once every request has been sent
+        in_flight.append(all_in_flight.wait(5))
+        return _text_response('process_virtual_memory_bytes {}\n'.format(url[-12:-8]))
+
+    with mock.patch('requests.get', side_effect=get):
+        check.process_all(scraper_configs)
+
+    assert in_flight == [True, True]
+    assert threading.current_thread() not in threads
+    # The endpoints are scraped by the thread pool shared by all checks
+    assert check.task_executor.submitted == 2
+    for endpoint in endpoints:
+        aggregator.assert_metric(
+            'openmetrics.process.vm.bytes', value=float(endpoint[-12:-8]), tags=['url:{}'.format(endpoint)]
+        )
+    aggregator.assert_all_metrics_covered()
+
+
+@pytest.mark.parametrize(
+    'options, max_concurrency',
+    [
+        pytest.param({}, 3, id='concurrent_scrapes'),
+        pytest.param({'max_concurrent_tasks': 2}, 2, id='max_concurrent_tasks'),
+    ],
+)
+def test_process_all_quota(options, max_concurrency):
+    check, _ = _concurrent_scrape_check(3, ['http://fake.endpoint:10055/metrics'], **options)
+
+    assert check._get_scrape_executor() is check.task_executor
+    assert check.task_executor.max_concurrency == max_concurrency
+
+
+def test_process_all_serially_by_default(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(1, endpoints)
+    threads = []
+
+    def get(url, **_):
+        threads.append(threading.current_thread())
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    with mock.patch('requests.get', side_effect=get):
+        check.process_all(scraper_configs)
+
+    assert check._get_scrape_executor() is None
+    assert threads == [threading.current_thread()] * 2
+    aggregator.assert_metric('openmetrics.process.vm.bytes', count=2)
+
+
+def test_process_all_errors(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints)
+
+    def get(url, **_):
+        if url == endpoints[0]:
+            raise requests.exceptions.ConnectionError('Connection refused')
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    with mock.patch('requests.get', side_effect=get):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            check.process_all(scraper_configs)
+
+    aggregator.assert_service_check(
+        'openmetrics.prometheus.health',
+        status=OpenMetricsBaseCheck.CRITICAL,
+        tags=['endpoint:{}'.format(endpoints[0]), 'url:{}'.format(endpoints[0])],
+    )
+    aggregator.assert_service_check(
+        'openmetrics.prometheus.health',
+        status=OpenMetricsBaseCheck.OK,
+        tags=['endpoint:{}'.format(endpoints[1]), 'url:{}'.format(endpoints[1])],
+    )
+    aggregator.assert_metric('openmetrics.process.vm.bytes', tags=['url:{}'.format(endpoints[1])])
+
+
+def test_process_all_timeout(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, scrape_timeout=0.1)
+    unblock = threading.Event()
+    slow_response = _text_response('process_virtual_memory_bytes 1\n')
+    slow_response.close = mock.MagicMock()
+
+    def get(url, **_):
+        if url == endpoints[0]:
+            unblock.wait(5)
+            return slow_response
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    try:
+        with mock.patch('requests.get', side_effect=get):
+            with pytest.raises(requests.exceptions.Timeout):
+                check.process_all(scraper_configs)
+    finally:
+        unblock.set()
+    _wait_for_tasks(check)
+
+    aggregator.assert_service_check(
+        'openmetrics.prometheus.health',
+        status=OpenMetricsBaseCheck.CRITICAL,
+        tags=['endpoint:{}'.format(endpoints[0]), 'url:{}'.format(endpoints[0])],
+    )
+    aggregator.assert_metric('openmetrics.process.vm.bytes', count=1, tags=['url:{}'.format(endpoints[1])])
+    # The response received after the timeout is released
+    slow_response.close.assert_called_once()
+
+
+def test_process_all_timeout_per_endpoint(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, scrape_timeout=0.5)
+    unblock = threading.Event()
+
+    def get(url, **_):
+        unblock.wait(5)
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    start = time.time()
+    try:
+        with mock.patch('requests.get', side_effect=get):
+            with pytest.raises(requests.exceptions.Timeout):
+                check.process_all(scraper_configs)
+    finally:
+        elapsed = time.time() - start
+        unblock.set()
+    _wait_for_tasks(check)
+
+    # Both endpoints were scraped at the same time, so waiting for them takes a single timeout
+    assert 0.5 <= elapsed < 0.9
+    aggregator.assert_metric('openmetrics.process.vm.bytes', count=0)
+
+
+def test_process_all_previous_scrape_still_running(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, scrape_timeout=0.1)
+    unblock = threading.Event()
+    requested = []
+
+    def get(url, **_):
+        requested.append(url)
+        if url == endpoints[0]:
+            unblock.wait(5)
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    try:
+        with mock.patch('requests.get', side_effect=get):
+            for _ in range(2):
+                with pytest.raises(requests.exceptions.Timeout):
+                    check.process_all(scraper_configs)
+    finally:
+        unblock.set()
+    _wait_for_tasks(check)
+
+    # The slow endpoint is not requested again while its first scrape is running
+    assert requested.count(endpoints[0]) == 1
+    assert requested.count(endpoints[1]) == 2
+    aggregator.assert_metric('openmetrics.process.vm.bytes', count=2, tags=['url:{}'.format(endpoints[1])])
+
+
+def test_process_all_timeout_cancels_pending_scrapes(aggregator):
+    endpoints = ['http://fake.endpoint:1005{}/metrics'.format(i) for i in range(3)]
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, scrape_timeout=0.1)
+    unblock = threading.Event()
+    requested = []
+
+    def get(url, **_):
+        requested.append(url)
+        unblock.wait(5)
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    try:
+        with mock.patch('requests.get', side_effect=get):
+            with pytest.raises(requests.exceptions.Timeout):
+                check.process_all(scraper_configs)
+    finally:
+        unblock.set()
+    _wait_for_tasks(check)
+
+    # Both scrapes allowed at once were busy with the first endpoints, the last one never started
+    assert sorted(requested) == endpoints[:2]
+    assert scraper_configs[2]['_prefetch_future'].cancelled()
+
+
+def test_process_all_worker_payload_buffer(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, parse_as_bytes=True, skip_unwanted_families=True)
+
+    with mock.patch('requests.get', side_effect=lambda url, **_: _text_response('process_virtual_memory_bytes 1\n')):
+        check.process_all(scraper_configs)
+
+    aggregator.assert_metric('openmetrics.process.vm.bytes', count=2)
+    for scraper_config in scraper_configs:
+        # Workers parse into their own buffer, and their wanted families are kept for the next run
+        assert scraper_config['_payload_buffer'] == bytearray()
+        assert scraper_config['_wanted_families'] == {('process_virtual_memory_bytes', 'gauge'): True}
+
+
+def test_process_all_text_filter_blacklist_count(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, telemetry=True)
+    for scraper_config in scraper_configs:
+        scraper_config['_text_filter_blacklist'] = ['filtered']
+
+    submitting_threads = set()
+    count = check.count
+
+    def count_from_thread(*args, **kwargs):
+        submitting_threads.add(threading.current_thread())
+        return count(*args, **kwargs)
+
+    def get(url, **_):
+        return _text_response('process_virtual_memory_bytes 1\nprocess_virtual_memory_bytes{filtered="1"} 2\n')
+
+    with mock.patch('requests.get', side_effect=get), mock.patch.object(check, 'count', side_effect=count_from_thread):
+        check.process_all(scraper_configs)
+
+    assert submitting_threads == {threading.current_thread()}
+    for endpoint in endpoints:
+        aggregator.assert_metric(
+            'openmetrics.telemetry.metrics.blacklist.count', value=1, count=1, tags=['url:{}'.format(endpoint)]
+        )
+    assert all(scraper_config['_text_filter_blacklist_count'] == 0 for scraper_config in scraper_configs)
+
+
+def test_process_all_telemetry_timings(aggregator):
+    endpoints = ['http://fake.endpoint:10055/metrics', 'http://fake.endpoint:10056/metrics']
+    check, scraper_configs = _concurrent_scrape_check(2, endpoints, telemetry=True)
+    metric_families = check._metric_families
+
+    def get(url, **_):
+        time.sleep(0.1)
+        return _text_response('process_virtual_memory_bytes 1\n')
+
+    def slow_metric_families(response, scraper_config):
+        for metric in metric_families(response, scraper_config):
+            time.sleep(0.1)
+            yield metric
+
+    with mock.patch('requests.get', side_effect=get):
+        with mock.patch.object(check, '_metric_families', side_effect=slow_metric_families):
+            check.process_all(scraper_configs)
+
+    # The time spent by the workers is reported, not the time spent by the calling thread
+    for name in ('scrape.http_wait.time', 'scrape.parse.time', 'metrics.family.time'):
+        metrics = aggregator.metrics('openmetrics.telemetry.{}'.format(name))
+        assert len(metrics) == 2
+        assert all(metric.value >= 0.1 for metric in metrics)
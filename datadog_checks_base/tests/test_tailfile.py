@@ -0,0 +1,282 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import json
+import logging
+import os
+import sys
+
+import mock
+import pytest
+
+from datadog_checks.base import AgentCheck
+from datadog_checks.base.utils.tailfile import InotifyWatcher, PollingWatcher, TailFile, TailFileCheckpoint
+
+log = logging.getLogger(__name__)
+
+
+def write(path, data, mode='a'):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+@pytest.fixture
+def log_file(tmpdir):
+    path = str(tmpdir.join('test.log'))
+    write(path, 'old1\nold2\n', mode='w')
+    return path
+
+
+@pytest.fixture(params=[True, False], ids=['inotify', 'polling'])
+def use_inotify(request):
+    return request.param
+
+
+class TestTailBatches:
+    def test_move_end(self, log_file, use_inotify):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append, use_inotify=use_inotify)
+
+        next(gen)
+        assert batches == []
+
+        write(log_file, 'foo\nbar\n')
+        next(gen)
+        assert batches == [['foo', 'bar']]
+
+    def test_from_start(self, log_file):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append, move_end=False)
+
+        next(gen)
+        assert batches == [['old1', 'old2']]
+
+    def test_blocks(self, log_file):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append, move_end=False, block_size=6)
+
+        next(gen)
+        assert batches == [['old1'], ['old2']]
+
+    def test_line_callback(self, log_file):
+        lines = []
+        gen = TailFile(log, log_file, lines.append).tail_batches(move_end=False)
+
+        next(gen)
+        assert lines == ['old1', 'old2']
+
+    def test_partial_line(self, log_file):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append)
+
+        next(gen)
+        write(log_file, 'foo\npar')
+        next(gen)
+        assert batches == [['foo']]
+
+        write(log_file, 'tial\n')
+        next(gen)
+        assert batches == [['foo'], ['partial']]
+
+    def test_rotation(self, log_file, use_inotify):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append, use_inotify=use_inotify)
+
+        next(gen)
+        os.rename(log_file, log_file + '.1')
+        write(log_file, 'new\n', mode='w')
+        next(gen)
+        next(gen)
+
+        assert batches == [['new']]
+
+    def test_removed(self, log_file):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append)
+
+        next(gen)
+        os.remove(log_file)
+        next(gen)
+        write(log_file, 'new\n', mode='w')
+        next(gen)
+        next(gen)
+
+        assert batches == [['new']]
+
+    def test_truncation(self, log_file, use_inotify):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append, use_inotify=use_inotify)
+
+        next(gen)
+        write(log_file, 'new\n', mode='w')
+        next(gen)
+        next(gen)
+
+        assert batches == [['new']]
+
+    def test_copytruncate(self, log_file):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append)
+
+        next(gen)
+        write(log_file, 'x' * 20 + '\n')
+        next(gen)
+        write(log_file, 'y' * 40 + '\n', mode='w')
+        next(gen)
+        next(gen)
+
+        assert batches == [['x' * 20], ['y' * 40]]
+
+    def test_holes(self, log_file):
+        batches = []
+        gen = TailFile(log, log_file, None).tail_batches(batches.append)
+
+        next(gen)
+        write(log_file, '\0\0foo\n')
+        next(gen)
+
+        assert batches == [['foo']]
+
+    def test_missing_file(self, tmpdir):
+        gen = TailFile(log, str(tmpdir.join('missing.log')), None).tail_batches()
+
+        assert list(gen) == []
+
+    def test_close(self, log_file):
+        tail = TailFile(log, log_file, None)
+        gen = tail.tail_batches()
+
+        next(gen)
+        gen.close()
+
+        assert tail._f is None
+        assert tail._watcher is None
+
+
+class TestWatchers:
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is only available on Linux')
+    def test_inotify(self, log_file):
+        watcher = InotifyWatcher.create(log_file, log)
+        try:
+            assert isinstance(watcher, InotifyWatcher)
+            assert watcher.changed() is False
+
+            write(log_file, 'foo\n')
+            assert watcher.changed() is False
+
+            write(log_file + '.other', 'foo\n')
+            assert watcher.changed() is False
+
+            os.rename(log_file, log_file + '.1')
+            assert watcher.changed() is True
+            assert watcher.changed() is False
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        watcher = PollingWatcher()
+
+        assert watcher.changed() is True
+
+
+@pytest.fixture
+def check(datadog_agent):
+    check = AgentCheck('test', {}, [{}])
+    check.check_id = 'test:123'
+    return check
+
+
+def tail_batches(check, log_file, batches, interval=0):
+    tail = TailFile(log, log_file, None, checkpoint=TailFileCheckpoint(check, 'log', interval=interval))
+    return tail.tail_batches(batches.append)
+
+
+def read_checkpoint(check):
+    return json.loads(check.read_persistent_cache('log'))
+
+
+class TestCheckpoint:
+    def test_first_run(self, check, log_file):
+        gen = tail_batches(check, log_file, [])
+
+        next(gen)
+        assert read_checkpoint(check)['offset'] == os.path.getsize(log_file)
+
+    def test_resume(self, check, log_file):
+        batches = []
+        gen = tail_batches(check, log_file, batches)
+
+        next(gen)
+        write(log_file, 'foo\n')
+        next(gen)
+        gen.close()
+
+        write(log_file, 'bar\nbaz\n')
+        gen = tail_batches(check, log_file, batches)
+        next(gen)
+
+        assert batches == [['foo'], ['bar', 'baz']]
+
+    def test_resume_partial_line(self, check, log_file):
+        batches = []
+        gen = tail_batches(check, log_file, batches)
+
+        next(gen)
+        write(log_file, 'foo\nba')
+        next(gen)
+        gen.close()
+
+        write(log_file, 'r\n')
+        gen = tail_batches(check, log_file, batches)
+        next(gen)
+
+        assert batches == [['foo'], ['bar']]
+
+    def test_rotated_while_stopped(self, check, log_file):
+        batches = []
+        gen = tail_batches(check, log_file, batches)
+        next(gen)
+        gen.close()
+
+        os.rename(log_file, log_file + '.1')
+        write(log_file, 'new1\nnew2\nnew3\nnew4\n', mode='w')
+        gen = tail_batches(check, log_file, batches)
+        next(gen)
+
+        assert batches == [['new1', 'new2', 'new3', 'new4']]
+
+    def test_truncated_while_stopped(self, check, log_file):
+        batches = []
+        write(log_file, 'x' * 20 + '\n')
+        gen = tail_batches(check, log_file, batches)
+        next(gen)
+        gen.close()
+
+        write(log_file, 'new\n', mode='w')
+        gen = tail_batches(check, log_file, batches)
+        next(gen)
+
+        assert batches == [['new']]
+
+    def test_batched_writes(self, check, log_file):
+        gen = tail_batches(check, log_file, [], interval=60)
+        next(gen)
+
+        with mock.patch.object(check, 'write_persistent_cache') as write_persistent_cache:
+            for i in range(5):
+                write(log_file, 'line{}\n'.format(i))
+                next(gen)
+
+            assert write_persistent_cache.call_count == 0
+
+            gen.close()
+            assert write_persistent_cache.call_count == 1
+
+    def test_invalid(self, check, log_file):
+        check.write_persistent_cache('log', 'not json')
+        batches = []
+        gen = tail_batches(check, log_file, batches)
+
+        next(gen)
+        assert batches == []
+        assert read_checkpoint(check)['offset'] == os.path.getsize(log_file)
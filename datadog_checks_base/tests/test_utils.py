@@ -4,6 +4,7 @@
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
 
+import json
 from decimal import ROUND_HALF_DOWN
 
 import mock
@@ -11,8 +12,10 @@ import pytest
 from six import PY3
 
 from datadog_checks.base.utils.common import ensure_bytes, ensure_unicode, pattern_filter, round_value, to_native_string
-from datadog_checks.base.utils.containers import iter_unique
-from datadog_checks.base.utils.limiter import Limiter
+from datadog_checks.base.utils.containers import ReadOnlyDict, ReadOnlyList, iter_unique, mutable_copy, read_only
+from datadog_checks.base.utils.json_stream import JSONStreamError, iter_json
+from datadog_checks.base.utils.limiter import HyperLogLog, Limiter, mix_hash
+from datadog_checks.base.utils.lru import LRUCache
 from datadog_checks.base.utils.secrets import SecretsSanitizer
 
 
@@ -117,6 +120,101 @@ class TestLimiter:
         assert limiter.is_reached("dummy1") is False
         assert limiter.get_status() == (1, 10, False)
 
+    def test_compact(self):
+        limiter = Limiter("my_check", "names", 10, compact=True)
+
+        for _ in range(0, 20):
+            assert limiter.is_reached("dummy1") is False
+        assert limiter.get_status() == (1, 10, False)
+        assert limiter.seen == {hash("dummy1")}
+
+        for i in range(0, 10):
+            limiter.is_reached("dummy{}".format(i))
+        assert limiter.get_status() == (10, 10, False)
+        assert limiter.is_reached("dummy10") is True
+
+
+class TestHyperLogLog:
+    def test_empty(self):
+        assert HyperLogLog().estimate() == 0
+
+    def test_duplicates(self):
+        hll = HyperLogLog()
+        for _ in range(0, 100):
+            hll.add("foo")
+            hll.add(("bar", 1))
+
+        assert hll.estimate() == 2
+
+    @pytest.mark.parametrize("precision, cardinality", [(12, 1000), (12, 50000), (14, 50000), (6, 50000)])
+    def test_estimate(self, precision, cardinality):
+        hll = HyperLogLog(precision)
+        for i in range(0, cardinality):
+            hll.add(i)
+
+        # Well within 4 standard errors
+        error = 4 * 1.04 / (2 ** precision) ** 0.5
+        assert abs(hll.estimate() - cardinality) <= error * cardinality
+
+    def test_reset(self):
+        hll = HyperLogLog()
+        hll.add("foo")
+        hll.reset()
+
+        assert hll.estimate() == 0
+
+    @pytest.mark.parametrize("precision", [3, 17])
+    def test_invalid_precision(self, precision):
+        with pytest.raises(ValueError, match="^The precision must be between 4 and 16$"):
+            HyperLogLog(precision)
+
+    def test_mix_hash(self):
+        assert 0 <= mix_hash(-1) < 2 ** 64
+        assert mix_hash(1) != 1
+        assert mix_hash("foo") == mix_hash("foo")
+
+
+class TestLRUCache:
+    def test_get_set(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        assert cache.get('a') == 1
+        assert cache.get('c') is None
+        assert cache.get('c', 3) == 3
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 2, 0)
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # `a` becomes the most recently used entry
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert len(cache) == 2
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert cache.evictions == 1
+
+        # Updating an entry doesn't evict anything
+        cache.set('a', 4)
+        assert cache.get('a') == 4
+        assert cache.evictions == 1
+
+    def test_reset_stats(self):
+        cache = LRUCache(1)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.get('b')
+
+        cache.reset_stats()
+        assert (cache.hits, cache.misses, cache.evictions) == (0, 0, 0)
+        assert cache.get('b') == 2
+
 
 class TestRounding:
     def test_round_half_up(self):
@@ -150,6 +248,94 @@ class TestContainers:
 
         assert len(list(iter_unique(custom_queries))) == 1
 
+    def test_read_only(self):
+        config = {'tags': ['foo:bar'], 'queries': [{'columns': [{'name': 'foo'}]}], 'port': 5432}
+        frozen = read_only(config)
+
+        assert frozen == config
+        assert type(frozen) is ReadOnlyDict
+        assert type(frozen['tags']) is ReadOnlyList
+        assert type(frozen['queries'][0]['columns'][0]) is ReadOnlyDict
+
+        with pytest.raises(TypeError):
+            frozen['port'] = 0
+        with pytest.raises(TypeError):
+            frozen['tags'].append('baz:qux')
+        with pytest.raises(TypeError):
+            frozen['queries'][0]['columns'][0].update(name='bar')
+
+        # Copies are regular containers
+        assert type(frozen.copy()) is dict
+        assert type(frozen['tags'] + ['baz:qux']) is list
+
+    def test_mutable_copy(self):
+        config = read_only({'tags': ['foo:bar'], 'nested': {'values': (1, [2])}, 'port': 5432})
+        config_copy = mutable_copy(config)
+
+        assert config_copy == config
+        assert type(config_copy) is dict
+        assert type(config_copy['tags']) is list
+        assert type(config_copy['nested']) is dict
+
+        config_copy['nested']['values'][1].append(3)
+        assert config['nested']['values'] == (1, [2])
+
+
+class TestJSONStream:
+    DOCUMENT = (
+        u'{"cluster_name": "foo", "count": 12345, "empty": {}, '
+        u'"nodes": {"abc": {"name": "b\u00e4r", "ids": [1, 2.5, null, true]}, "def": {"name": "baz"}}, '
+        u'"queues": [{"id": 0}, {"id": 1}, {"id": 2}]}'
+    )
+
+    @staticmethod
+    def chunks(text, size):
+        data = text.encode('utf-8')
+        return [data[i : i + size] for i in range(0, len(data), size)]
+
+    @pytest.mark.parametrize('size', [1, 3, 1024])
+    def test_object_members(self, size):
+        assert list(iter_json(self.chunks(self.DOCUMENT, size), 'nodes.*')) == [
+            ('abc', {'name': u'b\u00e4r', 'ids': [1, 2.5, None, True]}),
+            ('def', {'name': 'baz'}),
+        ]
+
+    @pytest.mark.parametrize('size', [1, 3, 1024])
+    def test_array_items(self, size):
+        assert list(iter_json(self.chunks(self.DOCUMENT, size), 'queues.*.id')) == [('id', 0), ('id', 1), ('id', 2)]
+        assert list(iter_json(self.chunks(self.DOCUMENT, size), ['queues', 1])) == [(1, {'id': 1})]
+
+    def test_top_level_array(self):
+        assert list(iter_json([b'[1, 2', b'3, 4]'], '*')) == [(0, 1), (1, 23), (2, 4)]
+
+    def test_scalar(self):
+        assert list(iter_json(self.chunks(self.DOCUMENT, 2), 'count')) == [('count', 12345)]
+
+    def test_empty_containers(self):
+        assert list(iter_json([self.DOCUMENT], 'empty.*')) == []
+        assert list(iter_json([b'[]'], '*')) == []
+
+    def test_no_match(self):
+        assert list(iter_json([self.DOCUMENT], 'missing.*')) == []
+        assert list(iter_json([self.DOCUMENT], 'cluster_name.*')) == []
+
+    def test_whole_document(self):
+        assert list(iter_json(self.chunks(self.DOCUMENT, 5), '')) == [(None, json.loads(self.DOCUMENT))]
+
+    @pytest.mark.parametrize(
+        'document',
+        [
+            pytest.param(b'{"nodes": [1, 2}', id='unbalanced'),
+            pytest.param(b'{"nodes" 1}', id='missing colon'),
+            pytest.param(b'{"nodes": [1,', id='truncated'),
+            pytest.param(b'{"nodes": 1} {}', id='extra data'),
+            pytest.param(b'', id='empty'),
+        ],
+    )
+    def test_invalid(self, document):
+        with pytest.raises(JSONStreamError):
+            list(iter_json([document], 'nodes.*'))
+
 
 class TestBytesUnicode:
     @pytest.mark.skipif(PY3, reason="Python 3 does not support explicit bytestring with special characters")
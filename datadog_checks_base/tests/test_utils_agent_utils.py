@@ -4,7 +4,7 @@
 import mock
 
 from datadog_checks.base import stubs
-from datadog_checks.base.utils.agent.utils import should_profile_memory
+from datadog_checks.base.utils.agent.utils import should_profile_cpu, should_profile_memory
 
 
 class TestShouldProfileMemory:
@@ -52,3 +52,22 @@ class TestShouldProfileMemory:
 
         with mock.patch('datadog_checks.base.stubs.datadog_agent.get_config', side_effect=mock_get_config):
             assert should_profile_memory(stubs.datadog_agent, 'test') is False
+
+
+class TestShouldProfileCpu:
+    def test_default(self):
+        with mock.patch('datadog_checks.base.stubs.datadog_agent.get_config', return_value=''):
+            assert should_profile_cpu(stubs.datadog_agent, 'test') is True
+
+    def test_blacklist(self):
+        # Keep a reference for use during mock
+        get_config = stubs.datadog_agent.get_config
+
+        def mock_get_config(key):
+            if key == 'cpu_profiling_blacklist':
+                return 'foo, test'
+
+            return get_config(key)
+
+        with mock.patch('datadog_checks.base.stubs.datadog_agent.get_config', side_effect=mock_get_config):
+            assert should_profile_cpu(stubs.datadog_agent, 'test') is False
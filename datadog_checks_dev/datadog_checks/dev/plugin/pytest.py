@@ -6,9 +6,12 @@ from __future__ import absolute_import
 import json
 import os
 import re
+import socket
 from base64 import urlsafe_b64encode
+from timeit import default_timer
 
 import pytest
+from six import string_types
 
 from .._env import (
     AGENT_COLLECTOR_SEPARATOR,
@@ -26,9 +29,16 @@ from .._env import (
     serialize_data,
 )
 
+try:
+    import tracemalloc
+except ImportError:  # no cov
+    tracemalloc = None
+
 __aggregator = None
 __datadog_agent = None
 
+LOOPBACK_HOSTS = {'localhost', 'ip6-localhost', '::1'}
+
 
 @pytest.fixture
 def aggregator():
@@ -232,6 +242,105 @@ def dd_save_state():
     return save_state
 
 
+def is_loopback(host):
+    if not isinstance(host, string_types):
+        return False
+
+    host = host.lower()
+    return host in LOOPBACK_HOSTS or host.startswith('127.')
+
+
+@pytest.fixture(autouse=True)
+def dd_block_network(request, monkeypatch):
+    """
+    With `--block-network`, fails tests trying to reach anything else than the local host,
+    so that benchmarks only run against recorded fixtures.
+    """
+    if not request.config.getoption('--block-network'):
+        yield
+        return
+
+    def blocked(address):
+        pytest.fail('Network access is blocked, tried to reach: {}'.format(address), pytrace=False)
+
+    def guard_connect(connect):
+        def guarded_connect(sock, address, *args, **kwargs):
+            if sock.family in (socket.AF_INET, socket.AF_INET6) and not is_loopback(address[0]):
+                blocked(address)
+            return connect(sock, address, *args, **kwargs)
+
+        return guarded_connect
+
+    getaddrinfo = socket.getaddrinfo
+
+    def guarded_getaddrinfo(host, *args, **kwargs):
+        if host is not None and not is_loopback(host):
+            blocked(host)
+        return getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket.socket, 'connect', guard_connect(socket.socket.connect))
+    monkeypatch.setattr(socket.socket, 'connect_ex', guard_connect(socket.socket.connect_ex))
+    monkeypatch.setattr(socket, 'getaddrinfo', guarded_getaddrinfo)
+    yield
+
+
+def count_submissions(stub):
+    return sum(len(metrics) for metrics in stub._metrics.values())
+
+
+@pytest.fixture(autouse=True)
+def dd_benchmark_stats(request):
+    """
+    With `--bench-stats`, runs the function measured by the `benchmark` fixture once more after
+    the benchmark to record the memory it allocates and the points it submits, as extra info
+    of the benchmark:
+
+      - memory_peak: the peak size in bytes of the memory allocated during a call
+      - points: the number of metrics submitted during a call
+      - points_per_second: points divided by the mean run time of the benchmark
+    """
+    if not request.config.getoption('--bench-stats') or 'benchmark' not in request.fixturenames:
+        yield
+        return
+
+    benchmark = request.getfixturevalue('benchmark')
+    calls = []
+    make_runner = benchmark._make_runner
+
+    def recording_make_runner(function_to_benchmark, args, kwargs):
+        calls.append((function_to_benchmark, args, kwargs))
+        return make_runner(function_to_benchmark, args, kwargs)
+
+    benchmark._make_runner = recording_make_runner
+    yield
+
+    # Functions measured with `benchmark.pedantic` may depend on their setup so are not called again
+    if not calls or getattr(benchmark, '_mode', None) != 'benchmark(...)' or benchmark.stats is None:
+        return
+
+    from datadog_checks.base.stubs import aggregator as stub
+
+    function_to_benchmark, args, kwargs = calls[-1]
+    submitted = count_submissions(stub)
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    start = default_timer()
+    try:
+        function_to_benchmark(*args, **kwargs)
+    finally:
+        elapsed = default_timer() - start
+        if tracemalloc is not None:
+            benchmark.extra_info['memory_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    points = count_submissions(stub) - submitted
+    mean = benchmark.stats.stats.mean or elapsed
+    benchmark.extra_info['points'] = points
+    benchmark.extra_info['points_per_second'] = points / mean if mean else 0
+
+
 def pytest_configure(config):
     # pytest will emit warnings if these aren't registered ahead of time
     config.addinivalue_line('markers', 'unit: marker for unit tests')
@@ -242,6 +351,15 @@ def pytest_configure(config):
 
 def pytest_addoption(parser):
     parser.addoption("--run-latest-metrics", action="store_true", default=False, help="run check_metrics tests")
+    parser.addoption(
+        "--block-network", action="store_true", default=False, help="fail tests trying to reach non-local hosts"
+    )
+    parser.addoption(
+        "--bench-stats",
+        action="store_true",
+        default=False,
+        help="record the memory allocated and the points submitted by benchmarks",
+    )
 
 
 def pytest_collection_modifyitems(config, items):
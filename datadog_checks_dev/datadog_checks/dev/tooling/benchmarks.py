@@ -0,0 +1,80 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import json
+
+from ..utils import file_exists, path_join, read_file
+from .constants import get_root
+
+# Located at the root of each repo
+BENCHMARK_RESULTS_DIR = '.benchmarks'
+BENCHMARK_BASELINE = 'baseline'
+
+# The statistics compared against the baseline, with whether a higher value is a regression
+BENCHMARK_STATS = (('mean', True), ('memory_peak', True), ('points_per_second', False))
+
+
+def get_benchmark_results_path(check, env, name):
+    """
+    Return the path of the benchmark results of a check for an environment, `name` being
+    a commit hash or `BENCHMARK_BASELINE`
+    """
+    return path_join(get_root(), BENCHMARK_RESULTS_DIR, check, env, f'{name}.json')
+
+
+def load_benchmark_results(path):
+    """
+    Return the statistics of every benchmark of a `--benchmark-json` report, by benchmark name
+    """
+    if not file_exists(path):
+        return {}
+
+    report = json.loads(read_file(path))
+
+    results = {}
+    for benchmark in report.get('benchmarks', []):
+        stats = {'mean': benchmark['stats']['mean']}
+        stats.update(benchmark.get('extra_info', {}))
+        results[benchmark['name']] = stats
+
+    return results
+
+
+def compare_benchmark_results(results, baseline, thresholds):
+    """
+    Compare benchmark statistics with the ones of a baseline.
+
+    :param thresholds: the change in percent above which a statistic is considered to regress, by statistic
+    :return: a list of (benchmark name, statistic, baseline value, value, change in percent, regressed) sorted
+    by benchmark name, for statistics present in both results
+    """
+    comparison = []
+    for name, stats in sorted(results.items()):
+        baseline_stats = baseline.get(name)
+        if not baseline_stats:
+            continue
+
+        for stat, higher_is_worse in BENCHMARK_STATS:
+            value = stats.get(stat)
+            baseline_value = baseline_stats.get(stat)
+            if value is None or not baseline_value:
+                continue
+
+            change = (value - baseline_value) / baseline_value * 100
+            regression = change if higher_is_worse else -change
+            comparison.append((name, stat, baseline_value, value, change, regression > thresholds[stat]))
+
+    return comparison
+
+
+def format_benchmark_stat(stat, value):
+    if value is None:
+        return '-'
+    elif stat == 'mean':
+        return f'{value * 1000:.3f}ms'
+    elif stat == 'memory_peak':
+        return f'{value / 1024:.1f}KiB'
+    elif stat == 'points_per_second':
+        return f'{value:.0f}/s'
+
+    return str(value)
@@ -7,12 +7,31 @@ import sys
 import click
 
 from ..._env import E2E_PARENT_PYTHON, SKIP_ENVIRONMENT
+from ...structures import EnvVars
 from ...subprocess import run_command
-from ...utils import chdir, file_exists, get_ci_env_vars, remove_path, running_on_ci
+from ...utils import (
+    chdir,
+    ensure_parent_dir_exists,
+    file_exists,
+    get_ci_env_vars,
+    read_file_binary,
+    remove_path,
+    running_on_ci,
+    write_file_binary,
+)
+from ..benchmarks import (
+    BENCHMARK_BASELINE,
+    BENCHMARK_STATS,
+    compare_benchmark_results,
+    format_benchmark_stat,
+    get_benchmark_results_path,
+    load_benchmark_results,
+)
 from ..constants import get_root
+from ..git import get_commit_hash
 from ..testing import construct_pytest_options, fix_coverage_report, get_tox_envs, pytest_coverage_sources
 from ..utils import complete_testable_checks
-from .console import CONTEXT_SETTINGS, abort, echo_info, echo_success, echo_waiting, echo_warning
+from .console import CONTEXT_SETTINGS, abort, echo_failure, echo_info, echo_success, echo_waiting, echo_warning
 
 
 def display_envs(check_envs):
@@ -22,11 +41,101 @@ def display_envs(check_envs):
             echo_info(f'    {e}')
 
 
+def tox_command(envs):
+    return (
+        'tox '
+        # so users won't get failures for our possibly strict CI requirements
+        '--skip-missing-interpreters '
+        # so coverage tracks the real locations instead of .tox virtual envs
+        '--develop '
+        # comma-separated list of environments
+        '-e {}'.format(','.join(envs))
+    )
+
+
+def display_benchmark_stats(name, stats):
+    echo_info(
+        f'    {name}: '
+        + ', '.join(f'{stat} {format_benchmark_stat(stat, stats.get(stat))}' for stat, _ in BENCHMARK_STATS)
+    )
+
+
+def report_benchmarks(check, env, commit, baseline_commit, thresholds, save_baseline):
+    """
+    Display the results of the benchmarks of a check for an environment compared to the baseline,
+    returning the number of regressions
+    """
+    results_path = get_benchmark_results_path(check, env, commit)
+    results = load_benchmark_results(results_path)
+    if not results:
+        echo_warning(f'No benchmark results were recorded for `{env}`')
+        return 0
+
+    echo_success(f'\nBenchmarks for `{env}`, saved to: {results_path}')
+    for name, stats in sorted(results.items()):
+        display_benchmark_stats(name, stats)
+
+    # Totals of the check, as if every benchmark was a part of a single run
+    total_time = sum(stats['mean'] for stats in results.values())
+    total_points = sum(stats.get('points', 0) for stats in results.values())
+    memory_peaks = [stats['memory_peak'] for stats in results.values() if 'memory_peak' in stats]
+    display_benchmark_stats(
+        'total',
+        {
+            'mean': total_time,
+            'memory_peak': max(memory_peaks) if memory_peaks else None,
+            'points_per_second': total_points / total_time if total_time and total_points else None,
+        },
+    )
+
+    baseline_path = get_benchmark_results_path(check, env, baseline_commit or BENCHMARK_BASELINE)
+    regressions = 0
+    if file_exists(baseline_path):
+        echo_info(f'\nCompared to: {baseline_path}')
+        for name, stat, baseline_value, value, change, regressed in compare_benchmark_results(
+            results, load_benchmark_results(baseline_path), thresholds
+        ):
+            message = (
+                f'    {name} {stat}: {format_benchmark_stat(stat, baseline_value)} -> '
+                f'{format_benchmark_stat(stat, value)} ({change:+.1f}%)'
+            )
+            if regressed:
+                regressions += 1
+                echo_failure(message)
+            else:
+                echo_info(message)
+    else:
+        echo_warning('\nNo baseline to compare to, record one with `--bench-save-baseline`')
+
+    if save_baseline:
+        baseline_path = get_benchmark_results_path(check, env, BENCHMARK_BASELINE)
+        write_file_binary(baseline_path, read_file_binary(results_path))
+        echo_info(f'Saved as the baseline: {baseline_path}')
+
+    return regressions
+
+
 @click.command(context_settings=CONTEXT_SETTINGS, short_help='Run tests')
 @click.argument('checks', autocompletion=complete_testable_checks, nargs=-1)
 @click.option('--format-style', '-fs', is_flag=True, help='Run only the code style formatter')
 @click.option('--style', '-s', is_flag=True, help='Run only style checks')
 @click.option('--bench', '-b', is_flag=True, help='Run only benchmarks')
+@click.option('--bench-baseline', help='Compare benchmarks to the results of a commit rather than to the baseline')
+@click.option('--bench-save-baseline', is_flag=True, help='Save the benchmark results as the baseline')
+@click.option(
+    '--bench-threshold',
+    type=float,
+    default=10,
+    show_default=True,
+    help='Increase in percent of the run time of a benchmark above which it fails',
+)
+@click.option(
+    '--bench-memory-threshold',
+    type=float,
+    default=10,
+    show_default=True,
+    help='Increase in percent of the memory allocated by a benchmark above which it fails',
+)
 @click.option('--latest-metrics', is_flag=True, help='Only verify support of new metrics')
 @click.option('--e2e', is_flag=True, help='Run only end-to-end tests')
 @click.option('--cov', '-c', 'coverage', is_flag=True, help='Measure code coverage')
@@ -50,6 +159,10 @@ def test(
     format_style,
     style,
     bench,
+    bench_baseline,
+    bench_save_baseline,
+    bench_threshold,
+    bench_memory_threshold,
     latest_metrics,
     e2e,
     coverage,
@@ -76,6 +189,13 @@ def test(
 
     \b
     `$ ddev test mysql:mysql57,maria10130`
+
+    With `--bench`, the results of the benchmarks of every environment are saved as JSON under
+    `.benchmarks/<CHECK>/<ENV>/<COMMIT>.json` and compared to the baseline, which is saved with
+    `--bench-save-baseline`, or to the results of the commit given with `--bench-baseline`.
+    Benchmarks run without network access, and their run time, memory allocated and submitted
+    points per second are reported. The command fails when any of them regresses by more than
+    the thresholds.
     """
     if list_envs:
         check_envs = get_tox_envs(checks, every=True, sort=True, changed_only=changed)
@@ -128,6 +248,24 @@ def test(
         test_env_vars[E2E_PARENT_PYTHON] = sys.executable
         test_env_vars['TOX_TESTENV_PASSENV'] += f' {E2E_PARENT_PYTHON}'
 
+    if bench:
+        commit = get_commit_hash()
+        if commit is None:
+            abort('Benchmark results are saved by commit, unable to get the current one!')
+
+        baseline_commit = None
+        if bench_baseline:
+            baseline_commit = get_commit_hash(bench_baseline)
+            if baseline_commit is None:
+                abort(f'Unknown baseline commit `{bench_baseline}`!')
+
+        thresholds = {
+            'mean': bench_threshold,
+            'memory_peak': bench_memory_threshold,
+            'points_per_second': bench_threshold,
+        }
+        regressions = 0
+
     check_envs = get_tox_envs(checks, style=style, format_style=format_style, benchmark=bench, changed_only=changed)
     tests_ran = False
 
@@ -145,7 +283,7 @@ def test(
         tests_ran = True
 
         # Build pytest options
-        pytest_options = construct_pytest_options(
+        pytest_option_kwargs = dict(
             check=check,
             verbose=verbose,
             color=color,
@@ -160,6 +298,7 @@ def test(
             pytest_args=pytest_args,
             e2e=e2e,
         )
+        pytest_options = construct_pytest_options(**pytest_option_kwargs)
         if coverage:
             pytest_options = pytest_options.format(pytest_coverage_sources(check))
         test_env_vars['PYTEST_ADDOPTS'] = pytest_options
@@ -185,17 +324,28 @@ def test(
             echo_waiting(wait_text)
             echo_waiting('-' * len(wait_text))
 
-            result = run_command(
-                'tox '
-                # so users won't get failures for our possibly strict CI requirements
-                '--skip-missing-interpreters '
-                # so coverage tracks the real locations instead of .tox virtual envs
-                '--develop '
-                # comma-separated list of environments
-                '-e {}'.format(','.join(envs))
-            )
-            if result.code:
-                abort('\nFailed!', code=result.code)
+            if bench:
+                # Each environment records its own results
+                for env in envs:
+                    results_path = get_benchmark_results_path(check, env, commit)
+                    ensure_parent_dir_exists(results_path)
+                    remove_path(results_path)
+
+                    pytest_options = construct_pytest_options(benchmark_json=results_path, **pytest_option_kwargs)
+                    if coverage:
+                        pytest_options = pytest_options.format(pytest_coverage_sources(check))
+                    with EnvVars({'PYTEST_ADDOPTS': pytest_options}):
+                        result = run_command(tox_command([env]))
+                    if result.code:
+                        abort('\nFailed!', code=result.code)
+
+                    regressions += report_benchmarks(
+                        check, env, commit, baseline_commit, thresholds, bench_save_baseline
+                    )
+            else:
+                result = run_command(tox_command(envs))
+                if result.code:
+                    abort('\nFailed!', code=result.code)
 
             if coverage and file_exists('.coverage'):
                 if not cov_keep:
@@ -223,6 +373,9 @@ def test(
         if e2e:
             break
 
+    if bench and regressions:
+        abort(f'\n{regressions} benchmark statistic(s) regressed!')
+
     if not tests_ran:
         if format_style:
             echo_warning('Code formatting is not enabled!')
@@ -34,6 +34,16 @@ def get_current_branch():
         return run_command(command, capture='out').stdout.strip()
 
 
+def get_commit_hash(ref='HEAD'):
+    """
+    Get the full hash of the commit a ref points to, or `None` if there is no such commit.
+    """
+    command = f'git rev-parse --verify --quiet {ref}^{{commit}}'
+
+    with chdir(get_root()):
+        return run_command(command, capture='out').stdout.strip() or None
+
+
 def files_changed():
     """
     Return the list of file changed in the current branch compared to `master`
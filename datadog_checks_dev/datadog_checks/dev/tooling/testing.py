@@ -189,6 +189,7 @@ def construct_pytest_options(
     test_filter='',
     pytest_args='',
     e2e=False,
+    benchmark_json=None,
 ):
     # Prevent no verbosity
     pytest_options = f'--verbosity={verbose or 1}'
@@ -208,6 +209,10 @@ def construct_pytest_options(
 
     if bench:
         pytest_options += ' --benchmark-only --benchmark-cprofile=tottime'
+
+        # Record the results, with the memory and throughput of each benchmark, without reaching the network
+        if benchmark_json:
+            pytest_options += f' --benchmark-json={benchmark_json} --bench-stats --block-network'
     else:
         pytest_options += ' --benchmark-skip'
 
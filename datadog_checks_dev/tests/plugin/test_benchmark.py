@@ -0,0 +1,103 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import json
+
+import pytest
+from six import PY2
+
+from datadog_checks.dev.plugin.pytest import is_loopback
+
+pytest_plugins = ['pytester']
+
+
+@pytest.mark.parametrize(
+    'host, expected',
+    [
+        pytest.param('localhost', True, id='localhost'),
+        pytest.param('127.0.0.1', True, id='ipv4 loopback'),
+        pytest.param('::1', True, id='ipv6 loopback'),
+        pytest.param('example.com', False, id='hostname'),
+        pytest.param('10.0.0.1', False, id='ip'),
+        pytest.param(None, False, id='none'),
+    ],
+)
+def test_is_loopback(host, expected):
+    assert is_loopback(host) is expected
+
+
+def test_block_network(testdir):
+    testdir.makepyfile(
+        """
+        import socket
+
+        def test_remote():
+            socket.create_connection(('example.com', 80), timeout=1)
+
+        def test_remote_ip():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect(('10.255.255.1', 80))
+            except Exception:
+                pass
+
+        def test_local():
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            socket.create_connection(server.getsockname(), timeout=1).close()
+            server.close()
+        """
+    )
+
+    result = testdir.runpytest('--block-network')
+
+    result.assert_outcomes(passed=1, failed=2)
+    result.stdout.fnmatch_lines(['*Network access is blocked, tried to reach: example.com*'])
+
+
+def test_network_allowed_by_default(testdir):
+    testdir.makepyfile(
+        """
+        import socket
+
+        def test_guard_not_installed():
+            assert socket.getaddrinfo.__module__ == 'socket'
+        """
+    )
+
+    testdir.runpytest().assert_outcomes(passed=1)
+
+
+@pytest.mark.skipif(PY2, reason='tracemalloc is only available on Python 3')
+def test_bench_stats(testdir):
+    testdir.makepyfile(
+        """
+        from datadog_checks.base import AgentCheck
+
+        def test_submit(benchmark):
+            check = AgentCheck('test', {}, [{}])
+
+            def submit():
+                for i in range(10):
+                    check.gauge('foo', i)
+                return [0] * 100000
+
+            benchmark(submit)
+
+        def test_pedantic(benchmark):
+            benchmark.pedantic(lambda: None, rounds=1)
+        """
+    )
+
+    result = testdir.runpytest('--bench-stats', '--benchmark-json=results.json')
+
+    result.assert_outcomes(passed=2)
+    with open(str(testdir.tmpdir.join('results.json'))) as f:
+        benchmarks = {benchmark['name']: benchmark for benchmark in json.load(f)['benchmarks']}
+
+    extra_info = benchmarks['test_submit']['extra_info']
+    assert extra_info['points'] == 10
+    assert extra_info['points_per_second'] > 0
+    assert extra_info['memory_peak'] >= 800000
+    assert benchmarks['test_pedantic']['extra_info'] == {}
@@ -0,0 +1,82 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import json
+import os
+
+import pytest
+
+from datadog_checks.dev.tooling.benchmarks import (
+    compare_benchmark_results,
+    format_benchmark_stat,
+    load_benchmark_results,
+)
+
+THRESHOLDS = {'mean': 10, 'memory_peak': 20, 'points_per_second': 10}
+
+
+def test_load_benchmark_results(tmpdir):
+    path = str(tmpdir.join('results.json'))
+    with open(path, 'w') as f:
+        json.dump(
+            {
+                'benchmarks': [
+                    {'name': 'test_run', 'stats': {'mean': 0.5, 'max': 1}, 'extra_info': {'points': 10}},
+                    {'name': 'test_parse', 'stats': {'mean': 0.25}},
+                ]
+            },
+            f,
+        )
+
+    assert load_benchmark_results(path) == {'test_run': {'mean': 0.5, 'points': 10}, 'test_parse': {'mean': 0.25}}
+
+
+def test_load_benchmark_results_missing(tmpdir):
+    assert load_benchmark_results(os.path.join(str(tmpdir), 'results.json')) == {}
+
+
+def test_compare_benchmark_results():
+    results = {
+        'test_new': {'mean': 1},
+        'test_run': {'mean': 1.2, 'memory_peak': 1100, 'points_per_second': 80},
+    }
+    baseline = {
+        'test_old': {'mean': 1},
+        'test_run': {'mean': 1, 'memory_peak': 1000, 'points_per_second': 100},
+    }
+
+    comparison = [
+        (name, stat, baseline_value, value, round(change, 1), regressed)
+        for name, stat, baseline_value, value, change, regressed in compare_benchmark_results(
+            results, baseline, THRESHOLDS
+        )
+    ]
+
+    assert comparison == [
+        ('test_run', 'mean', 1, 1.2, 20.0, True),
+        ('test_run', 'memory_peak', 1000, 1100, 10.0, False),
+        ('test_run', 'points_per_second', 100, 80, -20.0, True),
+    ]
+
+
+def test_compare_benchmark_results_improvement():
+    comparison = compare_benchmark_results(
+        {'test_run': {'mean': 0.5, 'points_per_second': 200}},
+        {'test_run': {'mean': 1, 'points_per_second': 100}},
+        THRESHOLDS,
+    )
+
+    assert [regressed for _, _, _, _, _, regressed in comparison] == [False, False]
+
+
+@pytest.mark.parametrize(
+    'stat, value, expected',
+    [
+        pytest.param('mean', 0.0123456, '12.346ms', id='mean'),
+        pytest.param('memory_peak', 2048, '2.0KiB', id='memory'),
+        pytest.param('points_per_second', 1234.5, '1234/s', id='throughput'),
+        pytest.param('mean', None, '-', id='missing'),
+    ],
+)
+def test_format_benchmark_stat(stat, value, expected):
+    assert format_benchmark_stat(stat, value) == expected
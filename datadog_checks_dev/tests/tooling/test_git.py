@@ -6,6 +6,7 @@ import mock
 from datadog_checks.dev.tooling.constants import set_root
 from datadog_checks.dev.tooling.git import (
     files_changed,
+    get_commit_hash,
     get_commits_since,
     get_current_branch,
     git_commit,
@@ -26,6 +27,26 @@ def test_get_current_branch():
             run.assert_called_once_with('git rev-parse --abbrev-ref HEAD', capture='out')
 
 
+def test_get_commit_hash():
+    with mock.patch('datadog_checks.dev.tooling.git.chdir') as chdir:
+        with mock.patch('datadog_checks.dev.tooling.git.run_command') as run:
+            run.return_value = mock.MagicMock()
+            run.return_value.stdout = 'abc123\n'
+            set_root('/foo/')
+            assert get_commit_hash('master') == 'abc123'
+            chdir.assert_called_once_with('/foo/')
+            run.assert_called_once_with('git rev-parse --verify --quiet master^{commit}', capture='out')
+
+
+def test_get_commit_hash_unknown():
+    with mock.patch('datadog_checks.dev.tooling.git.chdir'):
+        with mock.patch('datadog_checks.dev.tooling.git.run_command') as run:
+            run.return_value = mock.MagicMock()
+            run.return_value.stdout = ''
+            set_root('/foo/')
+            assert get_commit_hash() is None
+
+
 def test_files_changed():
     with mock.patch('datadog_checks.dev.tooling.git.chdir') as chdir:
         with mock.patch('datadog_checks.dev.tooling.git.run_command') as run: